@@ -0,0 +1,175 @@
+"""Admission control in front of process_message.
+
+Engine work runs on a fixed number of slots (threads). Requests beyond that
+wait in one queue per campaign, and freed slots are handed out by weighted
+fair queuing: every queued request gets a virtual finish tag,
+max(virtual time, campaign's last tag) + 1 / weight, and the smallest tag
+among the queue heads goes next. A campaign blasting thousands of replies
+therefore only delays itself; a small campaign's next message is served
+after at most one request of each busier campaign.
+
+A campaign whose queue is full is rejected immediately with Overloaded, so
+main.py can answer "try again" instead of letting every queue grow.
+
+Per-campaign counters and recent queue-wait/service-time percentiles are
+kept for the /admin/admission endpoint.
+"""
+import os
+import time
+import heapq
+import asyncio
+import itertools
+from array import array
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional
+
+ADMISSION_SLOTS = int(os.getenv("ADMISSION_SLOTS", "8"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "200"))
+ADMISSION_WEIGHTS = os.getenv("ADMISSION_WEIGHTS", "")  # "campaign_id=2,other_id=0.5"
+SAMPLE_SIZE = 1024
+
+class Overloaded(Exception):
+    """The campaign's queue is full."""
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    weights = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        campaign_id, _, weight = item.partition("=")
+        weights[campaign_id.strip()] = float(weight)
+    return weights
+
+class _Samples:
+    """Ring buffer of the latest durations, in seconds."""
+    def __init__(self, size: int = SAMPLE_SIZE):
+        self.values = array("d")
+        self.size = size
+        self.next = 0
+
+    def add(self, value: float) -> None:
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            self.values[self.next] = value
+        self.next = (self.next + 1) % self.size
+
+    def percentiles(self) -> Dict[str, float]:
+        if not self.values:
+            return {}
+        ordered = sorted(self.values)
+        pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+        return {"p50_ms": round(pick(0.50) * 1000, 2), "p99_ms": round(pick(0.99) * 1000, 2),
+                "max_ms": round(ordered[-1] * 1000, 2)}
+
+class _CampaignStats:
+    def __init__(self):
+        self.admitted = 0
+        self.rejected = 0
+        self.in_service = 0
+        self.wait = _Samples()
+        self.service = _Samples()
+
+class AdmissionController:
+    """Weighted fair queuing of engine work across campaigns.
+
+    Only used from the event loop thread, so it needs no locks.
+    """
+    def __init__(self, slots: int = ADMISSION_SLOTS, max_queue: int = ADMISSION_MAX_QUEUE,
+                 weights: Optional[Dict[str, float]] = None):
+        self.slots = slots
+        self.free = slots
+        self.max_queue = max_queue
+        self.weights = weights or {}
+        self.queues: Dict[str, deque] = {}
+        self.finish: Dict[str, float] = {}  # last virtual finish tag per campaign
+        self.heads: list = []  # (tag, seq, campaign_id) of each non-empty queue's head
+        self.vtime = 0.0
+        self.stats: Dict[str, _CampaignStats] = {}
+        self._seq = itertools.count()
+
+    def _stats(self, campaign_id: str) -> _CampaignStats:
+        stats = self.stats.get(campaign_id)
+        if stats is None:
+            stats = self.stats[campaign_id] = _CampaignStats()
+        return stats
+
+    async def acquire(self, campaign_id: str) -> float:
+        """Waits for a slot; returns the time spent queued."""
+        stats = self._stats(campaign_id)
+        if self.free > 0 and not self.heads:
+            self.free -= 1
+            stats.admitted += 1
+            stats.wait.add(0.0)
+            return 0.0
+        queue = self.queues.setdefault(campaign_id, deque())
+        if len(queue) >= self.max_queue:
+            stats.rejected += 1
+            raise Overloaded(campaign_id)
+        tag = max(self.vtime, self.finish.get(campaign_id, 0.0)) + 1.0 / self.weights.get(campaign_id, 1.0)
+        self.finish[campaign_id] = tag
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append((tag, waiter))
+        if len(queue) == 1:
+            heapq.heappush(self.heads, (tag, next(self._seq), campaign_id))
+        started = time.perf_counter()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the caller went away
+                self.release()
+            raise
+        waited = time.perf_counter() - started
+        stats.admitted += 1
+        stats.wait.add(waited)
+        return waited
+
+    def release(self) -> None:
+        """Frees a slot, handing it straight to the next request in fair order."""
+        while self.heads:
+            tag, _, campaign_id = heapq.heappop(self.heads)
+            queue = self.queues[campaign_id]
+            _, waiter = queue.popleft()
+            if queue:
+                heapq.heappush(self.heads, (queue[0][0], next(self._seq), campaign_id))
+            else:
+                del self.queues[campaign_id]
+            if waiter.cancelled():
+                continue
+            self.vtime = tag
+            waiter.set_result(None)
+            return
+        self.free += 1
+
+    @asynccontextmanager
+    async def slot(self, campaign_id: str):
+        await self.acquire(campaign_id)
+        stats = self._stats(campaign_id)
+        stats.in_service += 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats.in_service -= 1
+            stats.service.add(time.perf_counter() - started)
+            self.release()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Counters and latency percentiles per campaign."""
+        return {
+            "slots": self.slots,
+            "free": self.free,
+            "max_queue": self.max_queue,
+            "campaigns": {
+                campaign_id: {
+                    "weight": self.weights.get(campaign_id, 1.0),
+                    "queued": len(self.queues.get(campaign_id, ())),
+                    "in_service": stats.in_service,
+                    "admitted": stats.admitted,
+                    "rejected": stats.rejected,
+                    "queue_wait": stats.wait.percentiles(),
+                    "service": stats.service.percentiles(),
+                }
+                for campaign_id, stats in self.stats.items()
+            },
+        }
@@ -0,0 +1,239 @@
+"""Campaign reports computed over columnar NumPy arrays.
+
+A campaign's sessions are streamed page by page from whatsapp_user_states,
+plus the archive table or archive files written by archive_states.py when
+given. Each page is encoded into columns and then discarded:
+
+- one int16 array per choice question, holding the option index
+  (UNANSWERED if the question was not answered, OTHER for an answer that
+  matches no option). Compact answers already carry the index.
+- one bool array per text question: answered or not.
+- the position of the session's current question (COMPLETED or
+  NOT_STARTED when there is none).
+
+Memory is therefore about two bytes per respondent and choice question,
+whatever the size of the answers JSON. Distributions, crosstabs between any
+two choice questions, and the funnel are then bincounts over these arrays.
+
+Usage:
+    python analytics.py --campaign-id abc
+    python analytics.py --campaign-id abc --crosstab 1 3 --archive-table whatsapp_user_states_archive
+"""
+import os
+import sys
+import glob
+import gzip
+import json
+import time
+import argparse
+from typing import Dict, Any, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from flow_model import Flow
+from state_codec import is_compact, flow_schema, SCHEMA_KEY
+
+UNANSWERED = -1
+OTHER = -2
+NOT_STARTED = -1
+COMPLETED = -2
+DEFAULT_PAGE_SIZE = 1000
+
+class CampaignColumns:
+    """Columnar answers of a campaign's sessions."""
+    def __init__(self, flow: Flow):
+        self.flow = flow
+        # A repeated id is one question, as in the flow index
+        questions = [q for i, q in enumerate(flow.questions) if flow.index[q.id] == i]
+        self.questions = questions
+        self.choice_ids = [q.id for q in questions if q.is_choice]
+        self.text_ids = [q.id for q in questions if not q.is_choice]
+        self._choice_slot = {qid: i for i, qid in enumerate(self.choice_ids)}
+        self._text_slot = {qid: i for i, qid in enumerate(self.text_ids)}
+        self._codes = flow.option_codes()
+        self._option_counts = [len(flow.find(qid).options) for qid in self.choice_ids]
+        self._schema = flow_schema(flow)
+        self._blocks: List[tuple] = []
+        self.choices = np.empty((0, len(self.choice_ids)), dtype=np.int16)
+        self.texts = np.empty((0, len(self.text_ids)), dtype=bool)
+        self.steps = np.empty(0, dtype=np.int32)
+
+    @property
+    def size(self) -> int:
+        return len(self.steps)
+
+    def add_page(self, rows: List[Dict]) -> None:
+        """Encodes one page of state rows; the rows can be dropped afterwards."""
+        choices = np.full((len(rows), len(self.choice_ids)), UNANSWERED, dtype=np.int16)
+        texts = np.zeros((len(rows), len(self.text_ids)), dtype=bool)
+        steps = np.empty(len(rows), dtype=np.int32)
+        index = self.flow.index
+        for r, row in enumerate(rows):
+            answers = row.get("answers") or {}
+            if isinstance(answers, str):
+                answers = json.loads(answers)
+            compact = is_compact(answers)
+            # Indices written against another flow version count as OTHER, as in decode_answers
+            current = compact and answers[SCHEMA_KEY] == self._schema
+            for question_id, answer in answers.items():
+                slot = self._choice_slot.get(question_id)
+                if slot is not None:
+                    if compact and isinstance(answer, int) and not isinstance(answer, bool):
+                        choices[r, slot] = answer if current and 0 <= answer < self._option_counts[slot] else OTHER
+                    else:
+                        choices[r, slot] = self._codes.get(question_id, {}).get(str(answer), OTHER)
+                    continue
+                slot = self._text_slot.get(question_id)
+                if slot is not None:
+                    texts[r, slot] = True
+            step = row.get("current_step")
+            if step is None:
+                steps[r] = COMPLETED if answers else NOT_STARTED
+            else:
+                steps[r] = index.get(str(step), NOT_STARTED)
+        self._blocks.append((choices, texts, steps))
+
+    def finish(self) -> "CampaignColumns":
+        """Joins the encoded pages into single arrays."""
+        if self._blocks:
+            blocks = [(self.choices, self.texts, self.steps)] + self._blocks
+            self.choices = np.concatenate([b[0] for b in blocks])
+            self.texts = np.concatenate([b[1] for b in blocks])
+            self.steps = np.concatenate([b[2] for b in blocks])
+            self._blocks = []
+        return self
+
+    def answered(self, question_id: str) -> np.ndarray:
+        if question_id in self._choice_slot:
+            return self.choices[:, self._choice_slot[question_id]] != UNANSWERED
+        return self.texts[:, self._text_slot[question_id]]
+
+    def distribution(self, question_id: str) -> Dict[str, Any]:
+        """Answer counts of one choice question, by option text."""
+        question = self.flow.find(question_id)
+        column = self.choices[:, self._choice_slot[question.id]]
+        counts = np.bincount(column[column >= 0], minlength=len(question.options))
+        answered = int(np.count_nonzero(column != UNANSWERED))
+        options = {}
+        for i, opt in enumerate(question.options):
+            # Repeated option texts share the first one's index
+            options.setdefault(opt.text, int(counts[i]))
+        return {
+            "answered": answered,
+            "other": int(np.count_nonzero(column == OTHER)),
+            "options": {text: {"count": count, "share": round(count / answered, 4) if answered else 0.0}
+                        for text, count in options.items()},
+        }
+
+    def crosstab(self, row_id: str, column_id: str) -> Dict[str, Any]:
+        """Counts of every option pair between two choice questions, over sessions that answered both."""
+        rows_q, cols_q = self.flow.find(row_id), self.flow.find(column_id)
+        a = self.choices[:, self._choice_slot[rows_q.id]]
+        b = self.choices[:, self._choice_slot[cols_q.id]]
+        both = (a >= 0) & (b >= 0)
+        k_a, k_b = len(rows_q.options), len(cols_q.options)
+        table = np.bincount(a[both].astype(np.int64) * k_b + b[both], minlength=k_a * k_b).reshape(k_a, k_b)
+        return {
+            "rows": rows_q.id,
+            "columns": cols_q.id,
+            "respondents": int(np.count_nonzero(both)),
+            "row_labels": [opt.text for opt in rows_q.options],
+            "column_labels": [opt.text for opt in cols_q.options],
+            "counts": table.tolist(),
+        }
+
+    def funnel(self) -> List[Dict[str, Any]]:
+        """Per question: sessions that reached it, answered it, and stopped there."""
+        stopped = np.bincount(self.steps[self.steps >= 0], minlength=len(self.flow.questions))
+        nodes = []
+        for question in self.questions:
+            position = self.flow.index[question.id]
+            answered = int(np.count_nonzero(self.answered(question.id)))
+            reached = answered + int(stopped[position])
+            nodes.append({
+                "id": question.id,
+                "reached": reached,
+                "answered": answered,
+                "stopped": int(stopped[position]),
+                "drop_off": round(int(stopped[position]) / reached, 4) if reached else 0.0,
+            })
+        return nodes
+
+    def report(self, crosstabs: Iterable[tuple] = ()) -> Dict[str, Any]:
+        return {
+            "campaign_id": self.flow.campaign_id,
+            "sessions": self.size,
+            "completed": int(np.count_nonzero(self.steps == COMPLETED)),
+            "not_started": int(np.count_nonzero(self.steps == NOT_STARTED)),
+            "distributions": {qid: self.distribution(qid) for qid in self.choice_ids},
+            "crosstabs": [self.crosstab(a, b) for a, b in crosstabs],
+            "funnel": self.funnel(),
+        }
+
+def iter_archive_files(directory: str, campaign_id: str, page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[List[Dict]]:
+    """Pages of one campaign's rows from the gzip NDJSON files of archive_states.py."""
+    page = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.ndjson.gz"))):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                if row.get("campaign_id") == campaign_id:
+                    page.append(row)
+                    if len(page) >= page_size:
+                        yield page
+                        page = []
+    if page:
+        yield page
+
+def load_columns(campaign: Dict, page_size: int = DEFAULT_PAGE_SIZE, archive_table: Optional[str] = None,
+                 archive_key: str = "id", archive_dir: Optional[str] = None) -> CampaignColumns:
+    """Streams every session of a campaign, live and archived, into columns."""
+    from flow_compiler import get_compiled_flow
+    from supabase_client import iter_pages
+
+    campaign_id = campaign["campaign_id"]
+    columns = CampaignColumns(get_compiled_flow(campaign))
+    filters = {"campaign_id": f"eq.{campaign_id}"}
+    # The next page is fetched while the current one is encoded
+    sources = [iter_pages("whatsapp_user_states", "phone,current_step,answers", "phone", page_size,
+                          filters=filters, prefetch=1)]
+    if archive_table:
+        # Archived sessions repeat phones, so they are paged by the table's own unique key
+        sources.append(iter_pages(archive_table, f"{archive_key},current_step,answers", archive_key,
+                                  page_size, filters=filters, prefetch=1))
+    if archive_dir:
+        sources.append(iter_archive_files(archive_dir, campaign_id, page_size))
+    for pages in sources:
+        for page in pages:
+            columns.add_page(page)
+    return columns.finish()
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Distributions, crosstabs and funnel of a campaign.")
+    parser.add_argument("--campaign-id", required=True)
+    parser.add_argument("--crosstab", nargs=2, action="append", default=[], metavar=("ROWS", "COLUMNS"),
+                        help="two choice question ids (repeatable)")
+    parser.add_argument("--archive-table", help="also read sessions archived to this table")
+    parser.add_argument("--archive-key", default="id", help="unique column to page the archive table by")
+    parser.add_argument("--archive-dir", help="also read archive_states.py NDJSON files")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE)
+    args = parser.parse_args(argv)
+
+    from log_config import configure_logging
+    from supabase_client import get_campaign
+    configure_logging("supabase.log")
+    campaign = get_campaign(args.campaign_id)
+    if not campaign:
+        print(f"{args.campaign_id}: campanha não encontrada", file=sys.stderr)
+        return 1
+    started = time.perf_counter()
+    columns = load_columns(campaign, args.page_size, args.archive_table, args.archive_key, args.archive_dir)
+    loaded = time.perf_counter()
+    report = columns.report(args.crosstab)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    print(f"{columns.size} sessões: leitura {loaded - started:.2f}s, cálculo {time.perf_counter() - loaded:.3f}s",
+          file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
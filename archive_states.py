@@ -0,0 +1,185 @@
+"""Moves finished and abandoned sessions out of whatsapp_user_states.
+
+Completed sessions (current_step is null) and sessions idle for longer than
+the TTL are copied to an archive table or to gzip NDJSON files, then deleted
+from the hot table in batches. Each delete is guarded by the step and
+activity timestamp that were archived, so a session that moved on in the
+meantime is left alone.
+
+A deleted row reads back as {"current_step": None, "answers": {}}, which is
+what get_user_state already returns for a user with no state: a completed
+user starting over behaves exactly as before, and an expired open session
+simply restarts the survey. The deleted keys are announced on the cache
+bus, so no worker keeps serving the archived state (see state_cache.py).
+
+Idle detection needs an activity column kept current on every write, e.g.:
+
+    alter table whatsapp_user_states add column if not exists updated_at timestamptz default now();
+    create or replace function touch_updated_at() returns trigger as $$
+    begin new.updated_at = now(); return new; end $$ language plpgsql;
+    create trigger whatsapp_user_states_touch before update on whatsapp_user_states
+    for each row execute function touch_updated_at();
+
+Usage:
+    python archive_states.py --archive-table whatsapp_user_states_archive --ttl-hours 72
+    python archive_states.py --archive-dir /var/lib/flow_engine/archive --interval 600
+"""
+import os
+import sys
+import json
+import gzip
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from log_config import configure_logging
+
+STATES_TABLE = "whatsapp_user_states"
+DEFAULT_BATCH_SIZE = 1000
+DELETE_CHUNK_SIZE = 100  # rows per guarded DELETE, keeps the URL short
+DEFAULT_TTL_HOURS = 72
+
+def _quote(value) -> str:
+    """Quotes a value for a PostgREST logical filter."""
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def eligible_filter(cutoff: Optional[str], activity_column: str, include_completed: bool = True) -> str:
+    """PostgREST `or` filter selecting completed and idle-past-TTL sessions."""
+    conditions = []
+    if include_completed:
+        conditions.append("current_step.is.null")
+    if cutoff:
+        conditions.append(f"{activity_column}.lt.{_quote(cutoff)}")
+    return "(" + ",".join(conditions) + ")"
+
+def guard_filter(rows: List[Dict], activity_column: str) -> str:
+    """PostgREST `or` filter matching exactly the archived versions of `rows`."""
+    guards = []
+    for row in rows:
+        parts = [f"phone.eq.{_quote(row['phone'])}", f"campaign_id.eq.{_quote(row['campaign_id'])}"]
+        if row.get("current_step") is None:
+            parts.append("current_step.is.null")
+        else:
+            parts.append(f"current_step.eq.{_quote(row['current_step'])}")
+        if row.get(activity_column) is not None:
+            parts.append(f"{activity_column}.eq.{_quote(row[activity_column])}")
+        guards.append("and(" + ",".join(parts) + ")")
+    return "(" + ",".join(guards) + ")"
+
+def write_archive_file(directory: str, rows: List[Dict]) -> str:
+    """Writes rows as gzip NDJSON, durable before it becomes visible under its final name."""
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    path = os.path.join(directory, f"{STATES_TABLE}-{stamp}.ndjson.gz")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False).encode("utf-8") + b"\n")
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+def announce_deleted(bus: Any, rows: List[Dict]) -> None:
+    """Tells the workers' state caches to drop the given sessions."""
+    phones: Dict[str, List[str]] = {}
+    for row in rows:
+        phones.setdefault(row["campaign_id"], []).append(row["phone"])
+    for campaign_id, campaign_phones in phones.items():
+        bus.publish_states(campaign_id, campaign_phones)
+
+def archive_batch(rows: List[Dict], archive_table: Optional[str], archive_dir: Optional[str],
+                  activity_column: str, bus: Any = None) -> int:
+    """Archives then deletes one batch; returns how many rows left the hot table."""
+    from supabase_client import insert_rows, delete_rows, log_event
+
+    archived_at = datetime.now(timezone.utc).isoformat()
+    records = [dict(row, archived_at=archived_at) for row in rows]
+    if archive_table and not insert_rows(archive_table, records):
+        raise RuntimeError(f"Falha ao gravar lote em {archive_table}")
+    if archive_dir:
+        write_archive_file(archive_dir, records)
+
+    deleted = 0
+    for start in range(0, len(rows), DELETE_CHUNK_SIZE):
+        chunk = rows[start:start + DELETE_CHUNK_SIZE]
+        count = delete_rows(STATES_TABLE, {"or": guard_filter(chunk, activity_column)}, returning="phone")
+        if count is None:
+            raise RuntimeError(f"Falha ao remover lote de {STATES_TABLE}")
+        deleted += count
+        if bus is not None and count:
+            # Rows whose guard no longer matched are announced too; that only costs a read
+            announce_deleted(bus, chunk)
+    log_event("Lote de estados arquivado", {"archived": len(rows), "deleted": deleted})
+    return deleted
+
+def compact(ttl_hours: Optional[float] = DEFAULT_TTL_HOURS, batch_size: int = DEFAULT_BATCH_SIZE,
+            archive_table: Optional[str] = None, archive_dir: Optional[str] = None,
+            activity_column: str = "updated_at", include_completed: bool = True, bus: Any = None) -> Dict:
+    """Runs one compaction pass until no eligible session is left."""
+    from cache_bus import publisher
+    from supabase_client import select_rows
+
+    if not archive_table and not archive_dir:
+        raise ValueError("informe uma tabela ou um diretório de arquivo")
+    cutoff = None
+    if ttl_hours:
+        cutoff = (datetime.now(timezone.utc) - timedelta(hours=ttl_hours)).isoformat()
+    params = {"select": "*", "or": eligible_filter(cutoff, activity_column, include_completed),
+              "limit": str(batch_size)}
+    own_bus = bus is None
+    if own_bus:
+        bus = publisher()
+    archived = deleted = 0
+    try:
+        while True:
+            rows = select_rows(STATES_TABLE, params)
+            if not rows:
+                break
+            batch_deleted = archive_batch(rows, archive_table, archive_dir, activity_column, bus)
+            archived += len(rows)
+            deleted += batch_deleted
+            # Rows whose guard no longer matched come back in the next select with
+            # their new version; stop if a whole batch was skipped that way.
+            if len(rows) < batch_size or batch_deleted == 0:
+                break
+    finally:
+        if own_bus:
+            bus.close()
+    return {"archived": archived, "deleted": deleted, "cutoff": cutoff}
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Archive completed and idle sessions out of whatsapp_user_states.")
+    parser.add_argument("--archive-table", help="table receiving archived rows (same columns plus archived_at)")
+    parser.add_argument("--archive-dir", help="directory receiving gzip NDJSON archive files")
+    parser.add_argument("--ttl-hours", type=float, default=DEFAULT_TTL_HOURS,
+                        help=f"archive open sessions idle for longer than this (default: {DEFAULT_TTL_HOURS}; 0 disables)")
+    parser.add_argument("--activity-column", default="updated_at")
+    parser.add_argument("--keep-completed", action="store_true", help="only archive idle sessions")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--interval", type=float, default=0, help="seconds between passes; 0 runs once")
+    args = parser.parse_args(argv)
+    configure_logging("supabase.log")
+    if not args.archive_table and not args.archive_dir:
+        parser.error("informe --archive-table e/ou --archive-dir")
+    if args.keep_completed and not args.ttl_hours:
+        parser.error("--keep-completed exige --ttl-hours")
+
+    from cache_bus import publisher
+    bus = publisher()
+    try:
+        while True:
+            result = compact(args.ttl_hours, args.batch_size, args.archive_table, args.archive_dir,
+                             args.activity_column, not args.keep_completed, bus)
+            print(f"{result['archived']} sessões arquivadas, {result['deleted']} removidas "
+                  f"(inatividade antes de {result['cutoff']})", file=sys.stderr)
+            if not args.interval:
+                return 0
+            time.sleep(args.interval)
+    finally:
+        bus.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
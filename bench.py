@@ -0,0 +1,245 @@
+"""Micro-benchmarks of the per-message CPU path.
+
+Each engine function, and the compilation and lookup of the flow a message
+needs, is timed on generated flows of several sizes (10, 1,000 and 10,000
+questions by default). Choice questions cycle through 2 to --max-options
+options. Every benchmark reports the best time per call and,
+across sizes, its growth exponent: 0 is constant time and 1 is linear in
+the number of questions.
+
+`compare` checks a run against a stored baseline and fails on a slowdown
+beyond --threshold. It also fails when a benchmark's growth exponent rose
+by more than --max-exponent-increase. The exponent check catches an O(1)
+lookup turning into a scan even when the small flows stay fast.
+
+Logging is left unconfigured, so log_event returns before formatting
+anything. The numbers measure the engine itself.
+
+Usage:
+    python bench.py run --save bench_baseline.json
+    python bench.py compare bench_baseline.json          # runs again and compares
+    python bench.py compare bench_baseline.json new.json
+"""
+import sys
+import math
+import json
+import time
+import random
+import argparse
+import platform
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from text_utils import normalize_text, is_valid_cpf
+
+DEFAULT_SIZES = (10, 1000, 10000)
+DEFAULT_MAX_OPTIONS = 12
+DEFAULT_THRESHOLD = 1.25
+DEFAULT_MAX_EXPONENT_INCREASE = 0.3
+MIN_BATCH_SECONDS = 0.02
+REPEATS = 5
+PHONE = "5511999999999"
+
+def generate_campaign(questions: int, max_options: int = DEFAULT_MAX_OPTIONS, seed: int = 0) -> Dict[str, Any]:
+    """A campaign row whose flow mixes choice and text questions, targets and conditions."""
+    rng = random.Random(seed)
+    flow = []
+    for i in range(questions):
+        kind = ("quick_reply", "multiple_choice", "text", "open_text")[i % 4]
+        question = {"id": f"q{i}", "text": f"Pergunta {i}: o que você acha da proposta {i}?", "type": kind}
+        if kind in ("quick_reply", "multiple_choice"):
+            count = 2 + (i // 4) % (max_options - 1) if kind == "multiple_choice" else 2 + i % 2
+            question["options"] = [
+                {"text": f"Opção {j} da pergunta {i}",
+                 "target": f"q{rng.randrange(i + 1, questions)}" if j == 0 and i + 1 < questions and rng.random() < 0.2 else None}
+                for j in range(count)
+            ]
+        if i and i % 7 == 0:
+            question["condition"] = f"Opção 1 da pergunta {i - 3}"
+        flow.append(question)
+    return {"campaign_id": f"bench-{questions}", "flow_json": {"type": "standard", "questions": flow}}
+
+def _complete(coroutine: Any) -> Any:
+    """Runs a coroutine that never suspends, without the cost of an event loop."""
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError("coroutine suspended")
+
+def measure(func: Callable[[], Any]) -> float:
+    """Best time per call in nanoseconds, over REPEATS batches of at least MIN_BATCH_SECONDS."""
+    number = 1
+    while True:
+        started = time.perf_counter_ns()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter_ns() - started
+        if elapsed >= MIN_BATCH_SECONDS * 1e9:
+            break
+        number *= 2
+    best = elapsed / number
+    for _ in range(REPEATS - 1):
+        started = time.perf_counter_ns()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter_ns() - started) / number)
+    return best
+
+def sized_cases(size: int, max_options: int) -> Dict[str, Callable[[], Any]]:
+    """The flow-dependent benchmarks on a flow of `size` questions."""
+    import flow_compiler
+    from engine import SurveyProcessor
+    from flow_compiler import compile_campaign, get_compiled_flow
+    from state_store import InMemoryStateStore
+
+    campaign = generate_campaign(size, max_options)
+    store = InMemoryStateStore({campaign["campaign_id"]: campaign})
+    processor = SurveyProcessor(campaign, PHONE, campaign["campaign_id"], store)
+    questions = processor.questions
+    choices = [q for q in questions if q.is_choice]
+    widest = max(choices, key=lambda q: len(q.options))
+    last_choice = choices[-1]
+    middle = questions[len(questions) // 2]
+    middle_choice = next(q for q in questions[len(questions) // 2:] if q.is_choice)
+    last_option = last_choice.options[-1].text
+
+    def process() -> Any:
+        # Back at the same question every time, so each call does the same work
+        store.rows[(PHONE, campaign["campaign_id"])] = {
+            "phone": PHONE, "campaign_id": campaign["campaign_id"],
+            "current_step": middle_choice.id, "answers": {},
+        }
+        runner = SurveyProcessor(campaign, PHONE, campaign["campaign_id"], store)
+        return _complete(runner.process("2"))
+
+    def compile_cold() -> Any:
+        # A worker's first message for the campaign, with no artifact on disk
+        flow_compiler._compiled_cache.clear()
+        flow_compiler._row_flows.clear()
+        return get_compiled_flow(campaign)
+
+    return {
+        "compile_campaign": lambda: compile_campaign(campaign),
+        "get_compiled_flow.cold": compile_cold,
+        # The same row again, as CampaignCache serves it on every message
+        "get_compiled_flow": lambda: get_compiled_flow(campaign),
+        # An unchanged campaign fetched again is hashed to find its flow
+        "get_compiled_flow.new_row": lambda: get_compiled_flow(dict(campaign)),
+        "validate_answer.opt_index": lambda: processor._validate_answer(last_choice, "opt_1"),
+        "validate_answer.text": lambda: processor._validate_answer(last_choice, last_option),
+        "validate_answer.open_text": lambda: processor._validate_answer(middle if not middle.is_choice else questions[2], "uma resposta livre"),
+        # An answer no condition matches scans the rest of the flow before falling back
+        "get_next_question.first": lambda: processor._get_next_question(questions[0], "nenhuma condição"),
+        "get_next_question.middle": lambda: processor._get_next_question(middle, "nenhuma condição"),
+        "format_options.widest": lambda: processor._format_options(widest),
+        "process": process,
+    }
+
+def fixed_cases() -> Dict[str, Callable[[], Any]]:
+    """Benchmarks that do not depend on the flow."""
+    message = "Sim, eu apoio a proposta &amp; quero participar 👍"
+    return {
+        "normalize_text": lambda: normalize_text(message),
+        "is_valid_cpf.valid": lambda: is_valid_cpf("529.982.247-25"),
+        "is_valid_cpf.invalid": lambda: is_valid_cpf("123.456.789-00"),
+    }
+
+def growth_exponent(timings: Dict[str, float]) -> Optional[float]:
+    """Slope of log(time) over log(size) between the smallest and largest size."""
+    sizes = sorted(int(size) for size in timings)
+    if len(sizes) < 2:
+        return None
+    small, large = sizes[0], sizes[-1]
+    return round(math.log(timings[str(large)] / timings[str(small)]) / math.log(large / small), 3)
+
+def run(sizes: List[int], max_options: int = DEFAULT_MAX_OPTIONS, only: Optional[str] = None) -> Dict[str, Any]:
+    results: Dict[str, Dict[str, float]] = {}
+    for name, func in fixed_cases().items():
+        if not only or only in name:
+            results[name] = {"0": round(measure(func), 1)}
+    for size in sizes:
+        for name, func in sized_cases(size, max_options).items():
+            if not only or only in name:
+                results.setdefault(name, {})[str(size)] = round(measure(func), 1)
+        print(f"  {size} perguntas medidas", file=sys.stderr)
+    return {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "sizes": sizes,
+            "max_options": max_options,
+        },
+        "results": results,
+        "exponents": {name: growth_exponent(timings) for name, timings in results.items()
+                      if growth_exponent(timings) is not None},
+    }
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float = DEFAULT_THRESHOLD,
+            max_exponent_increase: float = DEFAULT_MAX_EXPONENT_INCREASE) -> List[str]:
+    """Regressions of `current` against `baseline`, one message each."""
+    problems = []
+    for name, timings in current["results"].items():
+        for size, ns in timings.items():
+            before = baseline["results"].get(name, {}).get(size)
+            if before and ns / before > threshold:
+                problems.append(f"{name} [{size}]: {before / 1000:.2f}µs -> {ns / 1000:.2f}µs ({ns / before:.2f}x)")
+        before = baseline.get("exponents", {}).get(name)
+        after = current.get("exponents", {}).get(name)
+        if before is not None and after is not None and after - before > max_exponent_increase:
+            problems.append(f"{name}: crescimento O(n^{before:.2f}) -> O(n^{after:.2f})")
+    return problems
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> None:
+    sizes = [str(size) for size in report["meta"]["sizes"]]
+    print(f"{'benchmark':<28}" + "".join(f"{'n=' + s if s != '0' else 'fixo':>14}" for s in ["0"] + sizes) + f"{'expoente':>10}")
+    for name, timings in report["results"].items():
+        cells = []
+        for size in ["0"] + sizes:
+            ns = timings.get(size)
+            cell = f"{ns / 1000:.2f}µs" if ns is not None else ""
+            before = (baseline or {}).get("results", {}).get(name, {}).get(size)
+            if ns is not None and before:
+                cell += f" {ns / before:.2f}x"
+            cells.append(f"{cell:>14}")
+        exponent = report["exponents"].get(name)
+        print(f"{name:<28}" + "".join(cells) + (f"{exponent:>10.2f}" if exponent is not None else ""))
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the engine's per-message CPU path.")
+    parser.add_argument("command", choices=["run", "compare"])
+    parser.add_argument("files", nargs="*", help="compare: baseline JSON [current JSON]")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="questions per generated flow")
+    parser.add_argument("--max-options", type=int, default=DEFAULT_MAX_OPTIONS)
+    parser.add_argument("--only", help="run only benchmarks whose name contains this")
+    parser.add_argument("--save", help="write the results as JSON")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="slowdown ratio that fails compare")
+    parser.add_argument("--max-exponent-increase", type=float, default=DEFAULT_MAX_EXPONENT_INCREASE)
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    baseline = None
+    if args.command == "compare":
+        if not args.files:
+            parser.error("compare needs a baseline file")
+        with open(args.files[0], encoding="utf-8") as f:
+            baseline = json.load(f)
+    if args.command == "compare" and len(args.files) > 1:
+        with open(args.files[1], encoding="utf-8") as f:
+            report = json.load(f)
+    else:
+        report = run(sizes, args.max_options, args.only)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    print_report(report, baseline)
+    if baseline is None:
+        return 0
+    problems = compare(baseline, report, args.threshold, args.max_exponent_increase)
+    for problem in problems:
+        print(f"REGRESSÃO {problem}", file=sys.stderr)
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,230 @@
+"""Opens a campaign to a contact list: seeds user states and sends the opening template.
+
+The CSV is streamed in batches. Each batch is seeded into
+whatsapp_user_states with one bulk upsert that ignores existing rows, so
+users already in the survey keep their progress, and new users start at the
+first question exactly as if they had sent "participar". The seeded keys are
+announced on the cache bus, so no worker keeps serving a cached "no state"
+for them (see state_cache.py). The batch's
+template messages then go out through a pool of sender threads sharing one
+rate limit. Seeding the next batch overlaps with sending the current one.
+
+The checkpoint records how many CSV rows are fully seeded and sent. A run
+resumed after a crash skips those rows; at most the batches that were in
+flight are sent again. Failed sends, including ones that raised (e.g. no
+access token), are appended to --failures as CSV, so they can be retried
+later by passing that file as the contact list. The checkpoint is also
+saved when a run stops on an error, once the batch in flight is settled.
+
+Usage:
+    python broadcast.py contacts.csv --campaign-id <uuid> --template abertura_pesquisa --rate 200
+    python broadcast.py contacts.csv --campaign-id <uuid> --template convite --body-param nome \
+        --checkpoint broadcast.json --failures falhas.csv
+"""
+import os
+import re
+import sys
+import csv
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Any, Iterator, List, Optional
+
+from whatsapp_client import SendRateLimiter, new_session, send_message, template_payload
+from log_config import configure_logging
+
+STATES_TABLE = "whatsapp_user_states"
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_CONCURRENCY = 32
+DEFAULT_RATE = 80.0  # messages per second, the default Cloud API throughput
+MIN_PHONE_DIGITS = 10
+
+def normalize_phone(value: str) -> Optional[str]:
+    """Digits-only phone as WhatsApp reports it in `from`, or None if implausible."""
+    digits = re.sub(r"\D", "", value or "")
+    return digits if len(digits) >= MIN_PHONE_DIGITS else None
+
+def iter_contact_batches(path: str, column: str, batch_size: int, skip: int = 0,
+                         seen: Optional[set] = None) -> Iterator[tuple]:
+    """Yields (rows read so far, contacts) per batch; contacts are deduplicated CSV rows."""
+    seen = seen if seen is not None else set()
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        if column not in (reader.fieldnames or []):
+            raise ValueError(f"coluna '{column}' não encontrada em {path}")
+        batch: List[Dict[str, str]] = []
+        position = 0
+        for row in reader:
+            position += 1
+            phone = normalize_phone(row.get(column))
+            if position <= skip:
+                # Already handled by an earlier run; only remembered for deduplication
+                if phone:
+                    seen.add(phone)
+                continue
+            if not phone or phone in seen:
+                continue
+            seen.add(phone)
+            row[column] = phone
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield position, batch
+                batch = []
+        if batch or position > skip:
+            yield position, batch
+
+def load_checkpoint(path: Optional[str]) -> Dict:
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return {"rows_done": 0, "seeded": 0, "sent": 0, "failed": 0}
+
+def save_checkpoint(path: Optional[str], checkpoint: Dict) -> None:
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def seed_states(campaign_id: str, first_step: str, phones: List[str]) -> None:
+    """Creates the state of every new contact in one request; existing rows are left as they are."""
+    from supabase_client import bulk_upsert
+
+    rows = [{"phone": phone, "campaign_id": campaign_id, "current_step": first_step, "answers": {}}
+            for phone in phones]
+    if not bulk_upsert(STATES_TABLE, rows, on_conflict="phone,campaign_id", ignore_duplicates=True):
+        raise RuntimeError(f"Falha ao semear lote de {len(rows)} estados")
+
+def broadcast(path: str, campaign: Dict, template: str, phone_number_id: str, language: str = "pt_BR",
+              column: str = "phone", body_params: Optional[List[str]] = None,
+              batch_size: int = DEFAULT_BATCH_SIZE, concurrency: int = DEFAULT_CONCURRENCY,
+              rate: float = DEFAULT_RATE, seed: bool = True, checkpoint_path: Optional[str] = None,
+              failures_path: Optional[str] = None, bus: Any = None) -> Dict:
+    """Seeds and messages every contact of the CSV; returns the final checkpoint."""
+    from cache_bus import publisher
+    from flow_compiler import get_compiled_flow
+    from supabase_client import log_event
+
+    campaign_id = campaign["campaign_id"]
+    flow = get_compiled_flow(campaign)
+    if not flow.questions:
+        raise ValueError(f"campanha {campaign_id} sem perguntas")
+    first_step = flow.questions[0].id
+    checkpoint = load_checkpoint(checkpoint_path)
+    checkpoint.update({"csv": os.path.abspath(path), "campaign_id": campaign_id})
+    limiter = SendRateLimiter(rate)
+    session = new_session(concurrency)
+    failures = open(failures_path, "a", newline="", encoding="utf-8") if failures_path else None
+    failures_writer = csv.writer(failures) if failures else None
+    if failures and failures.tell() == 0:
+        failures_writer.writerow([column, "status_code", "error"])
+    started = time.perf_counter()
+    sent_before = checkpoint["sent"]
+    own_bus = bus is None and seed
+    if own_bus:
+        bus = publisher()
+
+    def send(contact: Dict[str, str]) -> tuple:
+        limiter.acquire()
+        params = [contact.get(name, "") for name in body_params or []]
+        try:
+            payload = template_payload(contact[column], template, language, params)
+            ok, status, text = send_message(payload, phone_number_id, session)
+        except Exception as e:
+            # One contact's failure is recorded, not allowed to stop the run
+            return contact[column], False, None, f"{type(e).__name__}: {e}"
+        return contact[column], ok, status, text
+
+    def settle(position: int, seeded: int, futures: List[Future]) -> None:
+        checkpoint["seeded"] += seeded
+        for future in futures:
+            phone, ok, status, text = future.result()
+            if ok:
+                checkpoint["sent"] += 1
+            else:
+                checkpoint["failed"] += 1
+                if failures_writer:
+                    failures_writer.writerow([phone, status, text[:500]])
+        if failures:
+            failures.flush()
+        checkpoint["rows_done"] = position
+        save_checkpoint(checkpoint_path, checkpoint)
+        elapsed = time.perf_counter() - started
+        log_event("Lote de disparo concluído", {
+            "campaign_id": campaign_id,
+            "rows_done": position,
+            "sent": checkpoint["sent"],
+            "failed": checkpoint["failed"],
+            "rate_per_s": round((checkpoint["sent"] - sent_before) / elapsed, 1) if elapsed else 0.0
+        })
+
+    pending = None
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for position, contacts in iter_contact_batches(path, column, batch_size, checkpoint["rows_done"]):
+                if seed and contacts:
+                    phones = [c[column] for c in contacts]
+                    seed_states(campaign_id, first_step, phones)
+                    bus.publish_states(campaign_id, phones)
+                futures = [pool.submit(send, contact) for contact in contacts]
+                # Keep one batch sending while the next one is seeded
+                if pending:
+                    batch, pending = pending, None
+                    settle(*batch)
+                pending = (position, len(contacts) if seed else 0, futures)
+            batch, pending = pending, None
+            if batch:
+                settle(*batch)
+    finally:
+        try:
+            # Stopped by an error: the batch in flight was still sent
+            if pending:
+                settle(*pending)
+        finally:
+            save_checkpoint(checkpoint_path, checkpoint)
+            if failures:
+                failures.close()
+            if own_bus:
+                bus.close()
+    return checkpoint
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Seed user states and send a campaign's opening template to a CSV of contacts.")
+    parser.add_argument("csv", help="contact list with a header row")
+    parser.add_argument("--campaign-id", required=True)
+    parser.add_argument("--template", help="approved template name (default: the campaign's template_id)")
+    parser.add_argument("--language", default="pt_BR")
+    parser.add_argument("--phone-number-id", help="sender number (default: the campaign's phone_number_id)")
+    parser.add_argument("--column", default="phone", help="CSV column holding the phone number")
+    parser.add_argument("--body-param", action="append", default=[],
+                        help="CSV column filling the next template body parameter (repeatable)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="messages per second; 0 disables the limit")
+    parser.add_argument("--no-seed", action="store_true", help="only send; do not create user states")
+    parser.add_argument("--checkpoint", help="checkpoint file used to resume an interrupted run")
+    parser.add_argument("--failures", help="CSV receiving contacts whose send failed")
+    args = parser.parse_args(argv)
+    configure_logging("supabase.log")
+
+    from supabase_client import get_campaign
+    campaign = get_campaign(args.campaign_id)
+    if not campaign:
+        print(f"{args.campaign_id}: campanha não encontrada", file=sys.stderr)
+        return 1
+    template = args.template or campaign.get("template_id")
+    phone_number_id = args.phone_number_id or campaign.get("phone_number_id")
+    if not template or not phone_number_id:
+        parser.error("informe --template e --phone-number-id (a campanha não os define)")
+
+    result = broadcast(args.csv, campaign, template, phone_number_id, args.language, args.column,
+                       args.body_param, args.batch_size, args.concurrency, args.rate, not args.no_seed,
+                       args.checkpoint, args.failures)
+    print(f"{result['rows_done']} linhas processadas: {result['seeded']} estados semeados, "
+          f"{result['sent']} mensagens enviadas, {result['failed']} falhas", file=sys.stderr)
+    return 1 if result["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""Invalidation bus keeping per-process caches coherent across workers.
+
+Each worker caches campaigns (campaign_cache.CampaignCache) and, with
+STATE_CACHE_SIZE set, user states (state_cache.StateCache). When one worker
+learns that something changed, it broadcasts one of three messages:
+
+    {"kind": "campaign", "campaign_id": X}                    # row edited, e.g. flow_json
+    {"kind": "state", "phone": P, "campaign_id": X}           # state written through a StateCache
+    {"kind": "states", "campaign_id": X, "phones": [P, ...]}  # states written by a batch job
+
+Every other worker drops the matching entries, so caches can keep long
+lifetimes without serving stale reads. Batch jobs that write
+whatsapp_user_states directly (broadcast.py seeding, archive_states.py
+deletes) announce the keys they touched through publisher().
+
+Transports are chosen with CACHE_BUS_TRANSPORT:
+
+- "unix" (default): one Unix datagram socket per process in CACHE_BUS_DIR.
+  A message is sent to every socket there. This serves several uvicorn
+  workers on one host and needs no broker.
+- "none": local only, for a single process.
+- "package.module:factory": any object with publish(data: bytes),
+  start(deliver: Callable[[bytes], None]) and close(). Use it for
+  multi-host setups, e.g. a small adapter over Redis pub/sub or Postgres
+  LISTEN/NOTIFY.
+
+Messages are best effort. A lost message leaves an entry stale until the
+next invalidation or, for campaigns, the next background revalidation.
+"""
+import os
+import json
+import uuid
+import socket
+import logging
+import importlib
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+CACHE_BUS_TRANSPORT = os.getenv("CACHE_BUS_TRANSPORT", "unix")
+CACHE_BUS_DIR = os.getenv("CACHE_BUS_DIR", "/tmp/flow_engine_bus")
+PEER_REFRESH_SECONDS = 1.0
+MAX_DATAGRAM = 8192
+STATES_PER_MESSAGE = 200  # phones per "states" message, well under MAX_DATAGRAM
+
+def log_event(message: str, data: Dict = {}):
+    log_entry = {'message': message, 'data': data}
+    logging.info(json.dumps(log_entry, ensure_ascii=False))
+
+class NullTransport:
+    """Delivers nothing; every cache is local to its process."""
+    def publish(self, data: bytes) -> int:
+        return 0
+
+    def start(self, deliver: Callable[[bytes], None]) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class UnixSocketTransport:
+    """Datagram fan-out between the processes of one host.
+
+    Each process binds `<directory>/<pid>-<random>.sock` and publishes by
+    sending to every other socket in the directory. Sockets of dead
+    processes are removed when a send to them is refused.
+    """
+    def __init__(self, directory: str = CACHE_BUS_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock")
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self.path)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        self._peers: List[str] = []
+        self._peers_at = 0.0
+        self._closed = False
+
+    def _current_peers(self) -> List[str]:
+        now = time.monotonic()
+        if now - self._peers_at >= PEER_REFRESH_SECONDS:
+            self._peers = [entry.path for entry in os.scandir(self.directory)
+                           if entry.name.endswith(".sock") and entry.path != self.path]
+            self._peers_at = now
+        return self._peers
+
+    def publish(self, data: bytes) -> int:
+        sent = 0
+        for peer in self._current_peers():
+            try:
+                self._sender.sendto(data, peer)
+                sent += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The process is gone; forget its socket
+                try:
+                    os.unlink(peer)
+                except OSError:
+                    pass
+                self._peers_at = 0.0
+            except BlockingIOError:
+                log_event("Mensagem de invalidação descartada: fila do receptor cheia", {"peer": peer})
+        return sent
+
+    def start(self, deliver: Callable[[bytes], None]) -> None:
+        def receive() -> None:
+            while not self._closed:
+                try:
+                    data = self._socket.recv(MAX_DATAGRAM)
+                except OSError:
+                    return
+                deliver(data)
+
+        threading.Thread(target=receive, name="cache-bus", daemon=True).start()
+
+    def close(self) -> None:
+        self._closed = True
+        self._socket.close()
+        self._sender.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+def make_transport(spec: str = CACHE_BUS_TRANSPORT) -> Any:
+    if spec == "none":
+        return NullTransport()
+    if spec == "unix":
+        return UnixSocketTransport()
+    module_name, _, factory = spec.partition(":")
+    return getattr(importlib.import_module(module_name), factory or "make_transport")()
+
+class CacheBus:
+    """Publishes invalidations and hands the ones from other processes to subscribers."""
+    def __init__(self, transport: Any = None):
+        self.transport = transport if transport is not None else NullTransport()
+        self.origin = uuid.uuid4().hex
+        self.handlers: List[Callable[[Dict[str, Any]], None]] = []
+        self.stats = {"published": 0, "received": 0, "invalid": 0}
+
+    def subscribe(self, handler: Callable[[Dict[str, Any]], None]) -> None:
+        self.handlers.append(handler)
+
+    def start(self, transport: Any = None) -> "CacheBus":
+        """Starts receiving, on `transport` if given."""
+        if transport is not None:
+            self.transport = transport
+        self.transport.start(self._deliver)
+        return self
+
+    def close(self) -> None:
+        self.transport.close()
+
+    def publish(self, message: Dict[str, Any]) -> int:
+        """Sends a message to the other processes; returns how many were reached, if known."""
+        data = json.dumps(dict(message, origin=self.origin), separators=(",", ":")).encode("utf-8")
+        self.stats["published"] += 1
+        try:
+            return self.transport.publish(data)
+        except Exception as e:
+            log_event("Erro ao publicar invalidação", {"message": message, "error": str(e)})
+            return 0
+
+    def publish_campaign(self, campaign_id: str) -> int:
+        return self.publish({"kind": "campaign", "campaign_id": campaign_id})
+
+    def publish_state(self, phone: str, campaign_id: str) -> int:
+        return self.publish({"kind": "state", "phone": phone, "campaign_id": campaign_id})
+
+    def publish_states(self, campaign_id: str, phones: List[str]) -> int:
+        """Announces many states of one campaign, STATES_PER_MESSAGE phones per message."""
+        reached = 0
+        for start in range(0, len(phones), STATES_PER_MESSAGE):
+            reached = self.publish({"kind": "states", "campaign_id": campaign_id,
+                                    "phones": phones[start:start + STATES_PER_MESSAGE]})
+        return reached
+
+    def _deliver(self, data: bytes) -> None:
+        try:
+            message = json.loads(data)
+        except ValueError:
+            self.stats["invalid"] += 1
+            return
+        if message.get("origin") == self.origin:
+            return
+        self.stats["received"] += 1
+        for handler in self.handlers:
+            try:
+                handler(message)
+            except Exception as e:
+                log_event("Erro ao aplicar invalidação", {"message": message, "error": str(e)})
+
+def publisher() -> CacheBus:
+    """A started bus for processes that write states without a StateCache."""
+    bus = CacheBus()
+    try:
+        bus.start(make_transport())
+    except OSError as e:
+        log_event("Barramento de invalidação indisponível; os workers não serão avisados", {"error": str(e)})
+    return bus
+
+def connect(bus: CacheBus, campaign_cache: Any = None, state_cache: Any = None) -> CacheBus:
+    """Subscribes the caches to the bus: campaign messages drop the campaign and its
+    cached states, state messages drop the announced states."""
+    def handle(message: Dict[str, Any]) -> None:
+        kind = message.get("kind")
+        if kind == "campaign":
+            if campaign_cache is not None:
+                campaign_cache.invalidate(message["campaign_id"])
+            if state_cache is not None:
+                state_cache.evict_campaign(message["campaign_id"])
+        elif kind == "state" and state_cache is not None:
+            state_cache.evict(message["phone"], message["campaign_id"])
+        elif kind == "states" and state_cache is not None:
+            for phone in message["phones"]:
+                state_cache.evict(phone, message["campaign_id"])
+
+    bus.subscribe(handle)
+    return bus
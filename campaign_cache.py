@@ -0,0 +1,257 @@
+"""Warm-start snapshot and in-process cache of campaigns.
+
+The snapshot is one versioned file holding every cached campaign row
+together with its compiled flow:
+
+    b"FLOWSNAP" | u32 snapshot version | u32 artifact version | u64 index length
+    | index JSON {campaign_id: [offset, length, fetched_at]} | records
+
+A new worker memory-maps the file and parses only the index. The first
+request for a campaign decodes that one record and seeds the flow compiler
+cache, so no Supabase read and no recompilation happens on the request
+path. A background task then revalidates every cached campaign against
+iap_campaigns in batched reads. It compiles changed flows ahead of use,
+drops deleted campaigns, and rewrites the snapshot atomically for the next
+worker.
+
+CampaignCache wraps the state backend. It passes everything except
+get_campaign through, so it can be handed to process_message as `store`.
+
+Usage:
+    python campaign_cache.py --write   # bake a snapshot of all campaigns, e.g. at deploy
+"""
+import os
+import sys
+import mmap
+import json
+import time
+import struct
+import asyncio
+import argparse
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+
+from flow_compiler import (FLOW_ARTIFACT_DIR, FLOW_ARTIFACT_VERSION, get_compiled_flow, log_event,
+                           prepare_artifact, remember_flow, source_hash)
+from flow_model import Flow
+from log_config import configure_logging
+
+SNAPSHOT_MAGIC = b"FLOWSNAP"
+SNAPSHOT_VERSION = 1
+_HEADER = struct.Struct("<8sIIQ")
+CAMPAIGN_SNAPSHOT = os.getenv("CAMPAIGN_SNAPSHOT", os.path.join(FLOW_ARTIFACT_DIR, "campaigns.snapshot"))
+CAMPAIGN_REVALIDATE_SECONDS = float(os.getenv("CAMPAIGN_REVALIDATE_SECONDS", "60"))
+REVALIDATE_BATCH = 100  # campaign ids per `in.(...)` filter
+
+class CampaignSnapshot:
+    """Read-only view of a snapshot file; records are decoded on demand."""
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, artifact_version, index_length = _HEADER.unpack_from(self._map, 0)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or artifact_version != FLOW_ARTIFACT_VERSION:
+                raise ValueError(f"snapshot incompatível: {path}")
+            self.index: Dict[str, list] = json.loads(self._map[_HEADER.size:_HEADER.size + index_length])
+        except Exception:
+            self._file.close()
+            raise
+
+    def __contains__(self, campaign_id: str) -> bool:
+        return campaign_id in self.index
+
+    def load(self, campaign_id: str) -> Tuple[Dict, Flow, float]:
+        """Returns (campaign row, prepared flow, fetched_at) of one campaign."""
+        offset, length, fetched_at = self.index[campaign_id]
+        record = json.loads(self._map[offset:offset + length])
+        return record["campaign"], prepare_artifact(record["flow"]), fetched_at
+
+    def close(self) -> None:
+        self._map.close()
+        self._file.close()
+
+def write_snapshot(path: str, entries: List[Tuple[Dict, Flow, float]]) -> int:
+    """Writes (campaign row, flow, fetched_at) entries atomically; returns the file size."""
+    records, index = [], {}
+    position = 0
+    for campaign, flow, fetched_at in entries:
+        data = json.dumps({"campaign": campaign, "flow": flow.to_artifact()}, ensure_ascii=False,
+                          separators=(",", ":")).encode("utf-8")
+        index[campaign["campaign_id"]] = [position, len(data), fetched_at]
+        records.append(data)
+        position += len(data)
+    # Offsets are relative to the records until the index length is known
+    base = 0
+    while True:
+        shifted = {cid: [pos + base, length, ts] for cid, (pos, length, ts) in index.items()}
+        index_data = json.dumps(shifted, separators=(",", ":")).encode("utf-8")
+        if _HEADER.size + len(index_data) == base:
+            break
+        base = _HEADER.size + len(index_data)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, FLOW_ARTIFACT_VERSION, len(index_data)))
+        f.write(index_data)
+        for data in records:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return base + position
+
+def fetch_campaigns(campaign_ids: List[str]) -> Dict[str, Dict]:
+    """Reads many campaign rows with one request per REVALIDATE_BATCH ids."""
+    from supabase_client import select_rows
+
+    rows = {}
+    for start in range(0, len(campaign_ids), REVALIDATE_BATCH):
+        chunk = campaign_ids[start:start + REVALIDATE_BATCH]
+        quoted = ",".join('"' + cid.replace('"', '\\"') + '"' for cid in chunk)
+        for row in select_rows("iap_campaigns", {"select": "*", "campaign_id": f"in.({quoted})"}):
+            rows[row["campaign_id"]] = row
+    return rows
+
+class CampaignCache:
+    """Campaign rows served from memory, a snapshot, then Supabase."""
+    def __init__(self, backend: Any = None, snapshot_path: Optional[str] = CAMPAIGN_SNAPSHOT):
+        if backend is None:
+            import supabase_client as backend
+        self.backend = backend
+        self.snapshot_path = snapshot_path
+        self.snapshot: Optional[CampaignSnapshot] = None
+        self.entries: Dict[str, Tuple[Dict, float]] = {}  # campaign_id -> (row, fetched_at)
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        # State functions (get_user_state, save_user_state, ...) go straight to the backend
+        return getattr(self.backend, name)
+
+    def open_snapshot(self) -> int:
+        """Maps the snapshot if there is a usable one; returns how many campaigns it holds."""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return 0
+        try:
+            self.snapshot = CampaignSnapshot(self.snapshot_path)
+        except (OSError, ValueError) as e:
+            log_event("Snapshot de campanhas ignorado", {"path": self.snapshot_path, "error": str(e)})
+            return 0
+        return len(self.snapshot.index)
+
+    def get_campaign(self, campaign_id: str) -> Optional[Dict]:
+        entry = self.entries.get(campaign_id)
+        if entry is not None:
+            return entry[0]
+        with self._lock:
+            entry = self.entries.get(campaign_id)
+            if entry is None and self.snapshot is not None and campaign_id in self.snapshot:
+                campaign, flow, fetched_at = self.snapshot.load(campaign_id)
+                if flow.source_hash == source_hash(campaign):
+                    remember_flow(flow)
+                entry = self.entries[campaign_id] = (campaign, fetched_at)
+        if entry is not None:
+            return entry[0]
+        campaign = self.backend.get_campaign(campaign_id)
+        if campaign:
+            with self._lock:
+                self.entries[campaign_id] = (campaign, time.time())
+                self.dirty = True
+        return campaign
+
+    def invalidate(self, campaign_id: str) -> bool:
+        """Forgets a campaign so the next request reads it from the backend; returns whether it was cached."""
+        with self._lock:
+            cached = self.entries.pop(campaign_id, None) is not None
+            if self.snapshot is not None and self.snapshot.index.pop(campaign_id, None) is not None:
+                cached = True
+            self.dirty = self.dirty or cached
+        return cached
+
+    def revalidate(self, max_age: float = 0) -> Dict[str, int]:
+        """Refreshes campaigns fetched more than `max_age` seconds ago, snapshot ones included."""
+        now = time.time()
+        with self._lock:
+            ages = {cid: fetched_at for cid, (_, fetched_at) in self.entries.items()}
+            if self.snapshot is not None:
+                for cid, (_, _, fetched_at) in self.snapshot.index.items():
+                    ages.setdefault(cid, fetched_at)
+        stale = [cid for cid, fetched_at in ages.items() if now - fetched_at >= max_age]
+        if not stale:
+            return {"checked": 0, "changed": 0, "removed": 0}
+        rows = fetch_campaigns(stale)
+        changed = removed = 0
+        for cid in stale:
+            row = rows.get(cid)
+            if row is None:
+                with self._lock:
+                    self.entries.pop(cid, None)
+                    if self.snapshot is not None:
+                        self.snapshot.index.pop(cid, None)
+                removed += 1
+                continue
+            current = self.entries.get(cid)
+            previous = current[0] if current else None
+            if previous is None and self.snapshot is not None and cid in self.snapshot:
+                previous = self.snapshot.load(cid)[0]
+            if previous is None or source_hash(previous) != source_hash(row):
+                changed += 1
+                # Compile now so the next request finds the new flow ready
+                get_compiled_flow(row)
+            with self._lock:
+                self.entries[cid] = (row, now)
+        with self._lock:
+            self.dirty = self.dirty or bool(changed or removed) or self.snapshot is None
+        return {"checked": len(stale), "changed": changed, "removed": removed}
+
+    def save_snapshot(self) -> Optional[int]:
+        """Rewrites the snapshot with every cached campaign if anything changed."""
+        if not self.snapshot_path or not self.dirty:
+            return None
+        with self._lock:
+            campaigns = list(self.entries.values())
+            self.dirty = False
+        entries = [(campaign, get_compiled_flow(campaign), fetched_at) for campaign, fetched_at in campaigns]
+        return write_snapshot(self.snapshot_path, entries)
+
+    async def run(self, stop: asyncio.Event, interval: float = CAMPAIGN_REVALIDATE_SECONDS) -> None:
+        """Revalidates and re-snapshots in the background until `stop` is set."""
+        max_age = 0.0  # everything from the snapshot is checked once right away
+        while not stop.is_set():
+            try:
+                result = await asyncio.to_thread(self.revalidate, max_age)
+                if result["changed"] or result["removed"]:
+                    log_event("Campanhas revalidadas", result)
+                await asyncio.to_thread(self.save_snapshot)
+            except Exception as e:
+                log_event("Erro ao revalidar campanhas", {"error": str(e)})
+            max_age = interval
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Write a warm-start snapshot of all campaigns.")
+    parser.add_argument("--write", action="store_true", help="fetch every campaign and write the snapshot")
+    parser.add_argument("--path", default=CAMPAIGN_SNAPSHOT, help=f"snapshot file (default: {CAMPAIGN_SNAPSHOT})")
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args(argv)
+    configure_logging("supabase.log")
+    if not args.write:
+        snapshot = CampaignSnapshot(args.path)
+        print(f"{args.path}: {len(snapshot.index)} campanhas", file=sys.stderr)
+        return 0
+
+    from supabase_client import iter_pages
+    entries = []
+    now = time.time()
+    for page in iter_pages("iap_campaigns", key="campaign_id", page_size=args.page_size):
+        for campaign in page:
+            entries.append((campaign, get_compiled_flow(campaign), now))
+    size = write_snapshot(args.path, entries)
+    print(f"{len(entries)} campanhas -> {args.path} ({size} bytes)", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
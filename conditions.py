@@ -0,0 +1,360 @@
+"""Branching conditions: legacy answer texts and a small expression language.
+
+A question's `condition` used to be an answer text only. The question was
+asked when the answer just given matched that text. Such conditions keep
+working unchanged. A condition is an expression only when it parses as one,
+and a bare text never does, since every term must compare something:
+
+    q2 == 'Sim' and q5 in ['Saúde', 'Educação']
+    answer != 'Não' or not answered(q3)
+    answer('7') >= 18
+
+Names are question ids. `answer` alone is the answer just given, and
+`answer('id')` reaches ids that are not names, such as numeric ids. Strings
+compare like legacy conditions: normalized and case-insensitive. `<`, `<=`,
+`>` and `>=` compare numbers. A comparison with a question that was not
+answered, or that is not a number for `<` and the like, is false.
+
+Each flow compiles its conditions once (Flow.conditions()) into closures
+over a list of answer keys, one slot per referenced question. Checking a
+condition then costs a list index and a comparison, with no parsing or
+normalization.
+"""
+import re
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from text_utils import normalize_text
+
+CURRENT = 0  # slot of the answer just given
+
+_TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+      | (?P<number>-?\d+(?:\.\d+)?)
+      | (?P<op>==|!=|<=|>=|<|>|\(|\)|\[|\]|,)
+      | (?P<name>[^\W\d][\w.-]*)
+    )""", re.VERBOSE)
+_KEYWORDS = {"and", "or", "not", "in", "answered", "answer"}
+_COMPARISONS = {"==", "!=", "<", "<=", ">", ">="}
+
+class ConditionError(ValueError):
+    pass
+
+@lru_cache(maxsize=65536)
+def answer_key(value: Any) -> str:
+    """An answer or literal as conditions compare it."""
+    return normalize_text(value if isinstance(value, str) else str(value)).lower()
+
+def _tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if not match:
+            raise ConditionError(f"unexpected character at {position}: {text[position:position + 10]!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value in _KEYWORDS:
+            kind = "keyword"
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+class _Parser:
+    """Recursive descent over the tokens; produces nested tuples."""
+    def __init__(self, text: str):
+        self.tokens = _tokenize(text)
+        self.position = 0
+
+    def peek(self, offset: int = 0) -> Tuple[Optional[str], Optional[str]]:
+        i = self.position + offset
+        return self.tokens[i] if i < len(self.tokens) else (None, None)
+
+    def take(self, kind: Optional[str] = None, value: Optional[str] = None) -> str:
+        token_kind, token_value = self.peek()
+        if token_kind is None or (kind and token_kind != kind) or (value and token_value != value):
+            raise ConditionError(f"expected {value or kind}, found {token_value or 'end'}")
+        self.position += 1
+        return token_value
+
+    def accept(self, kind: str, value: str) -> bool:
+        if self.peek() == (kind, value):
+            self.position += 1
+            return True
+        return False
+
+    def parse(self) -> tuple:
+        if not self.tokens:
+            raise ConditionError("empty condition")
+        node = self.parse_or()
+        if self.position != len(self.tokens):
+            raise ConditionError(f"unexpected {self.peek()[1]}")
+        return node
+
+    def parse_or(self) -> tuple:
+        terms = [self.parse_and()]
+        while self.accept("keyword", "or"):
+            terms.append(self.parse_and())
+        return terms[0] if len(terms) == 1 else ("or", tuple(terms))
+
+    def parse_and(self) -> tuple:
+        terms = [self.parse_not()]
+        while self.accept("keyword", "and"):
+            terms.append(self.parse_not())
+        return terms[0] if len(terms) == 1 else ("and", tuple(terms))
+
+    def parse_not(self) -> tuple:
+        if self.peek() == ("keyword", "not") and self.peek(1) != ("keyword", "in"):
+            self.position += 1
+            return ("not", self.parse_not())
+        return self.parse_term()
+
+    def parse_term(self) -> tuple:
+        if self.accept("op", "("):
+            node = self.parse_or()
+            self.take("op", ")")
+            return node
+        if self.accept("keyword", "answered"):
+            self.take("op", "(")
+            ref = self.parse_ref()
+            self.take("op", ")")
+            return ("answered", ref)
+        left = self.parse_operand()
+        kind, value = self.peek()
+        if kind == "op" and value in _COMPARISONS:
+            self.position += 1
+            return ("compare", value, left, self.parse_operand())
+        if self.accept("keyword", "in"):
+            return ("in", left, self.parse_list())
+        if self.accept("keyword", "not"):
+            self.take("keyword", "in")
+            return ("not", ("in", left, self.parse_list()))
+        raise ConditionError(f"expected a comparison after {left[1]!r}")
+
+    def parse_ref(self) -> tuple:
+        kind, value = self.peek()
+        if kind == "name":
+            self.position += 1
+            return ("ref", value)
+        if (kind, value) != ("keyword", "answer"):
+            raise ConditionError(f"expected a question or a value, found {value or 'end'}")
+        self.position += 1
+        if self.accept("op", "("):
+            kind, value = self.peek()
+            if kind not in ("string", "number"):
+                raise ConditionError("answer() takes a question id")
+            self.position += 1
+            self.take("op", ")")
+            return ("ref", _unquote(value) if kind == "string" else value)
+        return ("ref", None)
+
+    def parse_operand(self) -> tuple:
+        kind, value = self.peek()
+        if kind in ("string", "number"):
+            self.position += 1
+            return ("literal", _unquote(value) if kind == "string" else value)
+        return self.parse_ref()
+
+    def parse_list(self) -> tuple:
+        self.take("op", "[")
+        items = []
+        while not self.accept("op", "]"):
+            kind, value = self.peek()
+            if kind not in ("string", "number"):
+                raise ConditionError("lists hold strings and numbers only")
+            self.position += 1
+            items.append(_unquote(value) if kind == "string" else value)
+            if not self.accept("op", ","):
+                self.take("op", "]")
+                break
+        return tuple(items)
+
+def _unquote(token: str) -> str:
+    return re.sub(r"\\(.)", r"\1", token[1:-1])
+
+@lru_cache(maxsize=4096)
+def parse(text: str) -> tuple:
+    """The syntax tree of an expression; raises ConditionError for anything else."""
+    return _Parser(text).parse()
+
+def is_expression(condition: Optional[str]) -> bool:
+    if not condition:
+        return False
+    try:
+        parse(condition)
+    except ConditionError:
+        return False
+    return True
+
+def references(node: tuple) -> List[str]:
+    """Question ids an expression reads, in order, without the current answer."""
+    found = []
+
+    def walk(node):
+        if node[0] == "ref":
+            if node[1] is not None and node[1] not in found:
+                found.append(node[1])
+        elif node[0] in ("and", "or"):
+            for term in node[1]:
+                walk(term)
+        elif node[0] in ("not", "answered"):
+            walk(node[1])
+        elif node[0] == "compare":
+            walk(node[2])
+            walk(node[3])
+        elif node[0] == "in":
+            walk(node[1])
+
+    walk(node)
+    return found
+
+def _number(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value.replace(",", "."))
+    except (AttributeError, ValueError):
+        return None
+
+_ORDER = {
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+def compile_expression(node: tuple, slot_of: Callable[[Optional[str]], int]) -> Callable[[Sequence], bool]:
+    """Turns a syntax tree into a predicate over a list of answer keys (None when unanswered)."""
+    kind = node[0]
+    if kind == "answered":
+        slot = slot_of(node[1][1])
+        return lambda values: values[slot] is not None
+    if kind == "not":
+        inner = compile_expression(node[1], slot_of)
+        return lambda values: not inner(values)
+    if kind in ("and", "or"):
+        terms = [compile_expression(term, slot_of) for term in node[1]]
+        # Folded into nested pairs, which beats all()/any() over a generator
+        predicate = terms[-1]
+        for term in reversed(terms[:-1]):
+            predicate = _both(term, predicate) if kind == "and" else _either(term, predicate)
+        return predicate
+    if kind == "in":
+        options = frozenset(answer_key(item) for item in node[2])
+        if node[1][0] == "literal":
+            result = answer_key(node[1][1]) in options
+            return lambda values: result
+        slot = slot_of(node[1][1])
+        return lambda values: values[slot] in options
+    op, left, right = node[1], node[2], node[3]
+    if left[0] == "literal" and right[0] == "ref":
+        left, right = right, left
+        op = {"<": ">", "<=": ">=", ">": "<", ">=": "<="}.get(op, op)
+    if left[0] == "literal":
+        result = _constant(op, left[1], right[1])
+        return lambda values: result
+    slot = slot_of(left[1])
+    if right[0] == "literal":
+        if op in ("==", "!="):
+            key = answer_key(right[1])
+            if op == "==":
+                return lambda values: values[slot] == key
+            return lambda values: values[slot] is not None and values[slot] != key
+        bound = _number(answer_key(right[1]))
+        compare = _ORDER[op]
+        if bound is None:
+            return lambda values: False
+
+        def against_literal(values):
+            number = _number(values[slot])
+            return number is not None and compare(number, bound)
+        return against_literal
+    other = slot_of(right[1])
+    if op in ("==", "!="):
+        equal = op == "=="
+        return lambda values: (values[slot] is not None and values[other] is not None
+                               and (values[slot] == values[other]) == equal)
+    compare = _ORDER[op]
+
+    def between_answers(values):
+        a, b = _number(values[slot]), _number(values[other])
+        return a is not None and b is not None and compare(a, b)
+    return between_answers
+
+def _both(first: Callable, second: Callable) -> Callable[[Sequence], bool]:
+    return lambda values: first(values) and second(values)
+
+def _either(first: Callable, second: Callable) -> Callable[[Sequence], bool]:
+    return lambda values: first(values) or second(values)
+
+def _constant(op: str, left: str, right: str) -> bool:
+    a, b = answer_key(left), answer_key(right)
+    if op in ("==", "!="):
+        return (a == b) == (op == "==")
+    a, b = _number(a), _number(b)
+    return a is not None and b is not None and _ORDER[op](a, b)
+
+class FlowConditions:
+    """The conditions of one flow, compiled for _get_next_question.
+
+    Legacy conditions are looked up by answer key, expressions are evaluated
+    in flow order, and the next question without a condition is precomputed
+    for every position.
+    """
+    __slots__ = ("slots", "_by_key", "_expressions", "_expression_positions", "_next_plain")
+
+    def __init__(self, questions: Sequence[Any]):
+        self.slots: Dict[str, int] = {}
+        self._by_key: Dict[str, List[int]] = {}
+        self._expressions: List[Tuple[int, Callable[[Sequence], bool]]] = []
+        next_plain = [-1] * (len(questions) + 1)
+        for i in range(len(questions) - 1, -1, -1):
+            next_plain[i] = next_plain[i + 1] if questions[i].condition else i
+        self._next_plain = next_plain
+        for i, q in enumerate(questions):
+            if not q.condition:
+                continue
+            if q.condition_key is not None:
+                self._by_key.setdefault(q.condition_key, []).append(i)
+            else:
+                self._expressions.append((i, compile_expression(parse(q.condition), self._slot)))
+        self._expression_positions = [i for i, _ in self._expressions]
+
+    def _slot(self, question_id: Optional[str]) -> int:
+        if question_id is None:
+            return CURRENT
+        return self.slots.setdefault(question_id, len(self.slots) + 1)
+
+    def values(self, answers: Dict, selected_key: str) -> List[Optional[str]]:
+        """Answer keys in slot order; the answer just given goes first."""
+        values = [selected_key]
+        for question_id in self.slots:
+            answer = answers.get(question_id)
+            values.append(answer_key(answer) if answer is not None and answer != "" else None)
+        return values
+
+    def first_match(self, after: int, answers: Dict, selected_key: str) -> Optional[int]:
+        """Position of the first question after `after` whose condition holds."""
+        best = None
+        positions = self._by_key.get(selected_key)
+        if positions:
+            found = bisect_right(positions, after)
+            if found < len(positions):
+                best = positions[found]
+        start = bisect_right(self._expression_positions, after)
+        if start < len(self._expressions):
+            values = None
+            for position, predicate in self._expressions[start:]:
+                if best is not None and position > best:
+                    break
+                if values is None:
+                    values = self.values(answers, selected_key)
+                if predicate(values):
+                    return position
+        return best
+
+    def next_plain(self, after: int) -> Optional[int]:
+        """Position of the first question after `after` without a condition."""
+        position = self._next_plain[after + 1]
+        return position if position >= 0 else None
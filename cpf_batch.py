@@ -0,0 +1,142 @@
+import re
+import csv
+import sys
+import time
+import argparse
+from typing import Any, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from text_utils import normalize_text
+
+# Rows per vectorized block; bounds the width of the code-point matrix when a
+# column contains a few very long garbage values.
+DEFAULT_CHUNK_SIZE = 65536
+
+_NON_DIGITS = re.compile(r'[^0-9]')
+_D1_WEIGHTS = np.arange(10, 1, -1, dtype=np.int64)
+_D2_WEIGHTS = np.arange(11, 1, -1, dtype=np.int64)
+
+def _slow_clean(value: Any) -> str:
+    """Cleans a value exactly like is_valid_cpf does, for inputs the fast path cannot handle."""
+    try:
+        if isinstance(value, str):
+            return _NON_DIGITS.sub('', normalize_text(value))
+        # normalize_text only stringifies non-string inputs, so no unescaping here
+        return _NON_DIGITS.sub('', str(value) if value else "")
+    except Exception:
+        return ""
+
+def _codepoints(values: List[str]) -> np.ndarray:
+    """Returns an (n, width) uint32 matrix of code points, zero padded."""
+    arr = np.asarray(values, dtype=np.str_)
+    width = arr.dtype.itemsize // 4
+    if width == 0:
+        return np.zeros((len(values), 0), dtype=np.uint32)
+    return arr.view(np.uint32).reshape(len(values), width)
+
+def _validate_block(values: List[Any]) -> Tuple[np.ndarray, np.ndarray]:
+    n = len(values)
+    if set(map(type, values)) <= {str}:
+        strs = list(values)
+    else:
+        strs = [v if isinstance(v, str) else _slow_clean(v) for v in values]
+    codes = _codepoints(strs)
+
+    # Non-ASCII text and HTML entities change meaning under normalize_text
+    # (fullwidth digits, "&#49;", ...); clean those rows one by one.
+    slow = np.flatnonzero(((codes > 127) | (codes == 38)).any(axis=1))
+    if slow.size:
+        for i in slow:
+            strs[i] = _slow_clean(strs[i])
+        codes = _codepoints(strs)
+
+    is_digit = (codes >= 48) & (codes <= 57)
+    candidate = is_digit.sum(axis=1) == 11
+    valid = np.zeros(n, dtype=bool)
+    canonical = np.full(n, "", dtype="<U11")
+    if not candidate.any():
+        return valid, canonical
+
+    # Row-major boolean selection keeps digit order, and every candidate row
+    # holds exactly 11 digits, so the result reshapes into a digit matrix.
+    digits = (codes[candidate][is_digit[candidate]].reshape(-1, 11) - 48).astype(np.int64)
+    repeated = (digits == digits[:, :1]).all(axis=1)
+    d1 = (digits[:, :9] @ _D1_WEIGHTS * 10) % 11
+    d1[d1 >= 10] = 0
+    d2 = (digits[:, :10] @ _D2_WEIGHTS * 10) % 11
+    d2[d2 >= 10] = 0
+    ok = ~repeated & (digits[:, 9] == d1) & (digits[:, 10] == d2)
+
+    rows = np.flatnonzero(candidate)
+    valid[rows[ok]] = True
+    canonical[rows[ok]] = (digits[ok] + 48).astype(np.uint8).view("S11").ravel().astype("<U11")
+    return valid, canonical
+
+def validate_cpfs(values: Iterable[Any], chunk_size: int = DEFAULT_CHUNK_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    """Validates a column of CPFs.
+
+    Returns (valid, canonical): a boolean array matching is_valid_cpf for each
+    value and the 11-digit canonical form of each valid CPF ("" when invalid).
+    """
+    values = list(values)
+    valid_parts, canonical_parts = [], []
+    for start in range(0, len(values), chunk_size):
+        valid, canonical = _validate_block(values[start:start + chunk_size])
+        valid_parts.append(valid)
+        canonical_parts.append(canonical)
+    if not valid_parts:
+        return np.zeros(0, dtype=bool), np.zeros(0, dtype="<U11")
+    return np.concatenate(valid_parts), np.concatenate(canonical_parts)
+
+def _read_chunks(reader: Iterator[dict], chunk_size: int) -> Iterator[List[dict]]:
+    chunk = []
+    for row in reader:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Validate and normalize a CSV column of CPFs.")
+    parser.add_argument("input", nargs="?", help="CSV file (default: stdin)")
+    parser.add_argument("-o", "--output", help="output CSV file (default: stdout)")
+    parser.add_argument("-c", "--column", default="cpf", help="column holding the CPFs (default: cpf)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--only-invalid", action="store_true", help="write only rows with invalid CPFs")
+    args = parser.parse_args(argv)
+
+    src = open(args.input, newline="", encoding="utf-8") if args.input else sys.stdin
+    dst = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    started = time.perf_counter()
+    total = valid_total = 0
+    try:
+        reader = csv.DictReader(src)
+        if not reader.fieldnames or args.column not in reader.fieldnames:
+            print(f"Coluna '{args.column}' não encontrada no CSV", file=sys.stderr)
+            return 2
+        writer = csv.DictWriter(dst, fieldnames=list(reader.fieldnames) + ["cpf_valid", "cpf_normalized"])
+        writer.writeheader()
+        for rows in _read_chunks(reader, args.chunk_size):
+            valid, canonical = _validate_block([row[args.column] for row in rows])
+            total += len(rows)
+            valid_total += int(valid.sum())
+            for row, ok, cpf in zip(rows, valid.tolist(), canonical.tolist()):
+                if args.only_invalid and ok:
+                    continue
+                row["cpf_valid"] = "true" if ok else "false"
+                row["cpf_normalized"] = cpf
+                writer.writerow(row)
+    finally:
+        if args.input:
+            src.close()
+        if args.output:
+            dst.close()
+    elapsed = time.perf_counter() - started
+    print(f"{total} CPFs, {valid_total} válidos, {total - valid_total} inválidos em {elapsed:.2f}s", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,218 @@
+"""Idempotency for redelivered WhatsApp messages, keyed by message id.
+
+Meta redelivers a webhook event when the ack is slow, and webhook.php
+forwards each delivery to /process (or /enqueue) with the message's id.
+Before the engine runs, main.py claims the id here:
+
+- New id: the claim is recorded as pending, the message is processed, and
+  the response is stored under the id (finish). When the engine did not
+  handle it (throttled, engine busy, backend unavailable, an error) the
+  claim is dropped (abandon), so the next delivery gets a real attempt.
+- Known id: the stored response comes back right away, marked
+  "duplicate", with no backend request. While the first delivery is still
+  being processed, a duplicate gets DUPLICATE_RESPONSE (no next_message);
+  the first delivery is the one that replies.
+
+Seen ids live in memory in DEDUP_BUCKETS time buckets spanning
+DEDUP_WINDOW_SECONDS. Expired buckets are dropped whole, and the oldest
+buckets go early once DEDUP_MAX_ENTRIES is reached, so memory stays
+bounded. With DEDUP_PATH set, ids are also written to an SQLite file
+shared by every worker on the host. That catches duplicates landing on
+another worker and ones older than what memory holds, and survives
+restarts. A pending claim older than DEDUP_CLAIM_SECONDS belongs to a
+worker that died, and may be taken over.
+"""
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+DEDUP_WINDOW_SECONDS = float(os.getenv("DEDUP_WINDOW_SECONDS", "86400"))
+DEDUP_BUCKETS = int(os.getenv("DEDUP_BUCKETS", "24"))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "200000"))
+DEDUP_CLAIM_SECONDS = float(os.getenv("DEDUP_CLAIM_SECONDS", "60"))
+DEDUP_PATH = os.getenv("DEDUP_PATH", "")
+
+DUPLICATE_RESPONSE = {"duplicate": True}
+
+SCHEMA = """
+create table if not exists seen_messages (
+    message_id text primary key,
+    response text,
+    claimed_at real not null
+);
+create index if not exists seen_messages_claimed on seen_messages (claimed_at);
+"""
+
+def log_event(message: str, data: Dict = {}):
+    log_entry = {'message': message, 'data': data}
+    logging.info(json.dumps(log_entry, ensure_ascii=False))
+
+# Entry: (response or None while pending, claimed_at)
+Entry = Tuple[Optional[Dict[str, Any]], float]
+
+class Deduplicator:
+    """Time-bucketed seen-set of message ids with their responses."""
+    def __init__(self, window: float = DEDUP_WINDOW_SECONDS, buckets: int = DEDUP_BUCKETS,
+                 max_entries: int = DEDUP_MAX_ENTRIES, path: str = DEDUP_PATH,
+                 claim_seconds: float = DEDUP_CLAIM_SECONDS):
+        self.window = window
+        self.bucket_seconds = window / max(1, buckets)
+        self.max_entries = max_entries
+        self.claim_seconds = claim_seconds
+        self.path = path
+        self.buckets: Deque[Tuple[int, Dict[str, Entry]]] = deque()  # oldest first
+        self.size = 0
+        self.stats = {"claimed": 0, "duplicates": 0, "in_flight": 0, "abandoned": 0, "dropped": 0}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._purged_bucket = None
+        if path:
+            self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("pragma journal_mode=wal")
+            db.execute("pragma synchronous=normal")  # a lost id only lets one duplicate through
+            self._local.db = db
+        return db
+
+    def _find(self, message_id: str) -> Optional[Dict[str, Entry]]:
+        """The bucket holding `message_id`, newest first."""
+        for _, entries in reversed(self.buckets):
+            if message_id in entries:
+                return entries
+        return None
+
+    def _expire(self, now: float) -> None:
+        oldest = int((now - self.window) // self.bucket_seconds)
+        while self.buckets and self.buckets[0][0] <= oldest:
+            self.size -= len(self.buckets.popleft()[1])
+        while self.size > self.max_entries:
+            # Over the memory bound: forget the oldest ids before they expire
+            dropped = len(self.buckets.popleft()[1])
+            self.size -= dropped
+            self.stats["dropped"] += dropped
+
+    def _put(self, message_id: str, entry: Entry, now: float) -> None:
+        current = int(now // self.bucket_seconds)
+        if not self.buckets or self.buckets[-1][0] != current:
+            self.buckets.append((current, {}))
+        self.buckets[-1][1][message_id] = entry
+        self.size += 1
+        self._expire(now)
+
+    def _answer(self, entry: Entry) -> Dict[str, Any]:
+        response = entry[0]
+        if response is None:
+            self.stats["in_flight"] += 1
+            return DUPLICATE_RESPONSE
+        self.stats["duplicates"] += 1
+        return dict(response, duplicate=True)
+
+    def seen(self, message_id: str) -> Optional[Dict[str, Any]]:
+        """The answer for a known id from memory only, else None. No I/O."""
+        with self._lock:
+            entries = self._find(message_id)
+            if entries is None:
+                return None
+            entry = entries[message_id]
+            if entry[0] is None and time.time() - entry[1] >= self.claim_seconds:
+                return None
+            return self._answer(entry)
+
+    def claim(self, message_id: str) -> Optional[Dict[str, Any]]:
+        """None if this delivery should be processed (call finish or abandon
+        afterwards); otherwise the response to return for the duplicate."""
+        now = time.time()
+        with self._lock:
+            entries = self._find(message_id)
+            if entries is not None:
+                entry = entries[message_id]
+                if entry[0] is not None or now - entry[1] < self.claim_seconds:
+                    return self._answer(entry)
+                del entries[message_id]
+                self.size -= 1
+            if not self.path:
+                self._put(message_id, (None, now), now)
+                self.stats["claimed"] += 1
+                return None
+        claimed, stored = self._claim_stored(message_id, now)
+        with self._lock:
+            if not claimed:
+                if stored is None:
+                    # Still being processed by another worker
+                    self.stats["in_flight"] += 1
+                    return DUPLICATE_RESPONSE
+                self._put(message_id, (stored, now), now)
+                return self._answer((stored, now))
+            self._put(message_id, (None, now), now)
+            self.stats["claimed"] += 1
+        return None
+
+    def _claim_stored(self, message_id: str, now: float) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """Claims the id in SQLite: (True, None) once claimed, else (False, stored response or None)."""
+        db = self._connection()
+        self._purge(db, now)
+        if db.execute("insert or ignore into seen_messages (message_id, claimed_at) values (?, ?)",
+                      (message_id, now)).rowcount:
+            return True, None
+        row = db.execute("select response, claimed_at from seen_messages where message_id = ?",
+                         (message_id,)).fetchone()
+        if row is None:
+            return self._claim_stored(message_id, now)  # purged in between
+        response, claimed_at = row
+        if response is not None:
+            return False, json.loads(response)
+        if now - claimed_at >= self.claim_seconds and db.execute(
+                "update seen_messages set claimed_at = ? where message_id = ? and claimed_at = ? and response is null",
+                (now, message_id, claimed_at)).rowcount:
+            log_event("Mensagem retomada de um processamento interrompido", {"message_id": message_id})
+            return True, None
+        return False, None
+
+    def _purge(self, db: sqlite3.Connection, now: float) -> None:
+        # Once per bucket is enough; ids only need to outlive the window
+        bucket = int(now // self.bucket_seconds)
+        if bucket != self._purged_bucket:
+            self._purged_bucket = bucket
+            db.execute("delete from seen_messages where claimed_at < ?", (now - self.window,))
+
+    def finish(self, message_id: str, response: Dict[str, Any]) -> None:
+        """Stores the response of a claimed id for later duplicates."""
+        now = time.time()
+        with self._lock:
+            entries = self._find(message_id)
+            if entries is not None:
+                entries[message_id] = (response, entries[message_id][1])
+            else:
+                self._put(message_id, (response, now), now)
+        if self.path:
+            self._connection().execute(
+                "update seen_messages set response = ? where message_id = ?",
+                (json.dumps(response, ensure_ascii=False), message_id)
+            )
+
+    def abandon(self, message_id: str) -> None:
+        """Drops a claim whose message was not processed, so a redelivery is."""
+        with self._lock:
+            entries = self._find(message_id)
+            if entries is not None and entries[message_id][0] is None:
+                del entries[message_id]
+                self.size -= 1
+            self.stats["abandoned"] += 1
+        if self.path:
+            self._connection().execute(
+                "delete from seen_messages where message_id = ? and response is null", (message_id,)
+            )
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.stats, entries=self.size, buckets=len(self.buckets),
+                        persistent=bool(self.path))
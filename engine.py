@@ -1,69 +1,47 @@
 import asyncio
 import json
 import re
-import html
-import unicodedata
 import traceback
 import logging
-from typing import Dict, Any, Union, Optional
-from supabase_client import get_campaign, get_user_state, save_user_state, get_campaign_by_code
+import os
+from typing import Dict, Any, List, Tuple, Union, Optional
+import supabase_client
+from text_utils import normalize_text, is_valid_cpf
+from flow_compiler import get_compiled_flow, safe_json_load
+from flow_model import Flow, Question, QUICK_REPLY
+from state_codec import answers_for_storage
+from tallies import tally_counter
+from resilience import BackendUnavailable
+import tracing
+
+# "upsert" saves the full state on every step; "delta" sends only the new
+# answer through the atomic whatsapp_step_user_state RPC
+STATE_WRITE_MODE = os.getenv("STATE_WRITE_MODE", "upsert").lower()
+
+# The state could not be read or written for lack of a backend; nothing was changed
+UNAVAILABLE_RESPONSE = {
+    "next_message": "⚠️ Estamos com instabilidade no momento. Por favor, envie sua resposta novamente em alguns instantes.",
+    "retry": True
+}
 
 # Contador simulado em memória (temporário)
 petition_counts = {}
 
-# Logging configuration
-logging.basicConfig(
-    filename='/home/flow_engine/engine.log',
-    filemode='a',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    force=True,
-    encoding='utf-8'
-)
-
+# Handlers are set up by log_config.configure_logging(), not on import
 petition_logger = logging.getLogger('petition')
-petition_handler = logging.FileHandler(
-    '/home/flow_engine/petition.log',
-    encoding='utf-8'
-)
-petition_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-petition_logger.addHandler(petition_handler)
-petition_logger.setLevel(logging.INFO)
-
-def normalize_text(text: Any) -> str:
-    """Normalizes special characters and HTML entities, handling non-string inputs."""
-    if text is None:
-        return ""
-    if not isinstance(text, str):
-        logging.warning(f"Non-string input received in normalize_text: {type(text)} - {text}")
-        return str(text) if text else ""
-    text = html.unescape(text)
-    text = unicodedata.normalize('NFKD', text)
-    return text.encode('utf-8', 'ignore').decode('utf-8')
-
-def is_valid_cpf(cpf: str) -> bool:
-    """Validates a CPF with character cleaning."""
-    try:
-        cpf = re.sub(r'[^0-9]', '', normalize_text(cpf))
-        if len(cpf) != 11 or cpf == cpf[0] * 11:
-            return False
-        soma = sum(int(cpf[i]) * (10 - i) for i in range(9))
-        d1 = (soma * 10) % 11
-        d1 = d1 if d1 < 10 else 0
-        soma = sum(int(cpf[i]) * (11 - i) for i in range(10))
-        d2 = (soma * 10) % 11
-        d2 = d2 if d2 < 10 else 0
-        return cpf[-2:] == f"{d1}{d2}"
-    except Exception:
-        return False
 
 def log_event(message: str, data: Dict = {}, survey_type: str = "unknown"):
     """Logs an event with safe character handling."""
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        return
     safe_data = {
         k: normalize_text(v) if isinstance(v, str) else v
         for k, v in data.items()
     }
     safe_data['survey_type'] = survey_type
+    trace_id = tracing.trace_id()
+    if trace_id:
+        safe_data['trace_id'] = trace_id
     logging.info(json.dumps(
         {"message": normalize_text(message), "data": safe_data},
         ensure_ascii=False
@@ -82,57 +60,62 @@ def log_petition_event(message: str, data: Dict = {}):
 
 class SurveyProcessor:
     """Handles processing of different survey types."""
-    def __init__(self, campaign: Dict, phone: str, campaign_id: str):
+    def __init__(self, campaign: Dict, phone: str, campaign_id: str, store: Any = None,
+                 user_state: Optional[Dict] = None):
+        # The state backend: supabase_client, or anything with the same functions
+        self.store = store if store is not None else supabase_client
         self.campaign = campaign
         self.phone = normalize_text(phone)
         self.campaign_id = normalize_text(campaign_id)
+        self.flow = get_compiled_flow(self.campaign)
         self.survey_type = self._determine_survey_type()
         self.questions = self._load_questions()
-        self.user_state = get_user_state(self.phone, self.campaign_id)
+        if user_state is None:
+            with tracing.span("state.read"):
+                user_state = self.store.get_user_state(self.phone, self.campaign_id, self.flow)
+        self.user_state = user_state
+
+    @classmethod
+    def from_flow(cls, flow: Flow, phone: str = "", campaign_id: str = "") -> "SurveyProcessor":
+        """A processor over an already compiled flow, with no campaign row and no backend.
+
+        Only _step can be used on it; process() needs a store.
+        """
+        processor = cls.__new__(cls)
+        processor.store = None
+        processor.campaign = {"campaign_id": campaign_id}
+        processor.phone = normalize_text(phone)
+        processor.campaign_id = normalize_text(campaign_id)
+        processor.flow = flow
+        processor.survey_type = flow.survey_type
+        processor.questions = flow.questions
+        processor.user_state = {"current_step": None, "answers": {}}
+        return processor
 
     def _determine_survey_type(self) -> str:
-        """Determines the survey type based on campaign data."""
-        questions_json = self._safe_json_load(self.campaign.get("questions_json", {}))
-        flow_json = self._safe_json_load(self.campaign.get("flow_json", {}))
-        survey_type = questions_json.get("type", flow_json.get("type", "standard")).lower()
+        """Determines the survey type based on the compiled flow."""
+        survey_type = self.flow.survey_type
         log_event("Survey type determined", {"type": survey_type}, survey_type)
         return survey_type
 
     def _safe_json_load(self, data: Any) -> Dict:
         """Safely loads JSON data, handling strings and invalid JSON."""
-        if isinstance(data, str):
-            try:
-                return json.loads(normalize_text(data))
-            except json.JSONDecodeError:
-                return {}
-        return data or {}
-
-    def _load_questions(self) -> list:
-        """Loads and normalizes questions from campaign data."""
-        questions_json = self._safe_json_load(self.campaign.get("questions_json", {}))
-        flow_json = self._safe_json_load(self.campaign.get("flow_json", {}))
-        flow = questions_json if questions_json.get("questions") else flow_json
-        questions = []
-        for q in flow.get("questions", []):
-            safe_q = {
-                "id": normalize_text(str(q.get("id"))),
-                "text": normalize_text(q.get("text", "")),
-                "type": normalize_text(q.get("type", "text")),
-                "options": [
-                    {
-                        "text": opt.get("text", str(opt)) if isinstance(opt, dict) else normalize_text(opt),
-                        "action": opt.get("action") if isinstance(opt, dict) else None,
-                        "target": opt.get("target") if isinstance(opt, dict) else None
-                    } if isinstance(opt, dict) else {"text": normalize_text(opt)}
-                    for opt in q.get("options", [])
-                ],
-                "condition": normalize_text(q["condition"]) if "condition" in q else None,
-                "message": normalize_text(q.get("message", "")) if "message" in q else None
-            }
-            questions.append(safe_q)
+        return safe_json_load(data)
+
+    def _load_questions(self) -> Tuple[Question, ...]:
+        """Returns the normalized questions of the compiled flow."""
+        questions = self.flow.questions
         log_event("Questions loaded", {"question_count": len(questions)}, self.survey_type)
         return questions
 
+    def _find_question(self, question_id: Any) -> Optional[Question]:
+        """Looks up a question by id through the compiled flow index."""
+        return self.flow.find(question_id)
+
+    def _answers_for_log(self, answers: Dict) -> Dict:
+        """Answers in their stored form, so compact encoding also shrinks log lines."""
+        return answers_for_storage(answers, self.flow)
+
     def _validate_campaign(self) -> bool:
         """Validates the campaign structure."""
         if not self.campaign:
@@ -143,25 +126,25 @@ class SurveyProcessor:
             return False
         return True
 
-    def _format_options(self, question: Dict) -> Dict[str, Any]:
+    def _format_options(self, question: Question) -> Dict[str, Any]:
         """Formats question options for display, returning an interactive payload."""
-        options = question.get("options", [])
+        options = question.options
         if not options:
             return {"text": ""}
-        if question["type"] == "quick_reply" and len(options) <= 3:
+        if question.code == QUICK_REPLY and len(options) <= 3:
             buttons = [
                 {
                     "type": "reply",
                     "reply": {
                         "id": f"opt_{i}",
-                        "title": opt["text"][:20]  # WhatsApp limits button titles to 20 characters
+                        "title": opt.text[:20]  # WhatsApp limits button titles to 20 characters
                     }
                 } for i, opt in enumerate(options)
             ]
             return {
                 "interactive": {
                     "type": "button",
-                    "body": {"text": question["text"]},
+                    "body": {"text": question.text},
                     "action": {"buttons": buttons}
                 }
             }
@@ -170,7 +153,7 @@ class SurveyProcessor:
                 "rows": [
                     {
                         "id": f"opt_{i}",
-                        "title": opt["text"][:24],  # WhatsApp limits list item titles to 24 characters
+                        "title": opt.text[:24],  # WhatsApp limits list item titles to 24 characters
                         "description": ""
                     } for i, opt in enumerate(options)
                 ]
@@ -178,7 +161,7 @@ class SurveyProcessor:
             return {
                 "interactive": {
                     "type": "list",
-                    "body": {"text": question["text"]},
+                    "body": {"text": question.text},
                     "action": {
                         "button": "Escolha uma opção",
                         "sections": sections
@@ -186,33 +169,35 @@ class SurveyProcessor:
                 }
             }
 
-    def _validate_answer(self, question: Dict, message: str) -> tuple[bool, str, str]:
+    def _validate_answer(self, question: Question, message: str) -> tuple[bool, str, str]:
         """Validates the user's answer and returns (is_valid, selected_answer, confirmation_text)."""
-        options = question.get("options", [])
-        question_type = question["type"]
+        options = question.options
+        question_type = question.type
         message = normalize_text(message.strip())
         log_event("Validating answer", {
-            "question_id": question["id"],
+            "question_id": question.id,
             "question_type": question_type,
             "message": message,
-            "options": [opt["text"] for opt in options]
+            "options": [opt.text for opt in options]
         }, self.survey_type)
 
         if not message:
-            log_event("Empty message received", {"question_id": question["id"]}, self.survey_type)
+            log_event("Empty message received", {"question_id": question.id}, self.survey_type)
             return False, "", "❌ Resposta inválida. Por favor, selecione uma opção."
 
-        if question_type in ["quick_reply", "multiple_choice"]:
+        if question.is_choice:
             letters = [chr(97 + i) for i in range(len(options))]
             numbers = [str(i + 1) for i in range(len(options))]
-            option_map = {opt["text"].lower(): f"opt_{i}" for i, opt in enumerate(options)}
+            # On repeated texts the last option wins, as in the text -> option map this replaced
+            key = message.lower()
+            text_idx = next((i for i in range(len(options) - 1, -1, -1) if options[i].key == key), None)
 
             if message.startswith("opt_"):
                 try:
                     idx = int(message.split("_")[1])
                     if 0 <= idx < len(options):
-                        log_event("Valid answer found", {"index": idx, "answer": options[idx]["text"]}, self.survey_type)
-                        return True, options[idx]["text"], f"✔️ Você escolheu: {options[idx]['text']}"
+                        log_event("Valid answer found", {"index": idx, "answer": options[idx].text}, self.survey_type)
+                        return True, options[idx].text, f"✔️ Você escolheu: {options[idx].text}"
                     else:
                         log_event("Invalid opt index", {"index": idx, "options_length": len(options)}, self.survey_type)
                 except (ValueError, IndexError) as e:
@@ -220,28 +205,29 @@ class SurveyProcessor:
             elif message.lower() in letters:
                 try:
                     idx = letters.index(message.lower())
-                    log_event("Valid answer found by letter", {"letter": message.lower(), "index": idx, "answer": options[idx]["text"]}, self.survey_type)
-                    return True, options[idx]["text"], f"✔️ Você escolheu: {options[idx]['text']}"
+                    log_event("Valid answer found by letter", {"letter": message.lower(), "index": idx, "answer": options[idx].text}, self.survey_type)
+                    return True, options[idx].text, f"✔️ Você escolheu: {options[idx].text}"
                 except ValueError as e:
                     log_event("Invalid letter", {"error": str(e), "message": message}, self.survey_type)
             elif message in numbers:
                 try:
                     idx = int(message) - 1
                     if 0 <= idx < len(options):
-                        log_event("Valid answer found by number", {"number": message, "index": idx, "answer": options[idx]["text"]}, self.survey_type)
-                        return True, options[idx]["text"], f"✔️ Você escolheu: {options[idx]['text']}"
+                        log_event("Valid answer found by number", {"number": message, "index": idx, "answer": options[idx].text}, self.survey_type)
+                        return True, options[idx].text, f"✔️ Você escolheu: {options[idx].text}"
                     else:
                         log_event("Invalid number index", {"index": idx, "options_length": len(options)}, self.survey_type)
                 except ValueError as e:
                     log_event("Error parsing number", {"error": str(e), "message": message}, self.survey_type)
-            elif message.lower() in option_map:
-                idx = int(option_map[message.lower()].split("_")[1])
-                log_event("Valid answer found by text", {"text": message.lower(), "index": idx, "answer": options[idx]["text"]}, self.survey_type)
-                return True, options[idx]["text"], f"✔️ Você escolheu: {options[idx]['text']}"
+            elif text_idx is not None:
+                idx = text_idx
+                log_event("Valid answer found by text", {"text": key, "index": idx, "answer": options[idx].text}, self.survey_type)
+                return True, options[idx].text, f"✔️ Você escolheu: {options[idx].text}"
             else:
+                option_map = {opt.key: f"opt_{i}" for i, opt in enumerate(options)}
                 log_event("No matching answer", {"message": message, "options_map": option_map}, self.survey_type)
-        elif question_type in ["text", "open_text"]:
-            if "cpf" in question["text"].lower() and self.survey_type == "petition":
+        elif question.is_text:
+            if "cpf" in question.text.lower() and self.survey_type == "petition":
                 if not is_valid_cpf(message):
                     log_event("Invalid CPF", {"cpf": message}, self.survey_type)
                     return False, "", "❌ CPF inválido. Por favor, digite um CPF válido com 11 dígitos (apenas números)."
@@ -257,56 +243,257 @@ class SurveyProcessor:
         log_event("Answer validation failed", {"message": message, "question_type": question_type}, self.survey_type)
         return False, "", "❌ Resposta inválida. Por favor, selecione uma opção."
 
-    def _get_next_question(self, current_question: Dict, selected_answer: str) -> Optional[Dict]:
-        """Determines the next question based on the current question and answer."""
-        current_index = next(
-            (i for i, q in enumerate(self.questions) if str(q["id"]) == str(current_question["id"])),
-            -1
-        )
+    def _get_next_question(self, current_question: Question, selected_answer: str,
+                           answers: Optional[Dict] = None) -> Optional[Question]:
+        """Determines the next question based on the current question and answer.
+
+        `answers` are the session's answers so far, read by expression conditions.
+        """
+        current_index = self.flow.index.get(current_question.id, -1)
         if current_index == -1:
-            log_event("Current question index not found", {"current_id": current_question["id"]}, self.survey_type)
+            log_event("Current question index not found", {"current_id": current_question.id}, self.survey_type)
             return None
 
         log_event("Searching for next question", {
             "current_index": current_index,
-            "current_id": current_question["id"],
+            "current_id": current_question.id,
             "selected_answer": selected_answer
         }, self.survey_type)
 
         # Check if the selected answer has a specific target
-        for opt in current_question.get("options", []):
-            if opt["text"].lower() == normalize_text(selected_answer).lower() and opt.get("target"):
-                target_id = opt["target"]
-                next_question = next(
-                    (q for q in self.questions if str(q["id"]) == str(target_id)),
-                    None
-                )
+        selected_key = normalize_text(selected_answer).lower()
+        for opt in current_question.options:
+            if opt.key == selected_key and opt.target:
+                target_id = opt.target
+                next_question = self._find_question(target_id)
                 if next_question:
                     log_event("Next question found by option target", {
-                        "next_id": next_question["id"],
+                        "next_id": next_question.id,
                         "target": target_id
                     }, self.survey_type)
                     return next_question
                 log_event("Target question not found", {"target": target_id}, self.survey_type)
 
         # Check for conditional questions
-        for i, q in enumerate(self.questions[current_index + 1:], start=current_index + 1):
-            if q.get("condition") and normalize_text(q["condition"]).lower() == normalize_text(selected_answer).lower():
-                log_event("Next question found by condition", {
-                    "next_id": q["id"],
-                    "condition": q["condition"]
-                }, self.survey_type)
-                return q
+        conditions = self.flow.conditions()
+        position = conditions.first_match(current_index, answers or {}, selected_key)
+        if position is not None:
+            q = self.questions[position]
+            log_event("Next question found by condition", {
+                "next_id": q.id,
+                "condition": q.condition
+            }, self.survey_type)
+            return q
 
         # Fall back to the next non-conditional question
-        for i, q in enumerate(self.questions[current_index + 1:], start=current_index + 1):
-            if not q.get("condition"):
-                log_event("Next non-conditional question found", {"next_id": q["id"]}, self.survey_type)
-                return q
+        position = conditions.next_plain(current_index)
+        if position is not None:
+            q = self.questions[position]
+            log_event("Next non-conditional question found", {"next_id": q.id}, self.survey_type)
+            return q
 
         log_event("No next question found", {}, self.survey_type)
         return None
 
+    def _save_effect(self, step: Optional[str], answers: Dict, on_error: str, failure_log: str,
+                     failure_data: Dict) -> Dict[str, Any]:
+        return {
+            "type": "save_state",
+            "step": step,
+            "answers": answers,
+            "on_error": on_error,
+            "failure_log": failure_log,
+            "failure_data": failure_data,
+        }
+
+    def _step(self, state: Dict, message: str) -> Tuple[Dict, Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Pure transition: (state, normalized message) -> (new state, response, effects).
+
+        Performs no backend I/O. Effects describe the writes that make the new
+        state durable, in order; each carries the reply to send if it fails.
+        A "switch_campaign" effect asks the caller to resolve a campaign code
+        and step again.
+        """
+        current_step = state.get("current_step")
+        answers = dict(state.get("answers", {}))
+        log_event("Current state", {
+            "current_step": current_step,
+            "answers": self._answers_for_log(answers)
+        }, self.survey_type)
+
+        # Handle campaign start via code
+        if message.lower().startswith("começar "):
+            code = normalize_text(message.split(" ")[1]).upper()
+            return state, None, [{"type": "switch_campaign", "code": code}]
+
+        # Handle survey initiation
+        if not current_step or message.lower() in ["participar", "começar", "assinar"]:
+            next_question = self.questions[0]
+            effects = [self._save_effect(
+                next_question.id, {}, "⚠️ Erro ao iniciar a pesquisa. Tente novamente.",
+                "Failed to save initial state",
+                {"phone": self.phone, "campaign_id": self.campaign_id, "step": next_question.id}
+            )]
+            log_event("Survey started", {
+                "phone": self.phone,
+                "campaign_id": self.campaign_id,
+                "first_question_id": next_question.id
+            }, self.survey_type)
+            new_state = {"current_step": str(next_question.id), "answers": {}}
+            if next_question.is_choice:
+                return new_state, self._format_options(next_question), effects
+            return new_state, {"next_message": next_question.text}, effects
+
+        # Find current question
+        current_question = self._find_question(current_step)
+        if not current_question:
+            log_event("Current question not found, checking answers", {
+                "current_step": current_step,
+                "answers": self._answers_for_log(answers)
+            }, self.survey_type)
+            if answers:
+                ids_respondidas = sorted([k for k in answers.keys() if k.isalnum()])
+                ultima_id = ids_respondidas[-1] if ids_respondidas else None
+                current_question = self._find_question(ultima_id) if ultima_id else None
+        if not current_question:
+            log_event("Current question not found", {"current_step": current_step}, self.survey_type)
+            return state, {"next_message": "Erro interno: pergunta atual não encontrada."}, []
+
+        # Validate answer
+        valid_answer, selected_answer, confirmation_text = self._validate_answer(current_question, message)
+        if not valid_answer:
+            message_text = f"❌ Resposta inválida. Escolha uma das opções abaixo:\n{current_question.text}"
+            if current_question.is_choice:
+                return state, self._format_options(current_question), []
+            return state, {"next_message": message_text}, []
+
+        # Record answer and determine next question
+        question_id = str(current_question.id)
+        answers[question_id] = selected_answer
+        log_event("Answer recorded", {
+            "question_id": current_question.id,
+            "answer": selected_answer,
+            "answers": self._answers_for_log(answers)
+        }, self.survey_type)
+        next_question = self._get_next_question(current_question, selected_answer, answers)
+        next_step = str(next_question.id) if next_question else None
+        new_state = {"current_step": next_step, "answers": answers}
+
+        if STATE_WRITE_MODE == "delta":
+            # One atomic call records the answer and moves to the next step
+            effects = [{
+                "type": "step_state",
+                "expected_step": current_step,
+                "next_step": next_step,
+                "question_id": question_id,
+                "answer": selected_answer,
+                "on_error": "⚠️ Erro ao salvar resposta. Tente novamente.",
+            }]
+        else:
+            effects = [self._save_effect(
+                current_question.id, answers, "⚠️ Erro ao salvar resposta. Tente novamente.",
+                "Failed to save answer",
+                {"question_id": current_question.id, "answer": selected_answer}
+            )]
+            if next_question:
+                effects.append(self._save_effect(
+                    next_question.id, answers, "⚠️ Erro ao avançar para a próxima pergunta. Tente novamente.",
+                    "Failed to save next question state", {"next_question_id": next_question.id}
+                ))
+            elif answers:
+                effects.append(self._save_effect(
+                    None, answers, "⚠️ Erro ao finalizar a pesquisa. Tente novamente.",
+                    "Failed to save completion state", {}
+                ))
+
+        if next_question:
+            if next_question.is_choice:
+                interactive_payload = self._format_options(next_question)
+                interactive_payload["interactive"]["header"] = {
+                    "type": "text",
+                    "text": confirmation_text
+                }
+                return new_state, interactive_payload, effects
+            return new_state, {"next_message": f"{confirmation_text}\n\n{next_question.text}"}, effects
+
+        # Survey completion
+        if not answers:
+            log_event("Attempted to complete survey with no answers", {}, self.survey_type)
+            return state, {"next_message": "⚠️ Nenhuma resposta registrada. Por favor, reinicie a pesquisa."}, []
+        final_message = self.flow.outro if self.flow.outro is not None else "Obrigado por participar da pesquisa!"
+        if self.survey_type == "petition":
+            # The signature count is only known once the effect runs
+            effects.append({"type": "count_petition", "prefix": f"{confirmation_text}\n\n", "template": final_message})
+        log_event("Survey completed", {
+            "phone": self.phone,
+            "campaign_id": self.campaign_id,
+            "answers": self._answers_for_log(answers)
+        }, self.survey_type)
+        return new_state, {
+            "next_message": f"{confirmation_text}\n\n{final_message}",
+            "completed": True,
+            "answers": answers
+        }, effects
+
+    def _rewrite_step(self, effect: Dict[str, Any]) -> bool:
+        """Writes a refused step as a full state if the row is still at the expected step.
+
+        The step RPC refuses to merge into answers encoded against another
+        version of the flow; the full write re-encodes them against this one.
+        A row that moved on is left alone.
+        """
+        with tracing.span("state.read"):
+            stored = self.store.get_user_state(self.phone, self.campaign_id, self.flow)
+        expected = effect["expected_step"]
+        if stored.get("current_step") != (str(expected) if expected else None):
+            return False
+        answers = dict(stored.get("answers") or {}, **{effect["question_id"]: effect["answer"]})
+        with tracing.span("state.write", mode="upsert"):
+            return self.store.save_user_state(self.phone, self.campaign_id, effect["next_step"], answers, self.flow)
+
+    def _apply_effect(self, effect: Dict[str, Any], response: Dict[str, Any]) -> bool:
+        """Performs one effect returned by _step; returns False if it failed."""
+        kind = effect["type"]
+        if kind == "save_state":
+            with tracing.span("state.write", mode="upsert"):
+                saved = self.store.save_user_state(self.phone, self.campaign_id, effect["step"], effect["answers"], self.flow)
+            if not saved:
+                log_event(effect["failure_log"], dict(
+                    effect["failure_data"], answers=self._answers_for_log(effect["answers"])
+                ), self.survey_type)
+                return False
+            return True
+        if kind == "step_state":
+            with tracing.span("state.write", mode="step"):
+                state = self.store.step_user_state(
+                    self.phone, self.campaign_id, effect["expected_step"], effect["next_step"],
+                    effect["question_id"], effect["answer"], self.flow
+                )
+            if state is None and self._rewrite_step(effect):
+                return True
+            if state is None:
+                log_event("Failed to step user state", {
+                    "question_id": effect["question_id"],
+                    "expected_step": effect["expected_step"],
+                    "next_question_id": effect["next_step"]
+                }, self.survey_type)
+                return False
+            return True
+        if kind == "count_petition":
+            petition_counts.setdefault(self.campaign_id, 0)
+            petition_counts[self.campaign_id] += 1
+            count = petition_counts[self.campaign_id]
+            count_text = "assinatura coletada" if count == 1 else "assinaturas coletadas"
+            response["next_message"] = effect["prefix"] + effect["template"].replace("[CONTADOR]", f"{count} {count_text}")
+            log_petition_event("Petition completed", {
+                "phone": self.phone,
+                "campaign_id": self.campaign_id,
+                "count": count,
+                "answers": self._answers_for_log(response.get("answers", {}))
+            })
+            return True
+        raise ValueError(f"Unknown effect: {kind}")
+
     async def process(self, message: str) -> Dict[str, Any]:
         """Processes an incoming message and returns the next message."""
         try:
@@ -320,158 +507,58 @@ class SurveyProcessor:
             if not self._validate_campaign():
                 return {"next_message": "Campanha sem perguntas válidas."}
 
-            current_step = self.user_state.get("current_step")
-            answers = self.user_state.get("answers", {})
-            log_event("Current state", {
-                "current_step": current_step,
-                "answers": answers
-            }, self.survey_type)
+            # Last durable state, for the answer tallies
+            previous_state = self.user_state
+            new_state, response, effects = self._step(self.user_state, message)
 
             # Handle campaign start via code
-            if message.lower().startswith("começar "):
-                code = normalize_text(message.split(" ")[1]).upper()
-                campaign = get_campaign_by_code(code)
+            if effects and effects[0]["type"] == "switch_campaign":
+                with tracing.span("get_campaign", by="code"):
+                    campaign = self.store.get_campaign_by_code(effects[0]["code"])
                 if not campaign:
                     return {"next_message": "Código de campanha inválido."}
                 self.campaign_id = normalize_text(campaign['campaign_id'])
                 self.campaign = campaign
+                self.flow = get_compiled_flow(self.campaign)
                 self.survey_type = self._determine_survey_type()
                 self.questions = self._load_questions()
-                if not save_user_state(self.phone, self.campaign_id, None, {}):
+                with tracing.span("state.read"):
+                    previous_state = self.store.get_user_state(self.phone, self.campaign_id, self.flow)
+                with tracing.span("state.write", mode="reset"):
+                    reset = self.store.save_user_state(self.phone, self.campaign_id, None, {}, self.flow)
+                if not reset:
                     log_event("Failed to reset user state", {
                         "phone": self.phone,
                         "campaign_id": self.campaign_id
                     }, self.survey_type)
                     return {"next_message": "⚠️ Erro ao iniciar a pesquisa. Tente novamente."}
-                message = "começar"
-
-            # Handle survey initiation
-            if not current_step or message.lower() in ["participar", "começar", "assinar"]:
-                next_question = self.questions[0]
-                answers = {}  # Reset answers on start
-                if not save_user_state(self.phone, self.campaign_id, next_question["id"], answers):
-                    log_event("Failed to save initial state", {
-                        "phone": self.phone,
-                        "campaign_id": self.campaign_id,
-                        "step": next_question["id"]
-                    }, self.survey_type)
-                    return {"next_message": "⚠️ Erro ao iniciar a pesquisa. Tente novamente."}
-                log_event("Survey started", {
-                    "phone": self.phone,
-                    "campaign_id": self.campaign_id,
-                    "first_question_id": next_question["id"]
-                }, self.survey_type)
-                if next_question["type"] in ["quick_reply", "multiple_choice"]:
-                    return self._format_options(next_question)
-                return {"next_message": next_question["text"]}
-
-            # Find current question
-            current_question = next(
-                (q for q in self.questions if str(q["id"]) == str(current_step)),
-                None
-            )
-            if not current_question:
-                log_event("Current question not found, checking answers", {
-                    "current_step": current_step,
-                    "answers": answers
-                }, self.survey_type)
-                if answers:
-                    ids_respondidas = sorted([k for k in answers.keys() if k.isalnum()])
-                    ultima_id = ids_respondidas[-1] if ids_respondidas else None
-                    current_question = next(
-                        (q for q in self.questions if str(q["id"]) == ultima_id),
-                        None
-                    )
-            if not current_question:
-                log_event("Current question not found", {"current_step": current_step}, self.survey_type)
-                return {"next_message": "Erro interno: pergunta atual não encontrada."}
-
-            # Validate answer
-            valid_answer, selected_answer, confirmation_text = self._validate_answer(current_question, message)
-            if not valid_answer:
-                message_text = f"❌ Resposta inválida. Escolha uma das opções abaixo:\n{current_question['text']}"
-                if current_question["type"] in ["quick_reply", "multiple_choice"]:
-                    return self._format_options(current_question)
-                return {"next_message": message_text}
-
-            # Save answer
-            answers[str(current_question["id"])] = selected_answer
-            log_event("Answer recorded", {
-                "question_id": current_question["id"],
-                "answer": selected_answer,
-                "answers": answers
-            }, self.survey_type)
-            if not save_user_state(self.phone, self.campaign_id, current_question["id"], answers):
-                log_event("Failed to save answer", {
-                    "question_id": current_question["id"],
-                    "answer": selected_answer,
-                    "answers": answers
-                }, self.survey_type)
-                return {"next_message": "⚠️ Erro ao salvar resposta. Tente novamente."}
-            self.user_state = get_user_state(self.phone, self.campaign_id)  # Refresh state
-            log_event("Answer saved and state refreshed", {
-                "question_id": current_question["id"],
-                "answer": selected_answer,
-                "updated_answers": self.user_state.get("answers", {})
-            }, self.survey_type)
-
-            # Determine next question
-            next_question = self._get_next_question(current_question, selected_answer)
-            if next_question:
-                if not save_user_state(self.phone, self.campaign_id, next_question["id"], answers):
-                    log_event("Failed to save next question state", {
-                        "next_question_id": next_question["id"],
-                        "answers": answers
-                    }, self.survey_type)
-                    return {"next_message": "⚠️ Erro ao avançar para a próxima pergunta. Tente novamente."}
-                self.user_state = get_user_state(self.phone, self.campaign_id)  # Refresh state
-                log_event("State updated for next question", {
-                    "next_question_id": next_question["id"],
-                    "answers": self.user_state.get("answers", {})
-                }, self.survey_type)
-                if next_question["type"] in ["quick_reply", "multiple_choice"]:
-                    interactive_payload = self._format_options(next_question)
-                    interactive_payload["interactive"]["header"] = {
-                        "type": "text",
-                        "text": confirmation_text
-                    }
-                    return interactive_payload
-                return {"next_message": f"{confirmation_text}\n\n{next_question['text']}"}
-
-            # Survey completion
-            if not answers:
-                log_event("Attempted to complete survey with no answers", {}, self.survey_type)
-                return {"next_message": "⚠️ Nenhuma resposta registrada. Por favor, reinicie a pesquisa."}
-            if not save_user_state(self.phone, self.campaign_id, None, answers):
-                log_event("Failed to save completion state", {"answers": answers}, self.survey_type)
-                return {"next_message": "⚠️ Erro ao finalizar a pesquisa. Tente novamente."}
-            self.user_state = get_user_state(self.phone, self.campaign_id)  # Refresh state
-            final_message = self._safe_json_load(self.campaign.get("questions_json", {})).get(
-                "outro", "Obrigado por participar da pesquisa!"
-            )
-            if self.survey_type == "petition":
-                petition_counts.setdefault(self.campaign_id, 0)
-                petition_counts[self.campaign_id] += 1
-                count = petition_counts[self.campaign_id]
-count_text = "assinatura coletada" if count == 1 else "assinaturas coletadas"
-final_message = final_message.replace("[CONTADOR]", f"{count} {count_text}")
-                log_petition_event("Petition completed", {
-                    "phone": self.phone,
-                    "campaign_id": self.campaign_id,
-                    "count": petition_counts[self.campaign_id],
-                    "answers": answers
-                })
-            log_event("Survey completed", {
+                reset_state = {"current_step": None, "answers": {}}
+                tally_counter.record(self.campaign_id, self.flow, previous_state, reset_state)
+                previous_state = reset_state
+                new_state, response, effects = self._step(self.user_state, "começar")
+
+            for effect in effects:
+                if not self._apply_effect(effect, response):
+                    return {"next_message": effect["on_error"]}
+                # Tally every write that landed, even if a later one fails
+                if effect["type"] == "save_state":
+                    stored_state = {"current_step": effect["step"], "answers": effect["answers"]}
+                elif effect["type"] == "step_state":
+                    stored_state = new_state
+                else:
+                    continue
+                tally_counter.record(self.campaign_id, self.flow, previous_state, stored_state)
+                previous_state = stored_state
+            self.user_state = new_state
+            return response
+
+        except BackendUnavailable as e:
+            log_event("Backend unavailable", {
+                "error": normalize_text(str(e)),
                 "phone": self.phone,
-                "campaign_id": self.campaign_id,
-                "answers": answers
+                "campaign_id": self.campaign_id
             }, self.survey_type)
-            return {
-                "next_message": f"{confirmation_text}\n\n{final_message}",
-                "completed": True,
-                "answers": answers
-            }
-
+            return dict(UNAVAILABLE_RESPONSE)
         except Exception as e:
             log_event("Processing error", {
                 "error": normalize_text(str(e)),
@@ -481,16 +568,35 @@ final_message = final_message.replace("[CONTADOR]", f"{count} {count_text}")
             }, self.survey_type)
             return {"next_message": "⚠️ Ocorreu um erro interno. Por favor, tente novamente."}
 
-async def process_message(phone: str, campaign_id: str, message: str) -> Dict[str, Any]:
+def step(flow: Flow, state: Dict, message: str, phone: str = "",
+         campaign_id: str = "") -> Tuple[Dict, Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Pure flow transition: (compiled flow, state, message) -> (new state, response, effects).
+
+    Applies the same message normalization as process(). Nothing is read from
+    or written to the backend; see SurveyProcessor._step for the effects.
+    """
+    processor = SurveyProcessor.from_flow(flow, phone, campaign_id)
+    return processor._step(state, normalize_text(message.strip()))
+
+async def process_message(phone: str, campaign_id: str, message: str, store: Any = None) -> Dict[str, Any]:
     """Entrypoint for processing messages."""
-    campaign = get_campaign(campaign_id)
+    store = store if store is not None else supabase_client
+    with tracing.span("get_campaign"):
+        campaign = store.get_campaign(campaign_id)
     if not campaign:
         log_event("Campaign not found", {"campaign_id": campaign_id}, "unknown")
         return {"next_message": "Erro ao carregar campanha."}
-    processor = SurveyProcessor(campaign, phone, campaign_id)
+    try:
+        processor = SurveyProcessor(campaign, phone, campaign_id, store)
+    except BackendUnavailable as e:
+        # Without the state we cannot tell a new user from one mid-survey
+        log_event("User state unavailable", {"phone": phone, "campaign_id": campaign_id, "error": str(e)}, "unknown")
+        return dict(UNAVAILABLE_RESPONSE)
     return await processor.process(message)
 
 if __name__ == "__main__":
+    from log_config import configure_logging
+    configure_logging()
     # Test the processor
     test_result = asyncio.run(process_message(
         "+5511999999999",
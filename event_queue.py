@@ -0,0 +1,402 @@
+"""Durable local queue of inbound messages and the consumers that drain it.
+
+In queue mode (EVENT_QUEUE_PATH set), /enqueue only appends the message to
+an SQLite log and returns. One or more consumer processes lease batches,
+run the engine, and send the reply through the outbound Graph path.
+Ingestion therefore survives Supabase slowdowns, and processing scales
+separately.
+
+Delivery guarantees:
+- A conversation (phone, campaign_id) is processed strictly in order: only
+  its oldest pending event can be leased, so two consumers never work on
+  the same conversation at once.
+- Acknowledging an event deletes it; this is the committed offset.
+- A consumer renews the leases of the events it is still handling every
+  third of the lease period, so a slow handler keeps its event. A consumer
+  that dies (or stalls) loses its leases when they expire, and the events
+  become available again. A consumer that lost a lease does not send the
+  reply; the new owner does.
+- A failed event is retried with exponential backoff and moves to
+  dead_events after EVENT_MAX_ATTEMPTS; `redrive` puts dead events back.
+- The engine's response is stored before the reply is sent. A retry after
+  a failed send re-sends that response instead of running the engine twice
+  on the same message.
+
+Usage:
+    python event_queue.py consume --workers 8
+    python event_queue.py stats
+    python event_queue.py redrive
+"""
+import os
+import sys
+import json
+import logging
+import time
+import uuid
+import random
+import sqlite3
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+from log_config import configure_logging
+import tracing
+
+EVENT_QUEUE_PATH = os.getenv("EVENT_QUEUE_PATH", "")
+EVENT_MAX_ATTEMPTS = int(os.getenv("EVENT_MAX_ATTEMPTS", "5"))
+DEFAULT_LEASE_SECONDS = 60.0
+DEFAULT_BATCH_SIZE = 32
+MAX_BACKOFF_SECONDS = 300.0
+
+SCHEMA = """
+create table if not exists events (
+    id integer primary key autoincrement,
+    conversation text not null,
+    payload text not null,
+    enqueued_at real not null,
+    available_at real not null,
+    attempts integer not null default 0,
+    lease_owner text,
+    lease_until real,
+    response text,
+    last_error text
+);
+create index if not exists events_conversation on events (conversation, id);
+create index if not exists events_available on events (available_at, id);
+create table if not exists dead_events (
+    id integer primary key,
+    conversation text not null,
+    payload text not null,
+    enqueued_at real not null,
+    attempts integer not null,
+    response text,
+    last_error text,
+    died_at real not null
+);
+"""
+
+def log_event(message: str, data: Dict = {}):
+    log_entry = {'message': message, 'data': data}
+    logging.info(json.dumps(log_entry, ensure_ascii=False))
+
+class EventQueue:
+    """SQLite-backed queue; safe to share between threads and processes."""
+    def __init__(self, path: str, max_attempts: int = EVENT_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        with self._connection() as db:
+            db.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("pragma journal_mode=wal")
+            db.execute("pragma synchronous=full")  # an acknowledged enqueue survives power loss
+            db.execute("pragma busy_timeout=30000")
+            self._local.db = db
+        return db
+
+    def _transaction(self):
+        db = self._connection()
+        db.execute("begin immediate")
+        return _Transaction(db)
+
+    def enqueue(self, phone: str, campaign_id: str, message: str, **extra: Any) -> int:
+        payload = dict(extra, phone=phone, campaign_id=campaign_id, message=message)
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.execute(
+                "insert into events (conversation, payload, enqueued_at, available_at) values (?, ?, ?, ?)",
+                (f"{phone}|{campaign_id}", json.dumps(payload, ensure_ascii=False), now, now)
+            )
+        return cursor.lastrowid
+
+    def lease(self, owner: str, limit: int = DEFAULT_BATCH_SIZE,
+              lease_seconds: float = DEFAULT_LEASE_SECONDS) -> List[Dict[str, Any]]:
+        """Leases up to `limit` events, at most one per conversation (its oldest)."""
+        now = time.time()
+        with self._transaction() as db:
+            rows = db.execute(
+                """
+                select id, payload, attempts, response, enqueued_at from events e
+                where available_at <= :now and (lease_until is null or lease_until <= :now)
+                  and not exists (select 1 from events p where p.conversation = e.conversation and p.id < e.id)
+                order by id limit :limit
+                """,
+                {"now": now, "limit": limit}
+            ).fetchall()
+            if rows:
+                db.executemany(
+                    "update events set lease_owner = ?, lease_until = ?, attempts = attempts + 1 where id = ?",
+                    [(owner, now + lease_seconds, row[0]) for row in rows]
+                )
+        return [{"id": id_, "payload": json.loads(payload), "attempts": attempts + 1,
+                 "response": json.loads(response) if response else None, "enqueued_at": enqueued_at}
+                for id_, payload, attempts, response, enqueued_at in rows]
+
+    def extend(self, event_ids: List[int], owner: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> int:
+        """Renews leases still held by `owner`; returns how many were renewed."""
+        if not event_ids:
+            return 0
+        with self._transaction() as db:
+            cursor = db.execute(
+                f"update events set lease_until = ? where lease_owner = ? and id in ({','.join('?' * len(event_ids))})",
+                [time.time() + lease_seconds, owner, *event_ids]
+            )
+        return cursor.rowcount
+
+    def record_response(self, event_id: int, owner: str, response: Dict[str, Any]) -> bool:
+        """Stores the engine's response; False if the lease was lost to another consumer."""
+        with self._transaction() as db:
+            cursor = db.execute("update events set response = ? where id = ? and lease_owner = ?",
+                                (json.dumps(response, ensure_ascii=False), event_id, owner))
+        return cursor.rowcount == 1
+
+    def ack(self, event_id: int, owner: str) -> bool:
+        """Commits a processed event; False if the lease was lost to another consumer."""
+        with self._transaction() as db:
+            cursor = db.execute("delete from events where id = ? and lease_owner = ?", (event_id, owner))
+        return cursor.rowcount == 1
+
+    def fail(self, event_id: int, owner: str, error: str) -> bool:
+        """Schedules a retry with backoff, or dead-letters the event; True if it went dead."""
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("select attempts from events where id = ? and lease_owner = ?",
+                             (event_id, owner)).fetchone()
+            if row is None:
+                return False
+            attempts = row[0]
+            if attempts >= self.max_attempts:
+                db.execute(
+                    """
+                    insert into dead_events (id, conversation, payload, enqueued_at, attempts, response, last_error, died_at)
+                    select id, conversation, payload, enqueued_at, attempts, response, ?, ? from events where id = ?
+                    """,
+                    (error, now, event_id)
+                )
+                db.execute("delete from events where id = ?", (event_id,))
+                return True
+            backoff = min(MAX_BACKOFF_SECONDS, 2 ** attempts) * (0.5 + random.random())
+            db.execute(
+                "update events set lease_owner = null, lease_until = null, available_at = ?, last_error = ? where id = ?",
+                (now + backoff, error, event_id)
+            )
+        return False
+
+    def redrive(self, ids: Optional[List[int]] = None) -> int:
+        """Moves dead events back into the queue (all of them by default)."""
+        now = time.time()
+        where, params = ("", []) if not ids else (f"where id in ({','.join('?' * len(ids))})", list(ids))
+        with self._transaction() as db:
+            db.execute(
+                f"""
+                insert into events (id, conversation, payload, enqueued_at, available_at, attempts, response, last_error)
+                select id, conversation, payload, enqueued_at, {now}, 0, response, last_error from dead_events {where}
+                """,
+                params
+            )
+            cursor = db.execute(f"delete from dead_events {where}", params)
+        return cursor.rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        db = self._connection()
+        now = time.time()
+        pending, leased, oldest = db.execute(
+            "select count(*), sum(lease_until > ?), min(enqueued_at) from events", (now,)
+        ).fetchone()
+        dead = db.execute("select count(*) from dead_events").fetchone()[0]
+        return {"pending": pending, "leased": leased or 0, "dead": dead,
+                "oldest_age_s": round(now - oldest, 3) if oldest else 0.0}
+
+class _Transaction:
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+
+    def __enter__(self) -> sqlite3.Connection:
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.db.execute("rollback" if exc_type else "commit")
+
+def handle_event(event: Dict[str, Any], store: Any) -> Dict[str, Any]:
+    """Runs the engine for one event (unless a previous attempt already did)."""
+    from engine import process_message
+
+    if event["response"] is not None:
+        return event["response"]
+    payload = event["payload"]
+    with tracing.span("engine"):
+        response = asyncio.run(process_message(payload["phone"], payload["campaign_id"], payload["message"], store))
+    if response.get("retry"):
+        # Backend unavailable: nothing was processed, so retry later instead of replying
+        raise RuntimeError(response.get("next_message") or "backend indisponível")
+    return response
+
+def deliver(payload: Dict[str, Any], response: Dict[str, Any], store: Any) -> None:
+    """Sends the engine's reply, as webhook.php does in synchronous mode."""
+    from whatsapp_client import response_payload, send_message
+
+    phone_number_id = payload.get("phone_number_id")
+    if not phone_number_id:
+        campaign = store.get_campaign(payload["campaign_id"]) or {}
+        phone_number_id = campaign.get("phone_number_id")
+    if not phone_number_id:
+        raise RuntimeError("phone_number_id desconhecido")
+    ok, status, text = send_message(response_payload(payload["phone"], response), phone_number_id)
+    if not ok:
+        raise RuntimeError(f"Falha ao enviar resposta: {status} {text[:200]}")
+
+def consume(queue: EventQueue, store: Any = None, workers: int = 4, batch_size: int = DEFAULT_BATCH_SIZE,
+            lease_seconds: float = DEFAULT_LEASE_SECONDS, idle_sleep: float = 0.2,
+            stop: Optional[threading.Event] = None, send: bool = True, reminders: Any = None) -> Dict[str, int]:
+    """Drains the queue until `stop` is set (or, without `stop`, until nothing is leasable).
+
+    With a reminders.ReminderScheduler, processed messages re-arm their
+    session's reminder and the scheduler runs in this process, as in main.py.
+    """
+    from tallies import TALLY_FLUSH_SECONDS, tally_counter
+
+    bus = None
+    if store is None:
+        from campaign_cache import CampaignCache
+        from cache_bus import CacheBus, connect, make_transport
+        from state_cache import STATE_CACHE_SIZE, StateCache
+        bus = CacheBus()
+        # States written here are announced to the web workers' caches; with
+        # STATE_CACHE_SIZE=0 this process caches none but still announces them
+        state_cache = StateCache(bus=bus, capacity=STATE_CACHE_SIZE)
+        store = CampaignCache(backend=state_cache)
+        store.open_snapshot()
+        connect(bus, store, state_cache)
+        try:
+            bus.start(make_transport())
+        except OSError as e:
+            log_event("Barramento de invalidação indisponível; caches apenas locais", {"error": str(e)})
+    owner = f"{os.uname().nodename}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    totals = {"processed": 0, "failed": 0, "dead": 0}
+    totals_lock = threading.Lock()
+
+    in_flight: set = set()
+    heartbeat_stop = threading.Event()
+
+    def count(key: str) -> None:
+        with totals_lock:
+            totals[key] += 1
+
+    def heartbeat() -> None:
+        # Renews the leases of events still being handled, so a slow handler is not raced by another consumer
+        while not heartbeat_stop.wait(lease_seconds / 3):
+            with totals_lock:
+                event_ids = list(in_flight)
+            try:
+                queue.extend(event_ids, owner, lease_seconds)
+            except sqlite3.Error as e:
+                log_event("Erro ao renovar leases", {"events": len(event_ids), "error": str(e)})
+
+    def run(event: Dict[str, Any]) -> None:
+        with totals_lock:
+            in_flight.add(event["id"])
+        try:
+            # Continues the trace of the /enqueue request; slow ones are logged (TRACE_LOG_SLOW_MS)
+            with tracing.start("event", event["payload"].get("traceparent"), event_id=event["id"],
+                               attempt=event["attempts"]):
+                tracing.record("queue.wait", time.time() - event["enqueued_at"])
+                handle(event)
+        finally:
+            with totals_lock:
+                in_flight.discard(event["id"])
+
+    def handle(event: Dict[str, Any]) -> None:
+        try:
+            response = handle_event(event, store)
+            if event["response"] is None:
+                if not queue.record_response(event["id"], owner, response):
+                    # Another consumer leased the event after ours expired; it replies
+                    log_event("Lease perdido durante o processamento", {"id": event["id"]})
+                    return
+                event["response"] = response
+                if reminders is not None:
+                    payload = event["payload"]
+                    reminders.touch(payload["phone"], payload["campaign_id"], bool(response.get("completed")))
+            if send:
+                deliver(event["payload"], response, store)
+        except Exception as e:
+            count("failed")
+            if queue.fail(event["id"], owner, str(e)):
+                count("dead")
+                log_event("Evento movido para a fila de mortos", {"id": event["id"], "error": str(e)})
+            return
+        queue.ack(event["id"], owner)
+        count("processed")
+
+    reminders_stop = threading.Event()
+    reminders_thread = None
+    if reminders is not None:
+        restored = reminders.restore()
+        log_event("Agendador de lembretes iniciado", {"restored": restored})
+        reminders_thread = threading.Thread(target=reminders.run_blocking, args=(reminders_stop,), daemon=True)
+        reminders_thread.start()
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    last_flush = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while stop is None or not stop.is_set():
+            if time.monotonic() - last_flush >= TALLY_FLUSH_SECONDS:
+                tally_counter.flush()
+                last_flush = time.monotonic()
+            events = queue.lease(owner, batch_size, lease_seconds)
+            if not events:
+                if stop is None:
+                    break
+                stop.wait(idle_sleep)
+                continue
+            # Leased events belong to distinct conversations, so they can run in parallel
+            list(pool.map(run, events))
+    heartbeat_stop.set()
+    heartbeat_thread.join()
+    tally_counter.flush()
+    if reminders_thread is not None:
+        reminders_stop.set()
+        reminders_thread.join()
+    if bus is not None:
+        bus.close()
+    return totals
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Durable inbound message queue.")
+    parser.add_argument("command", choices=["consume", "stats", "redrive"])
+    parser.add_argument("--queue", default=EVENT_QUEUE_PATH or "events.db", help="SQLite queue file")
+    parser.add_argument("--workers", type=int, default=4, help="events processed in parallel")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--lease-seconds", type=float, default=DEFAULT_LEASE_SECONDS)
+    parser.add_argument("--id", type=int, action="append", help="dead event to redrive (repeatable; default: all)")
+    args = parser.parse_args(argv)
+    queue = EventQueue(args.queue)
+
+    if args.command == "stats":
+        print(json.dumps(queue.stats(), indent=2))
+        return 0
+    if args.command == "redrive":
+        print(f"{queue.redrive(args.id)} eventos devolvidos à fila", file=sys.stderr)
+        return 0
+    configure_logging()
+    from reminders import REMINDER_AFTER_MINUTES, ReminderScheduler
+    reminders = ReminderScheduler(REMINDER_AFTER_MINUTES * 60) if REMINDER_AFTER_MINUTES > 0 else None
+    stop = threading.Event()
+    try:
+        consume(queue, workers=args.workers, batch_size=args.batch_size,
+                lease_seconds=args.lease_seconds, stop=stop, reminders=reminders)
+    except KeyboardInterrupt:
+        stop.set()
+        if reminders is not None:
+            reminders.snapshot()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
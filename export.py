@@ -0,0 +1,157 @@
+"""Streaming export of a campaign's sessions as CSV or NDJSON.
+
+Rows come from whatsapp_user_states in keyset pages, with the next page
+fetched while the current one is written out, followed by the sessions
+archive_states.py moved out: the archive table (EXPORT_ARCHIVE_TABLE, paged
+by EXPORT_ARCHIVE_KEY) and/or the archive files (EXPORT_ARCHIVE_DIR), or
+--archive-table / --archive-dir on the command line. Archived rows are
+marked in the "archived" column. Each page is formatted into
+a single chunk and dropped, so memory stays at about two pages whatever the
+size of the campaign. The CSV header is produced before the first query.
+
+Answers are flattened into one column per question, in the compiled flow's
+order. Compact answers are decoded to option texts. Answers to questions no
+longer in the flow are left out.
+
+Usage:
+    python export.py --campaign-id abc > respostas.csv
+    python export.py --campaign-id abc --format ndjson > respostas.ndjson
+    python export.py --campaign-id abc --archive-table whatsapp_user_states_archive > respostas.csv
+"""
+import io
+import os
+import sys
+import csv
+import json
+import logging
+import argparse
+from typing import Dict, Any, Iterable, Iterator, List, Optional
+
+from flow_model import Flow
+from state_codec import decode_answers
+
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+DEFAULT_PAGE_SIZE = 1000
+FIXED_COLUMNS = ["phone", "current_step", "completed", "archived"]
+EXPORT_ARCHIVE_TABLE = os.getenv("EXPORT_ARCHIVE_TABLE", "")
+EXPORT_ARCHIVE_KEY = os.getenv("EXPORT_ARCHIVE_KEY", "id")
+EXPORT_ARCHIVE_DIR = os.getenv("EXPORT_ARCHIVE_DIR", "")
+
+def log_event(message: str, data: Dict = {}):
+    log_entry = {'message': message, 'data': data}
+    logging.info(json.dumps(log_entry, ensure_ascii=False))
+
+def question_columns(flow: Flow) -> List[str]:
+    """Question ids in flow order, each once."""
+    return [q.id for i, q in enumerate(flow.questions) if flow.index[q.id] == i]
+
+def flatten(row: Dict, flow: Flow, questions: List[str], archived: bool = False) -> Dict[str, Any]:
+    answers = row.get("answers") or {}
+    if isinstance(answers, str):
+        answers = json.loads(answers)
+    answers = decode_answers(answers, flow)
+    flat = {
+        "phone": row.get("phone"),
+        "current_step": row.get("current_step"),
+        "completed": row.get("current_step") is None and bool(answers),
+        "archived": archived,
+    }
+    for question_id in questions:
+        flat[question_id] = answers.get(question_id)
+    return flat
+
+def _cell(value: Any) -> Any:
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+def csv_chunks(flow: Flow, pages: Iterable[tuple]) -> Iterator[str]:
+    """`pages` yields (archived, rows)."""
+    questions = question_columns(flow)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIXED_COLUMNS + questions)
+    yield buffer.getvalue()
+    for archived, page in pages:
+        buffer.seek(0)
+        buffer.truncate()
+        for row in page:
+            writer.writerow([_cell(value) for value in flatten(row, flow, questions, archived).values()])
+        yield buffer.getvalue()
+
+def ndjson_chunks(flow: Flow, pages: Iterable[tuple]) -> Iterator[str]:
+    questions = question_columns(flow)
+    for archived, page in pages:
+        yield "".join(json.dumps(flatten(row, flow, questions, archived), ensure_ascii=False) + "\n"
+                      for row in page)
+
+def session_pages(campaign_id: str, page_size: int = DEFAULT_PAGE_SIZE, archive_table: Optional[str] = None,
+                  archive_key: str = "id", archive_dir: Optional[str] = None) -> Iterator[tuple]:
+    """(archived, rows) pages of a campaign's live sessions, then its archived ones."""
+    from analytics import iter_archive_files
+    from supabase_client import iter_pages
+
+    filters = {"campaign_id": f"eq.{campaign_id}"}
+    for page in iter_pages("whatsapp_user_states", "phone,current_step,answers", "phone", page_size,
+                           filters=filters, prefetch=1):
+        yield False, page
+    if archive_table:
+        # Archived sessions repeat phones, so they are paged by the table's own unique key
+        columns = ",".join(dict.fromkeys([archive_key, "phone", "current_step", "answers"]))
+        for page in iter_pages(archive_table, columns, archive_key, page_size, filters=filters, prefetch=1):
+            yield True, page
+    if archive_dir:
+        for page in iter_archive_files(archive_dir, campaign_id, page_size):
+            yield True, page
+
+def export_stream(campaign: Dict, fmt: str = "csv", page_size: int = DEFAULT_PAGE_SIZE,
+                  archive_table: Optional[str] = EXPORT_ARCHIVE_TABLE, archive_key: str = EXPORT_ARCHIVE_KEY,
+                  archive_dir: Optional[str] = EXPORT_ARCHIVE_DIR) -> Iterator[bytes]:
+    """Encoded chunks of a campaign's export; the first one needs no query."""
+    from flow_compiler import get_compiled_flow
+
+    campaign_id = campaign["campaign_id"]
+    flow = get_compiled_flow(campaign)
+    pages = session_pages(campaign_id, page_size, archive_table, archive_key, archive_dir)
+    chunks = csv_chunks(flow, pages) if fmt == "csv" else ndjson_chunks(flow, pages)
+    exported = 0
+    try:
+        for chunk in chunks:
+            exported += 1
+            yield chunk.encode("utf-8")
+    except Exception as e:
+        # The status line is already sent; the truncated body is all the client can get
+        log_event("Erro durante exportação", {"campaign_id": campaign_id, "chunks": exported, "error": str(e)})
+        raise
+    log_event("Exportação concluída", {"campaign_id": campaign_id, "format": fmt, "chunks": exported})
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Export a campaign's sessions to stdout.")
+    parser.add_argument("--campaign-id", required=True)
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="csv")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument("--archive-table", default=EXPORT_ARCHIVE_TABLE,
+                        help="also export sessions archived to this table")
+    parser.add_argument("--archive-key", default=EXPORT_ARCHIVE_KEY, help="unique column to page the archive table by")
+    parser.add_argument("--archive-dir", default=EXPORT_ARCHIVE_DIR, help="also export archive_states.py NDJSON files")
+    args = parser.parse_args(argv)
+
+    from log_config import configure_logging
+    from supabase_client import get_campaign
+    configure_logging("supabase.log")
+    campaign = get_campaign(args.campaign_id)
+    if not campaign:
+        print(f"{args.campaign_id}: campanha não encontrada", file=sys.stderr)
+        return 1
+    for chunk in export_stream(campaign, args.format, args.page_size, args.archive_table, args.archive_key,
+                               args.archive_dir):
+        sys.stdout.buffer.write(chunk)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
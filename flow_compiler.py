@@ -0,0 +1,350 @@
+import os
+import sys
+import json
+import re
+import hashlib
+import logging
+import argparse
+from typing import Dict, Any, List, Optional
+
+from text_utils import normalize_text
+from flow_model import Flow
+from conditions import ConditionError, is_expression, parse, references
+from log_config import configure_logging
+
+# Bump whenever the artifact layout or the normalization rules change; older
+# artifacts are then ignored and recompiled.
+FLOW_ARTIFACT_VERSION = 3
+FLOW_ARTIFACT_DIR = os.getenv("FLOW_ARTIFACT_DIR", "compiled_flows")
+CHOICE_TYPES = ("quick_reply", "multiple_choice")
+TEXT_TYPES = ("text", "open_text")
+MAX_CACHED_FLOWS = 1024
+
+# Compiled flows by (campaign_id, source_hash)
+_compiled_cache: Dict[tuple, Flow] = {}
+# The last row object seen per campaign and its flow. CampaignCache hands out
+# the same row until the campaign changes, so a repeat lookup skips source_hash.
+# Rows are never modified after they are fetched.
+_row_flows: Dict[str, tuple] = {}
+
+def log_event(message: str, data: Dict = {}):
+    log_entry = {'message': message, 'data': data}
+    logging.info(json.dumps(log_entry, ensure_ascii=False))
+
+def safe_json_load(data: Any) -> Dict:
+    """Safely loads JSON data, handling strings and invalid JSON."""
+    if isinstance(data, str):
+        try:
+            return json.loads(normalize_text(data))
+        except json.JSONDecodeError:
+            return {}
+    return data or {}
+
+def source_hash(campaign: Dict) -> str:
+    """Fingerprints the raw questions_json/flow_json of a campaign row."""
+    digest = hashlib.sha1()
+    for key in ("questions_json", "flow_json"):
+        value = campaign.get(key)
+        if not isinstance(value, str):
+            value = json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        digest.update(value.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+def determine_survey_type(campaign: Dict) -> str:
+    """Determines the survey type based on campaign data."""
+    questions_json = safe_json_load(campaign.get("questions_json", {}))
+    flow_json = safe_json_load(campaign.get("flow_json", {}))
+    return questions_json.get("type", flow_json.get("type", "standard")).lower()
+
+def flow_outro(campaign: Dict) -> Optional[str]:
+    """The closing message, taken from the same source as the questions.
+
+    On the flow_json path, questions_json's outro still applies when flow_json has none.
+    """
+    questions_json = safe_json_load(campaign.get("questions_json", {}))
+    if not questions_json.get("questions"):
+        flow_json = safe_json_load(campaign.get("flow_json", {}))
+        if "outro" in flow_json:
+            return flow_json["outro"]
+    return questions_json.get("outro")
+
+def normalize_questions(campaign: Dict) -> List[Dict]:
+    """Loads and normalizes questions from campaign data."""
+    questions_json = safe_json_load(campaign.get("questions_json", {}))
+    flow_json = safe_json_load(campaign.get("flow_json", {}))
+    flow = questions_json if questions_json.get("questions") else flow_json
+    questions = []
+    for q in flow.get("questions", []):
+        safe_q = {
+            "id": normalize_text(str(q.get("id"))),
+            "text": normalize_text(q.get("text", "")),
+            "type": normalize_text(q.get("type", "text")),
+            "options": [
+                {
+                    "text": opt.get("text", str(opt)) if isinstance(opt, dict) else normalize_text(opt),
+                    "action": opt.get("action") if isinstance(opt, dict) else None,
+                    "target": opt.get("target") if isinstance(opt, dict) else None
+                } if isinstance(opt, dict) else {"text": normalize_text(opt)}
+                for opt in q.get("options", [])
+            ],
+            "condition": normalize_text(q["condition"]) if "condition" in q else None,
+            "message": normalize_text(q.get("message", "")) if "message" in q else None
+        }
+        questions.append(safe_q)
+    return questions
+
+def build_index(questions: List[Dict]) -> Dict[str, int]:
+    """Maps each question id to the position of its first occurrence."""
+    index = {}
+    for i, q in enumerate(questions):
+        index.setdefault(str(q["id"]), i)
+    return index
+
+def _successors(questions: List[Dict], index: Dict[str, int]) -> List[set]:
+    """Computes the transitions _get_next_question can take from each question."""
+    n = len(questions)
+    successors = [set() for _ in range(n)]
+    first_condition: Dict[str, int] = {}  # condition -> first later question having it
+    expressions: List[int] = []  # later questions with an expression condition; any may hold
+    next_plain = None  # first later question without a condition
+    for i in range(n - 1, -1, -1):
+        q = questions[i]
+        fallback = False
+        successors[i].update(expressions)
+        if q["type"] in CHOICE_TYPES and q.get("options"):
+            for opt in q["options"]:
+                target = opt.get("target")
+                if target and str(target) in index:
+                    successors[i].add(index[str(target)])
+                    continue
+                key = normalize_text(opt["text"]).lower()
+                if key in first_condition:
+                    successors[i].add(first_condition[key])
+                else:
+                    fallback = True
+        else:
+            # Free text can match any later condition, or none of them
+            successors[i].update(first_condition.values())
+            fallback = True
+        if fallback and next_plain is not None:
+            successors[i].add(next_plain)
+        if q.get("condition") and is_expression(q["condition"]):
+            expressions.append(i)
+        elif q.get("condition"):
+            first_condition[normalize_text(q["condition"]).lower()] = i
+        else:
+            next_plain = i
+    return successors
+
+def _find_cycles(successors: List[set], start: int, limit: int = 10) -> List[List[int]]:
+    """Returns up to `limit` cycles reachable from `start`, as lists of positions."""
+    cycles = []
+    state = {}  # position -> 1 while on the DFS stack, 2 when finished
+    path = []
+    stack = [(start, iter(sorted(successors[start])))]
+    state[start] = 1
+    path.append(start)
+    while stack and len(cycles) < limit:
+        node, children = stack[-1]
+        child = next(children, None)
+        if child is None:
+            state[node] = 2
+            path.pop()
+            stack.pop()
+        elif state.get(child) == 1:
+            cycles.append(path[path.index(child):] + [child])
+        elif child not in state:
+            state[child] = 1
+            path.append(child)
+            stack.append((child, iter(sorted(successors[child]))))
+    return cycles
+
+_CONDITION_OPERATOR = re.compile(r"==|!=|<=|>=|\banswered\s*\(|\bin\s*\[")
+
+def validate_flow(questions: List[Dict]) -> List[Dict]:
+    """Checks a normalized flow for structural problems.
+
+    Returns a list of issues, each {"level", "code", "question_id", "detail"}.
+    Errors break users at runtime; warnings are suspicious but may be intended.
+    """
+    issues = []
+
+    def issue(level, code, question_id, detail):
+        issues.append({"level": level, "code": code, "question_id": question_id, "detail": detail})
+
+    if not questions:
+        issue("error", "no_questions", None, "Flow has no questions")
+        return issues
+
+    index = build_index(questions)
+    seen = set()
+    for q in questions:
+        qid = str(q["id"])
+        if qid in seen:
+            issue("error", "duplicate_id", qid, "Question id used more than once; only the first is reachable by id")
+        seen.add(qid)
+        if q["type"] not in CHOICE_TYPES + TEXT_TYPES:
+            issue("warning", "unknown_type", qid, f"Type '{q['type']}' accepts no answer")
+        if q["type"] in CHOICE_TYPES and not q.get("options"):
+            issue("error", "no_options", qid, "Choice question without options")
+        for opt in q.get("options", []):
+            target = opt.get("target")
+            if target and str(target) not in index:
+                issue("error", "dangling_target", qid, f"Option '{opt['text']}' targets missing question '{target}'")
+        condition = q.get("condition")
+        if condition and is_expression(condition):
+            for ref in references(parse(condition)):
+                if ref not in index:
+                    issue("warning", "unknown_reference", qid, f"Condition reads missing question '{ref}'")
+        elif condition and _CONDITION_OPERATOR.search(condition):
+            # Looks like an expression but is matched as a plain answer text
+            try:
+                parse(condition)
+            except ConditionError as e:
+                issue("warning", "condition_syntax", qid, f"Condition is compared as text: {e}")
+
+    successors = _successors(questions, index)
+    reachable = {0}
+    frontier = [0]
+    while frontier:
+        for nxt in successors[frontier.pop()]:
+            if nxt not in reachable:
+                reachable.add(nxt)
+                frontier.append(nxt)
+    for i, q in enumerate(questions):
+        if i not in reachable:
+            issue("warning", "unreachable", str(q["id"]), "No path from the first question reaches this question")
+
+    for cycle in _find_cycles(successors, 0):
+        ids = [str(questions[i]["id"]) for i in cycle]
+        issue("warning", "cycle", ids[0], "Flow can loop: " + " -> ".join(ids))
+    return issues
+
+def compile_campaign(campaign: Dict) -> Dict:
+    """Compiles a campaign row into a versioned flow artifact."""
+    questions = normalize_questions(campaign)
+    artifact = {
+        "version": FLOW_ARTIFACT_VERSION,
+        "campaign_id": normalize_text(campaign.get("campaign_id")),
+        "source_hash": source_hash(campaign),
+        "survey_type": determine_survey_type(campaign),
+        "questions": questions,
+        "issues": validate_flow(questions),
+    }
+    outro = flow_outro(campaign)
+    if outro is not None:
+        artifact["outro"] = outro
+    return artifact
+
+def artifact_path(campaign_id: str, directory: str = None) -> str:
+    return os.path.join(directory or FLOW_ARTIFACT_DIR, f"{campaign_id}.json")
+
+def dump_artifact(artifact: Dict, path: str) -> None:
+    """Writes an artifact atomically in compact JSON."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(artifact, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+def prepare_artifact(artifact: Dict) -> Flow:
+    """Turns an artifact into the in-memory flow model the engine uses."""
+    return Flow.from_artifact(artifact)
+
+def load_artifact(path: str) -> Optional[Flow]:
+    """Loads an artifact from disk, or None if it is missing or from another version."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            artifact = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if artifact.get("version") != FLOW_ARTIFACT_VERSION:
+        return None
+    return prepare_artifact(artifact)
+
+def get_compiled_flow(campaign: Dict) -> Flow:
+    """Returns the compiled flow for a campaign row.
+
+    Looks in the process cache, then in FLOW_ARTIFACT_DIR, and compiles as a
+    last resort. Artifacts are only used while their source_hash matches the row.
+    The row itself is hashed once; the same row object again is a dict lookup.
+    """
+    campaign_id = normalize_text(campaign.get("campaign_id"))
+    seen = _row_flows.get(campaign_id)
+    if seen is not None and seen[0] is campaign:
+        return seen[1]
+    key = (campaign_id, source_hash(campaign))
+    flow = _compiled_cache.get(key)
+    if flow is None:
+        flow = load_artifact(artifact_path(campaign_id)) if campaign_id else None
+        if flow is None or flow.source_hash != key[1]:
+            flow = prepare_artifact(compile_campaign(campaign))
+            errors = [i for i in flow.issues if i["level"] == "error"]
+            if errors:
+                log_event("Flow compiled with errors", {"campaign_id": campaign_id, "issues": errors})
+        remember_flow(flow)
+    if campaign_id not in _row_flows and len(_row_flows) >= MAX_CACHED_FLOWS:
+        _row_flows.pop(next(iter(_row_flows)), None)
+    _row_flows[campaign_id] = (campaign, flow)
+    return flow
+
+def remember_flow(flow: Flow) -> None:
+    """Puts a prepared flow in the process cache, e.g. one read from a snapshot."""
+    key = (flow.campaign_id, flow.source_hash)
+    if key not in _compiled_cache and len(_compiled_cache) >= MAX_CACHED_FLOWS:
+        _compiled_cache.pop(next(iter(_compiled_cache)))
+    _compiled_cache[key] = flow
+
+def load_campaign_file(path: str) -> Dict:
+    """Reads a campaign row (or a bare flow) exported as JSON."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = data[0] if data else {}
+    if "questions" in data:
+        # A bare flow rather than an iap_campaigns row
+        data = {"flow_json": data}
+    data.setdefault("campaign_id", os.path.splitext(os.path.basename(path))[0])
+    return data
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Validate and compile campaign flows.")
+    parser.add_argument("--campaign-id", action="append", default=[], help="campaign to fetch from Supabase (repeatable)")
+    parser.add_argument("--file", action="append", default=[], help="campaign row or flow JSON file (repeatable)")
+    parser.add_argument("--out-dir", default=FLOW_ARTIFACT_DIR, help=f"artifact directory (default: {FLOW_ARTIFACT_DIR})")
+    parser.add_argument("--check", action="store_true", help="only validate, do not write artifacts")
+    parser.add_argument("--strict", action="store_true", help="treat warnings as errors")
+    args = parser.parse_args(argv)
+    configure_logging("supabase.log")
+    if not args.campaign_id and not args.file:
+        parser.error("informe --campaign-id ou --file")
+
+    campaigns = [load_campaign_file(path) for path in args.file]
+    if args.campaign_id:
+        from supabase_client import get_campaign
+        for campaign_id in args.campaign_id:
+            campaign = get_campaign(campaign_id)
+            if not campaign:
+                print(f"{campaign_id}: campanha não encontrada", file=sys.stderr)
+                return 1
+            campaigns.append(campaign)
+
+    failed = False
+    for campaign in campaigns:
+        artifact = compile_campaign(campaign)
+        campaign_id = artifact["campaign_id"]
+        blocking = [i for i in artifact["issues"] if i["level"] == "error" or args.strict]
+        for i in artifact["issues"]:
+            print(f"{campaign_id}: {i['level']}: {i['code']} [{i['question_id']}] {i['detail']}", file=sys.stderr)
+        if blocking:
+            failed = True
+            continue
+        if not args.check:
+            path = artifact_path(campaign_id, args.out_dir)
+            dump_artifact(artifact, path)
+            print(f"{campaign_id}: {len(artifact['questions'])} perguntas -> {path}", file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
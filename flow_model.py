@@ -0,0 +1,159 @@
+"""Compact in-memory model of a compiled flow.
+
+Compiled artifacts are plain JSON (see flow_compiler); at load time they are
+turned into these slotted, immutable objects. Compared with a dict per
+question and per option, this takes a fraction of the memory, and hot paths
+read attributes instead of doing string-keyed lookups. Identifiers, types
+and option texts are interned, so the "Sim"/"Não" options of thousands of
+campaigns share one string each. Question types become integer codes.
+"""
+import sys
+from typing import Dict, Any, List, Optional, Tuple
+
+from text_utils import normalize_text
+from conditions import FlowConditions, is_expression
+
+UNKNOWN, QUICK_REPLY, MULTIPLE_CHOICE, TEXT, OPEN_TEXT = range(5)
+TYPE_CODES = {"quick_reply": QUICK_REPLY, "multiple_choice": MULTIPLE_CHOICE, "text": TEXT, "open_text": OPEN_TEXT}
+CHOICE_CODES = (QUICK_REPLY, MULTIPLE_CHOICE)
+TEXT_CODES = (TEXT, OPEN_TEXT)
+
+def _intern(value: Any) -> Any:
+    return sys.intern(value) if isinstance(value, str) else value
+
+class _Frozen:
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+class Option(_Frozen):
+    """A choice option; `key` is its lower-cased text, used to match answers."""
+    __slots__ = ("text", "key", "action", "target")
+
+    def __init__(self, text: Any, action: Optional[str] = None, target: Optional[str] = None):
+        text = _intern(text if isinstance(text, str) else str(text))
+        key = text.lower()
+        setattr_ = object.__setattr__
+        setattr_(self, "text", text)
+        setattr_(self, "key", text if key == text else sys.intern(key))
+        setattr_(self, "action", _intern(action))
+        setattr_(self, "target", _intern(target))
+
+class Question(_Frozen):
+    """A normalized question.
+
+    `condition_key` is a legacy text condition as answers are compared to it;
+    it is None when there is no condition or the condition is an expression.
+    """
+    __slots__ = ("id", "text", "type", "code", "options", "condition", "condition_key", "message")
+
+    def __init__(self, id: str, text: str, type: str, options: Tuple[Option, ...] = (),
+                 condition: Optional[str] = None, message: Optional[str] = None):
+        setattr_ = object.__setattr__
+        setattr_(self, "id", sys.intern(id))
+        setattr_(self, "text", text)
+        setattr_(self, "type", sys.intern(type))
+        setattr_(self, "code", TYPE_CODES.get(type, UNKNOWN))
+        setattr_(self, "options", options)
+        setattr_(self, "condition", condition)
+        legacy = condition and not is_expression(condition)
+        setattr_(self, "condition_key", sys.intern(normalize_text(condition).lower()) if legacy else None)
+        setattr_(self, "message", message)
+
+    @property
+    def is_choice(self) -> bool:
+        return self.code in CHOICE_CODES
+
+    @property
+    def is_text(self) -> bool:
+        return self.code in TEXT_CODES
+
+    @classmethod
+    def from_dict(cls, q: Dict[str, Any]) -> "Question":
+        options = tuple(Option(opt["text"], opt.get("action"), opt.get("target")) for opt in q.get("options", []))
+        return cls(str(q["id"]), q.get("text", ""), q.get("type", "text"), options, q.get("condition"), q.get("message"))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "text": self.text,
+            "type": self.type,
+            "options": [{"text": opt.text, "action": opt.action, "target": opt.target} for opt in self.options],
+            "condition": self.condition,
+            "message": self.message,
+        }
+
+class Flow(_Frozen):
+    """A compiled flow: its questions, an id -> position index and the artifact metadata."""
+    __slots__ = ("version", "campaign_id", "source_hash", "survey_type", "questions", "index",
+                 "outro", "issues", "_option_codes", "_conditions")
+
+    def __init__(self, version: int, campaign_id: str, source_hash: str, survey_type: str,
+                 questions: Tuple[Question, ...], outro: Optional[str] = None, issues: List[Dict] = ()):
+        index = {}
+        for i, q in enumerate(questions):
+            index.setdefault(q.id, i)
+        setattr_ = object.__setattr__
+        setattr_(self, "version", version)
+        setattr_(self, "campaign_id", _intern(campaign_id))
+        setattr_(self, "source_hash", source_hash)
+        setattr_(self, "survey_type", sys.intern(survey_type))
+        setattr_(self, "questions", questions)
+        setattr_(self, "index", index)
+        setattr_(self, "outro", outro)
+        setattr_(self, "issues", list(issues))
+        setattr_(self, "_option_codes", None)
+        setattr_(self, "_conditions", None)
+
+    def find(self, question_id: Any) -> Optional[Question]:
+        position = self.index.get(str(question_id))
+        return self.questions[position] if position is not None else None
+
+    def option_codes(self) -> Dict[str, Dict[str, int]]:
+        """Per choice question, option text -> index of its first option with that text.
+
+        Built on first use only, since only compact answer encoding needs it.
+        """
+        codes = self._option_codes
+        if codes is None:
+            codes = {}
+            for q in self.questions:
+                if q.is_choice and q.options and q.id not in codes:
+                    by_text = {}
+                    for i, opt in enumerate(q.options):
+                        by_text.setdefault(opt.text, i)
+                    codes[q.id] = by_text
+            object.__setattr__(self, "_option_codes", codes)
+        return codes
+
+    def conditions(self) -> FlowConditions:
+        """The flow's branching conditions, compiled on first use."""
+        conditions = self._conditions
+        if conditions is None:
+            conditions = FlowConditions(self.questions)
+            object.__setattr__(self, "_conditions", conditions)
+        return conditions
+
+    @classmethod
+    def from_artifact(cls, artifact: Dict[str, Any]) -> "Flow":
+        questions = tuple(Question.from_dict(q) for q in artifact["questions"])
+        return cls(artifact.get("version"), artifact.get("campaign_id"), artifact.get("source_hash"),
+                   artifact.get("survey_type", "standard"), questions, artifact.get("outro"),
+                   artifact.get("issues", []))
+
+    def to_artifact(self) -> Dict[str, Any]:
+        artifact = {
+            "version": self.version,
+            "campaign_id": self.campaign_id,
+            "source_hash": self.source_hash,
+            "survey_type": self.survey_type,
+            "questions": [q.to_dict() for q in self.questions],
+            "issues": self.issues,
+        }
+        if self.outro is not None:
+            artifact["outro"] = self.outro
+        return artifact
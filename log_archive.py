@@ -0,0 +1,402 @@
+"""Columnar archive of closed log segments and a query tool over it.
+
+The service keeps logging to plain files exactly as before. Once a segment
+is closed, e.g. engine.log.1 after logrotate (use `copytruncate`, since the
+handlers keep their file open), `roll` converts it into compressed chunk
+files of at most CHUNK_ROWS lines:
+
+    b"FLOWLOG1" | u32 header length | header JSON | column blobs
+
+Every line becomes one row with the columns ts (epoch ms), level, message,
+phone and campaign_id, taken from the JSON that log_event writes. Lines
+that are not log_event records (tracebacks, uvicorn output) keep the
+previous row's timestamp and empty fields. String columns are dictionary
+encoded into uint32 codes. The raw lines are zlib-compressed in blocks of
+BLOCK_ROWS, so a query only inflates the blocks that hold matching rows.
+
+catalog.db (SQLite) maps every phone, campaign_id and message to the
+chunks that contain it and stores each chunk's time range. A query
+therefore opens only the chunks that can match.
+
+Usage:
+    python log_archive.py roll --log-dir /home/flow_engine --archive-dir /var/lib/flow_engine/logs
+    python log_archive.py query --phone 5511999999999 --campaign-id abc
+    python log_archive.py query --message "Failed to save" --since 1h
+"""
+import os
+import re
+import sys
+import json
+import gzip
+import time
+import zlib
+import glob
+import struct
+import sqlite3
+import hashlib
+import argparse
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from log_config import LOG_DIR
+
+LOG_ARCHIVE_DIR = os.getenv("LOG_ARCHIVE_DIR", os.path.join(LOG_DIR, "archive"))
+LOG_SOURCES = ("engine", "petition", "app", "supabase")
+CHUNK_MAGIC = b"FLOWLOG1"
+_HEADER = struct.Struct("<8sI")
+CHUNK_ROWS = 100_000
+BLOCK_ROWS = 2048
+DICT_COLUMNS = ("level", "message", "phone", "campaign_id")
+INDEXED_COLUMNS = ("message", "phone", "campaign_id")
+DEFAULT_MIN_AGE = 300  # seconds a rotated segment must be untouched before it is archived
+
+_LINE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - ([A-Z]+) - (.*)$")
+
+CATALOG_SCHEMA = """
+create table if not exists chunks (
+    id integer primary key,
+    path text not null unique,
+    source text not null,
+    segment text not null,
+    min_ts integer not null,
+    max_ts integer not null,
+    rows integer not null
+);
+create index if not exists chunks_time on chunks (min_ts, max_ts);
+create table if not exists chunk_keys (
+    kind text not null,
+    value text not null,
+    chunk_id integer not null,
+    primary key (kind, value, chunk_id)
+) without rowid;
+create table if not exists segments (
+    path text primary key,
+    size integer not null,
+    mtime real not null,
+    archived_at real not null
+);
+"""
+
+@lru_cache(maxsize=4096)
+def _epoch_ms(stamp: str) -> int:
+    # Consecutive lines mostly share their second, so this rarely parses
+    return int(time.mktime(time.strptime(stamp, "%Y-%m-%d %H:%M:%S"))) * 1000
+
+def parse_line(line: str, last_ts: int) -> Tuple[int, str, str, str, str]:
+    """(ts ms, level, message, phone, campaign_id) of one log line."""
+    match = _LINE.match(line)
+    if not match:
+        return last_ts, "", "", "", ""
+    stamp, millis, level, text = match.groups()
+    ts = _epoch_ms(stamp) + int(millis)
+    message = phone = campaign_id = ""
+    if text.startswith("{"):
+        try:
+            record = json.loads(text)
+        except json.JSONDecodeError:
+            record = None
+        if isinstance(record, dict):
+            message = str(record.get("message") or "")
+            data = record.get("data")
+            if isinstance(data, dict):
+                phone = str(data.get("phone") or "")
+                campaign_id = str(data.get("campaign_id") or "")
+    return ts, level, message, phone, campaign_id
+
+def _encode_strings(values: List[str]) -> Tuple[List[str], np.ndarray]:
+    """Dictionary encoding: (distinct values, uint32 code per row)."""
+    dictionary: Dict[str, int] = {}
+    codes = np.fromiter((dictionary.setdefault(v, len(dictionary)) for v in values),
+                        dtype=np.uint32, count=len(values))
+    return list(dictionary), codes
+
+class _ChunkWriter:
+    def __init__(self):
+        self.blobs: List[bytes] = []
+        self.size = 0
+
+    def add(self, data: bytes) -> List[int]:
+        blob = zlib.compress(data, 6)
+        self.blobs.append(blob)
+        location = [self.size, len(blob)]
+        self.size += len(blob)
+        return location
+
+def write_chunk(path: str, lines: List[str], rows: List[Tuple[int, str, str, str, str]]) -> Tuple[Dict, Dict]:
+    """Writes one chunk atomically; returns its header and the distinct values of each column."""
+    writer = _ChunkWriter()
+    ts = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    header: Dict[str, Any] = {"rows": len(rows), "min_ts": int(ts.min()), "max_ts": int(ts.max()),
+                              "columns": {"ts": writer.add(ts.tobytes())}, "dicts": {}, "blocks": []}
+    distinct = {}
+    for position, name in enumerate(DICT_COLUMNS, start=1):
+        values, codes = _encode_strings([row[position] for row in rows])
+        distinct[name] = values
+        header["columns"][name] = writer.add(codes.tobytes())
+        header["dicts"][name] = writer.add(json.dumps(values, ensure_ascii=False).encode("utf-8"))
+    for start in range(0, len(lines), BLOCK_ROWS):
+        header["blocks"].append(writer.add("\n".join(lines[start:start + BLOCK_ROWS]).encode("utf-8")))
+    header_data = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(CHUNK_MAGIC, len(header_data)))
+        f.write(header_data)
+        for blob in writer.blobs:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return header, distinct
+
+class Chunk:
+    """Lazy reader of one chunk file; columns are inflated on first use."""
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.data = f.read()
+        magic, header_length = _HEADER.unpack_from(self.data, 0)
+        if magic != CHUNK_MAGIC:
+            raise ValueError(f"chunk inválido: {path}")
+        self.header = json.loads(self.data[_HEADER.size:_HEADER.size + header_length])
+        self.base = _HEADER.size + header_length
+        self._cache: Dict[str, Any] = {}
+
+    def _blob(self, location: List[int]) -> bytes:
+        offset, length = location
+        return zlib.decompress(self.data[self.base + offset:self.base + offset + length])
+
+    def column(self, name: str) -> np.ndarray:
+        if name not in self._cache:
+            dtype = np.int64 if name == "ts" else np.uint32
+            self._cache[name] = np.frombuffer(self._blob(self.header["columns"][name]), dtype=dtype)
+        return self._cache[name]
+
+    def dictionary(self, name: str) -> List[str]:
+        key = f"dict:{name}"
+        if key not in self._cache:
+            self._cache[key] = json.loads(self._blob(self.header["dicts"][name]))
+        return self._cache[key]
+
+    def lines(self, rows: np.ndarray) -> List[str]:
+        """Raw lines of the given (sorted) rows, inflating only their blocks."""
+        result = []
+        block_lines: List[str] = []
+        current_block = -1
+        for row in rows.tolist():
+            block = row // BLOCK_ROWS
+            if block != current_block:
+                block_lines = self._blob(self.header["blocks"][block]).decode("utf-8").split("\n")
+                current_block = block
+            result.append(block_lines[row - block * BLOCK_ROWS])
+        return result
+
+class Catalog:
+    def __init__(self, archive_dir: str = LOG_ARCHIVE_DIR):
+        os.makedirs(archive_dir, exist_ok=True)
+        self.archive_dir = archive_dir
+        self.db = sqlite3.connect(os.path.join(archive_dir, "catalog.db"), isolation_level=None)
+        self.db.execute("pragma journal_mode=wal")
+        self.db.executescript(CATALOG_SCHEMA)
+
+    def archived(self, path: str, size: int, mtime: float) -> bool:
+        row = self.db.execute("select size, mtime from segments where path = ?", (path,)).fetchone()
+        return row is not None and row[0] == size and row[1] == mtime
+
+    def add_segment(self, path: str, size: int, mtime: float, chunks: List[Tuple[str, str, Dict, Dict]]) -> None:
+        """Registers the chunks of one segment, replacing an earlier run over it."""
+        self.db.execute("begin immediate")
+        try:
+            for chunk_path, source, header, distinct in chunks:
+                self.db.execute("delete from chunk_keys where chunk_id in (select id from chunks where path = ?)",
+                                (chunk_path,))
+                self.db.execute("delete from chunks where path = ?", (chunk_path,))
+                chunk_id = self.db.execute(
+                    "insert into chunks (path, source, segment, min_ts, max_ts, rows) values (?, ?, ?, ?, ?, ?)",
+                    (chunk_path, source, path, header["min_ts"], header["max_ts"], header["rows"])
+                ).lastrowid
+                self.db.executemany(
+                    "insert or ignore into chunk_keys (kind, value, chunk_id) values (?, ?, ?)",
+                    [(kind, value, chunk_id) for kind in INDEXED_COLUMNS for value in distinct[kind] if value]
+                )
+            self.db.execute("insert or replace into segments (path, size, mtime, archived_at) values (?, ?, ?, ?)",
+                            (path, size, mtime, time.time()))
+            self.db.execute("commit")
+        except Exception:
+            self.db.execute("rollback")
+            raise
+
+    def candidates(self, filters: Dict[str, str], message_like: Optional[str], since: Optional[int],
+                   until: Optional[int], source: Optional[str]) -> List[str]:
+        """Chunk paths that can hold matching rows, oldest first."""
+        where, params = [], []
+        for kind, value in filters.items():
+            where.append("id in (select chunk_id from chunk_keys where kind = ? and value = ?)")
+            params += [kind, value]
+        if message_like:
+            where.append("id in (select chunk_id from chunk_keys where kind = 'message' and value like ?)")
+            params.append(f"%{message_like}%")
+        if since is not None:
+            where.append("max_ts >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("min_ts < ?")
+            params.append(until)
+        if source:
+            where.append("source = ?")
+            params.append(source)
+        sql = "select path from chunks" + (" where " + " and ".join(where) if where else "") + " order by min_ts, id"
+        return [os.path.join(self.archive_dir, path) for (path,) in self.db.execute(sql, params)]
+
+def _read_segment(path: str) -> Iterator[str]:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            yield line.rstrip("\n")
+
+def closed_segments(log_dir: str, min_age: float = DEFAULT_MIN_AGE) -> List[Tuple[str, str]]:
+    """(source, path) of rotated log files untouched for at least `min_age` seconds."""
+    now = time.time()
+    segments = []
+    for source in LOG_SOURCES:
+        for path in sorted(glob.glob(os.path.join(log_dir, f"{source}.log[.-]*"))):
+            if path.endswith(".tmp") or now - os.path.getmtime(path) < min_age:
+                continue
+            segments.append((source, path))
+    return segments
+
+def archive_segment(catalog: Catalog, source: str, path: str, chunk_rows: int = CHUNK_ROWS) -> int:
+    """Converts one closed segment into chunks; returns the number of rows."""
+    stat = os.stat(path)
+    tag = hashlib.sha1(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime}".encode()).hexdigest()[:12]
+    chunks = []
+    lines: List[str] = []
+    rows: List[Tuple[int, str, str, str, str]] = []
+    last_ts = 0  # lines before the first record have no time of their own
+    total = 0
+
+    def flush() -> None:
+        name = f"{source}-{tag}-{len(chunks):04d}.chunk"
+        header, distinct = write_chunk(os.path.join(catalog.archive_dir, name), lines, rows)
+        chunks.append((name, source, header, distinct))
+        lines.clear()
+        rows.clear()
+
+    for line in _read_segment(path):
+        row = parse_line(line, last_ts)
+        last_ts = row[0]
+        lines.append(line)
+        rows.append(row)
+        total += 1
+        if len(rows) >= chunk_rows:
+            flush()
+    if rows:
+        flush()
+    catalog.add_segment(os.path.abspath(path), stat.st_size, stat.st_mtime, chunks)
+    return total
+
+def roll(log_dir: str, archive_dir: str, min_age: float = DEFAULT_MIN_AGE, keep: bool = False) -> Dict[str, int]:
+    catalog = Catalog(archive_dir)
+    result = {"segments": 0, "rows": 0}
+    for source, path in closed_segments(log_dir, min_age):
+        stat = os.stat(path)
+        if not catalog.archived(os.path.abspath(path), stat.st_size, stat.st_mtime):
+            result["rows"] += archive_segment(catalog, source, path)
+            result["segments"] += 1
+        if not keep:
+            os.remove(path)
+    return result
+
+def query(archive_dir: str, phone: Optional[str] = None, campaign_id: Optional[str] = None,
+          message: Optional[str] = None, level: Optional[str] = None, since: Optional[int] = None,
+          until: Optional[int] = None, source: Optional[str] = None, limit: Optional[int] = None) -> Iterator[str]:
+    """Raw log lines matching every given filter, in time order per chunk."""
+    catalog = Catalog(archive_dir)
+    filters = {kind: value for kind, value in (("phone", phone), ("campaign_id", campaign_id)) if value}
+    emitted = 0
+    for path in catalog.candidates(filters, message, since, until, source):
+        chunk = Chunk(path)
+        mask = np.ones(chunk.header["rows"], dtype=bool)
+        for kind, value in filters.items():
+            dictionary = chunk.dictionary(kind)
+            if value not in dictionary:
+                mask[:] = False
+                break
+            mask &= chunk.column(kind) == dictionary.index(value)
+        if mask.any() and message:
+            wanted = [code for code, text in enumerate(chunk.dictionary("message")) if message.lower() in text.lower()]
+            mask &= np.isin(chunk.column("message"), wanted)
+        if mask.any() and level:
+            dictionary = chunk.dictionary("level")
+            if level in dictionary:
+                mask &= chunk.column("level") == dictionary.index(level)
+            else:
+                mask[:] = False
+        if mask.any() and (since is not None or until is not None):
+            ts = chunk.column("ts")
+            if since is not None:
+                mask &= ts >= since
+            if until is not None:
+                mask &= ts < until
+        rows = np.flatnonzero(mask)
+        if limit is not None:
+            rows = rows[:limit - emitted]
+        for line in chunk.lines(rows):
+            yield line
+        emitted += len(rows)
+        if limit is not None and emitted >= limit:
+            return
+
+def parse_time(value: Optional[str]) -> Optional[int]:
+    """Epoch ms of an ISO time (local) or of a relative one such as 15m, 1h, 2d."""
+    if not value:
+        return None
+    match = re.fullmatch(r"(\d+)([smhd])", value)
+    if match:
+        seconds = int(match.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+        return int((time.time() - seconds) * 1000)
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Archive closed log segments and query them.")
+    parser.add_argument("command", choices=["roll", "query", "stats"])
+    parser.add_argument("--archive-dir", default=LOG_ARCHIVE_DIR, help=f"chunk directory (default: {LOG_ARCHIVE_DIR})")
+    parser.add_argument("--log-dir", default=LOG_DIR, help="directory of the rotated logs (roll)")
+    parser.add_argument("--min-age", type=float, default=DEFAULT_MIN_AGE, help="seconds since a segment's last write (roll)")
+    parser.add_argument("--keep", action="store_true", help="keep segments after archiving them (roll)")
+    parser.add_argument("--interval", type=float, help="roll again every N seconds")
+    parser.add_argument("--phone")
+    parser.add_argument("--campaign-id")
+    parser.add_argument("--message", help="event message substring, e.g. 'Failed to save'")
+    parser.add_argument("--level", help="e.g. ERROR")
+    parser.add_argument("--source", choices=LOG_SOURCES)
+    parser.add_argument("--since", help="ISO time or relative (15m, 1h, 2d)")
+    parser.add_argument("--until", help="ISO time or relative (15m, 1h, 2d)")
+    parser.add_argument("--limit", type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == "roll":
+        while True:
+            result = roll(args.log_dir, args.archive_dir, args.min_age, args.keep)
+            print(f"{result['segments']} segmentos arquivados ({result['rows']} linhas)", file=sys.stderr)
+            if not args.interval:
+                return 0
+            time.sleep(args.interval)
+    if args.command == "stats":
+        catalog = Catalog(args.archive_dir)
+        chunks, rows = catalog.db.execute("select count(*), coalesce(sum(rows), 0) from chunks").fetchone()
+        segments = catalog.db.execute("select count(*) from segments").fetchone()[0]
+        print(json.dumps({"segments": segments, "chunks": chunks, "rows": rows}, indent=2))
+        return 0
+    started = time.perf_counter()
+    count = 0
+    for line in query(args.archive_dir, args.phone, args.campaign_id, args.message, args.level,
+                      parse_time(args.since), parse_time(args.until), args.source, args.limit):
+        print(line)
+        count += 1
+    print(f"{count} linhas em {(time.perf_counter() - started) * 1000:.1f} ms", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,33 @@
+"""Logging setup for the service and the command-line tools.
+
+No module configures logging when it is imported; entry points call
+configure_logging() once. The service logs everything to engine.log and
+petition events additionally to petition.log, both in FLOW_ENGINE_LOG_DIR.
+"""
+import os
+import logging
+
+LOG_DIR = os.getenv("FLOW_ENGINE_LOG_DIR", "/home/flow_engine")
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+def configure_logging(filename: str = None, log_dir: str = None) -> None:
+    """Sends the root logger to `filename` (default: engine.log in the log
+    directory) and the petition logger to petition.log. Safe to call again."""
+    log_dir = log_dir or LOG_DIR
+    logging.basicConfig(
+        filename=filename or os.path.join(log_dir, 'engine.log'),
+        filemode='a',
+        level=logging.INFO,
+        format=LOG_FORMAT,
+        force=True,
+        encoding='utf-8'
+    )
+
+    petition_logger = logging.getLogger('petition')
+    for handler in list(petition_logger.handlers):
+        petition_logger.removeHandler(handler)
+        handler.close()
+    petition_handler = logging.FileHandler(os.path.join(log_dir, 'petition.log'), encoding='utf-8')
+    petition_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    petition_logger.addHandler(petition_handler)
+    petition_logger.setLevel(logging.INFO)
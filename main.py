@@ -1,15 +1,32 @@
-from fastapi import FastAPI, Request
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from engine import process_message
+from reminders import REMINDER_AFTER_MINUTES, ReminderScheduler
+from admission import ADMISSION_SLOTS, ADMISSION_MAX_QUEUE, ADMISSION_WEIGHTS, AdmissionController, Overloaded, parse_weights
+from concurrent.futures import ThreadPoolExecutor
+from log_config import configure_logging
+from campaign_cache import CampaignCache
+from cache_bus import CacheBus, connect, make_transport
+from state_cache import STATE_CACHE_SIZE, StateCache
+from event_queue import EVENT_QUEUE_PATH, EventQueue
+from flow_compiler import get_compiled_flow
+from tallies import campaign_tallies, tally_counter
+from rate_limit import RateLimiter
+from dedup import Deduplicator
+import resilience
+import tracing
+from export import EXPORT_FORMATS, export_stream
+from contextlib import contextmanager
+import asyncio
 import logging
+import hmac
 import json
+import time
+import os
 
-# Configurar logging estruturado
-logging.basicConfig(
-    filename='app.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Configurar logging estruturado (engine.log e petition.log em FLOW_ENGINE_LOG_DIR)
+configure_logging()
 
 def log_event(message, data={}):
     log_entry = {'message': message, 'data': data}
@@ -17,6 +34,130 @@ def log_event(message, data={}):
 
 app = FastAPI()
 
+# Rotas administrativas e a exportação de respostas exigem ADMIN_TOKEN (Authorization: Bearer <token> ou X-Admin-Token);
+# sem ADMIN_TOKEN definido elas ficam fechadas
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+def require_admin(request: Request) -> None:
+    """Shared guard of every admin route: the request must carry ADMIN_TOKEN."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=503, detail="Rotas administrativas desativadas (defina ADMIN_TOKEN)")
+    authorization = request.headers.get("authorization", "")
+    if authorization[:7].lower() == "bearer ":
+        token = authorization[7:].strip()
+    else:
+        token = request.headers.get("x-admin-token", "")
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Token de administração inválido")
+
+# Todas as rotas /admin/* passam por require_admin; incluídas no app ao final do módulo
+admin = APIRouter(prefix="/admin", dependencies=[Depends(require_admin)])
+
+BUSY_RESPONSE = {
+    "next_message": "⏳ Estamos recebendo muitas mensagens agora. Por favor, tente novamente em alguns instantes.",
+    "retry": True
+}
+
+# Fila justa por campanha; o engine roda em threads para não bloquear o event loop
+admission = AdmissionController(ADMISSION_SLOTS, ADMISSION_MAX_QUEUE, parse_weights(ADMISSION_WEIGHTS))
+engine_pool = ThreadPoolExecutor(max_workers=ADMISSION_SLOTS, thread_name_prefix="engine")
+
+# Invalidações entre workers (cache_bus.py); o cache de estados só é ligado com STATE_CACHE_SIZE
+cache_bus = CacheBus()
+state_cache = StateCache(bus=cache_bus, capacity=STATE_CACHE_SIZE) if STATE_CACHE_SIZE > 0 else None
+
+# Limite de mensagens por telefone e por campanha (RATE_LIMITS; desligado por padrão), verificado antes de qualquer I/O
+rate_limiter = RateLimiter()
+
+# Mensagens reentregues pela Meta (mesmo message_id) não passam pelo engine de novo
+deduplicator = Deduplicator()
+
+# Campanhas em memória, pré-carregadas do snapshot e revalidadas em segundo plano
+campaign_cache = CampaignCache(backend=state_cache)
+connect(cache_bus, campaign_cache, state_cache)
+
+def run_engine(phone: str, campaign_id: str, message: str, expires: float = None, parent=None):
+    # Every Supabase call of this message shares the deadline set when it arrived,
+    # and its trace; neither crosses into the thread pool on its own
+    with resilience.deadline_at(expires), tracing.activate(parent), tracing.span("engine"):
+        return asyncio.run(process_message(phone, campaign_id, message, campaign_cache))
+
+def request_deadline(request: Request) -> float:
+    """Deadline of a request: REQUEST_DEADLINE_SECONDS, or less if the caller sent X-Deadline-Ms."""
+    seconds = resilience.REQUEST_DEADLINE_SECONDS
+    header = request.headers.get("x-deadline-ms")
+    if header:
+        try:
+            seconds = min(seconds, max(0.0, float(header) / 1000))
+        except ValueError:
+            pass
+    return time.monotonic() + seconds
+
+@contextmanager
+def traced(request: Request, name: str):
+    """Root span of a request, continuing webhook.php's trace (traceparent header)."""
+    with tracing.start(name, request.headers.get("traceparent")):
+        started_ms = request.headers.get("x-webhook-started-ms")
+        if started_ms:
+            try:
+                # Time webhook.php spent before calling us, the hop included
+                tracing.record("webhook", time.time() - float(started_ms) / 1000)
+            except ValueError:
+                pass
+        yield
+
+async def claim_message(message_id: str):
+    """None if the message is new (settle it afterwards); otherwise the answer for the duplicate."""
+    duplicate = deduplicator.seen(message_id)
+    if duplicate is None:
+        if deduplicator.path:
+            duplicate = await asyncio.to_thread(deduplicator.claim, message_id)
+        else:
+            duplicate = deduplicator.claim(message_id)
+    return duplicate
+
+async def settle_message(message_id: str, handled: dict = None):
+    """Keeps the response the message was handled with for later duplicates,
+    or frees the id when nothing was handled (throttled, rejected, failed)."""
+    try:
+        if handled is None or handled.get("retry"):
+            await asyncio.to_thread(deduplicator.abandon, message_id)
+        else:
+            await asyncio.to_thread(deduplicator.finish, message_id, handled)
+    except Exception as e:
+        log_event("Erro ao registrar mensagem processada", {"message_id": message_id, "error": str(e)})
+
+# Modo fila: /enqueue grava a mensagem e consumidores (event_queue.py) respondem
+event_queue = EventQueue(EVENT_QUEUE_PATH) if EVENT_QUEUE_PATH else None
+
+# Lembretes para sessões abandonadas (desligados com REMINDER_AFTER_MINUTES=0)
+reminder_scheduler = ReminderScheduler(REMINDER_AFTER_MINUTES * 60) if REMINDER_AFTER_MINUTES > 0 else None
+background_stop = asyncio.Event()
+
+@app.on_event("startup")
+async def start_background():
+    snapshot_campaigns = campaign_cache.open_snapshot()
+    log_event("Snapshot de campanhas carregado", {"campaigns": snapshot_campaigns})
+    try:
+        cache_bus.start(make_transport())
+    except Exception as e:
+        log_event("Barramento de invalidação indisponível; caches apenas locais", {"error": str(e)})
+    asyncio.create_task(campaign_cache.run(background_stop))
+    asyncio.create_task(tally_counter.run(background_stop))
+    if reminder_scheduler:
+        restored = await asyncio.to_thread(reminder_scheduler.restore)
+        log_event("Agendador de lembretes iniciado", {"restored": restored})
+        asyncio.create_task(reminder_scheduler.run(background_stop))
+
+@app.on_event("shutdown")
+async def stop_background():
+    background_stop.set()
+    cache_bus.close()
+    await asyncio.to_thread(campaign_cache.save_snapshot)
+    await asyncio.to_thread(tally_counter.flush)
+    if reminder_scheduler:
+        await asyncio.to_thread(reminder_scheduler.snapshot)
+
 class ProcessRequest(BaseModel):
     phone: str
     campaign_id: str
@@ -24,6 +165,13 @@ class ProcessRequest(BaseModel):
 
 @app.post("/process")
 async def process(request: Request):
+    expires = request_deadline(request)
+    with traced(request, "process"):
+        return await process_request(request, expires)
+
+async def process_request(request: Request, expires: float):
+    message_id = None
+    handled = None  # the engine's response, once it ran
     try:
         body = await request.json()
         phone = body.get("phone")
@@ -32,9 +180,166 @@ async def process(request: Request):
         if not all([phone, campaign_id, message]):
             log_event("Parâmetros inválidos no corpo da requisição", body)
             return {"detail": "Parâmetros obrigatórios ausentes"}
-        response = await process_message(phone, campaign_id, message)
+        if body.get("message_id"):
+            duplicate = await claim_message(body["message_id"])
+            if duplicate:
+                log_event("Mensagem duplicada ignorada", {"phone": phone, "campaign_id": campaign_id, "message_id": body["message_id"]})
+                return duplicate
+            message_id = body["message_id"]
+        tracing.annotate(campaign_id=campaign_id, message_id=message_id)
+        throttled = rate_limiter.check(phone, campaign_id)
+        if throttled:
+            return throttled
+        waiting_since = time.perf_counter()
+        try:
+            async with admission.slot(campaign_id):
+                tracing.record("admission.wait", time.perf_counter() - waiting_since)
+                response = await asyncio.get_running_loop().run_in_executor(
+                    engine_pool, run_engine, phone, campaign_id, message, expires, tracing.current()
+                )
+        except Overloaded:
+            log_event("Fila da campanha cheia", {"phone": phone, "campaign_id": campaign_id})
+            return BUSY_RESPONSE
+        handled = response
+        if reminder_scheduler:
+            reminder_scheduler.touch(phone, campaign_id, bool(response.get("completed")))
         log_event("Mensagem processada com sucesso", {"phone": phone, "campaign_id": campaign_id, "response": response})
         return response
     except Exception as e:
         log_event("Erro ao processar requisição", {"error": str(e)})
-        return {"detail": f"Erro ao interpretar corpo da requisição: {str(e)}"}
\ No newline at end of file
+        return {"detail": f"Erro ao interpretar corpo da requisição: {str(e)}"}
+    finally:
+        if message_id:
+            await settle_message(message_id, handled)
+
+@admin.get("/admission")
+async def admission_stats():
+    return admission.snapshot()
+
+@admin.get("/backend")
+async def backend_stats():
+    return resilience.snapshot()
+
+@admin.get("/traces")
+async def traces(limit: int = 50, min_ms: float = 0, trace_id: str = None):
+    """Latest traces of this worker, newest first; only sampled requests are kept."""
+    return tracing.traces(limit, min_ms, trace_id)
+
+@admin.get("/dedup")
+async def dedup_stats():
+    return deduplicator.snapshot()
+
+@admin.get("/rate_limit")
+async def rate_limit_stats():
+    return rate_limiter.snapshot()
+
+@app.post("/enqueue")
+async def enqueue(request: Request):
+    if not event_queue:
+        return {"detail": "Fila de eventos desativada (defina EVENT_QUEUE_PATH)"}
+    with traced(request, "enqueue"):
+        return await enqueue_request(request)
+
+async def enqueue_request(request: Request):
+    message_id = None
+    handled = None  # set once the message is in the queue
+    try:
+        body = await request.json()
+        phone = body.get("phone")
+        campaign_id = body.get("campaign_id")
+        message = body.get("message")
+        if not all([phone, campaign_id, message]):
+            log_event("Parâmetros inválidos no corpo da requisição", body)
+            return {"detail": "Parâmetros obrigatórios ausentes"}
+        if body.get("message_id"):
+            duplicate = await claim_message(body["message_id"])
+            if duplicate:
+                log_event("Mensagem duplicada ignorada", {"phone": phone, "campaign_id": campaign_id, "message_id": body["message_id"]})
+                return duplicate
+            message_id = body["message_id"]
+        throttled = rate_limiter.check(phone, campaign_id)
+        if throttled:
+            return dict(throttled, queued=False)
+        event_id = await asyncio.to_thread(
+            event_queue.enqueue, phone, campaign_id, message, phone_number_id=body.get("phone_number_id"),
+            message_id=message_id, traceparent=tracing.traceparent()
+        )
+        handled = {"queued": True, "id": event_id}
+        return handled
+    except Exception as e:
+        log_event("Erro ao enfileirar mensagem", {"error": str(e)})
+        return {"detail": f"Erro ao enfileirar mensagem: {str(e)}"}
+    finally:
+        if message_id:
+            await settle_message(message_id, handled)
+
+@admin.get("/queue")
+async def queue_stats():
+    if not event_queue:
+        return {"detail": "Fila de eventos desativada (defina EVENT_QUEUE_PATH)"}
+    return await asyncio.to_thread(event_queue.stats)
+
+@app.get("/campaigns/{campaign_id}/tallies")
+async def tallies(campaign_id: str):
+    try:
+        campaign = await asyncio.to_thread(campaign_cache.get_campaign, campaign_id)
+        if not campaign:
+            return {"detail": "Campanha não encontrada"}
+        flow = await asyncio.to_thread(get_compiled_flow, campaign)
+        return await asyncio.to_thread(campaign_tallies, campaign_id, flow)
+    except Exception as e:
+        log_event("Erro ao consultar contagens", {"campaign_id": campaign_id, "error": str(e)})
+        return {"detail": f"Erro ao consultar contagens: {str(e)}"}
+
+@app.get("/campaigns/{campaign_id}/export", dependencies=[Depends(require_admin)])
+async def export(campaign_id: str, format: str = "csv"):
+    if format not in EXPORT_FORMATS:
+        return {"detail": f"Formato inválido; use {', '.join(sorted(EXPORT_FORMATS))}"}
+    try:
+        campaign = await asyncio.to_thread(campaign_cache.get_campaign, campaign_id)
+    except Exception as e:
+        log_event("Erro ao exportar respostas", {"campaign_id": campaign_id, "error": str(e)})
+        return {"detail": f"Erro ao exportar respostas: {str(e)}"}
+    if not campaign:
+        return {"detail": "Campanha não encontrada"}
+    # Starlette drives the blocking generator from its thread pool, one chunk at a time
+    return StreamingResponse(
+        export_stream(campaign, format),
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{campaign_id}.{format}"'},
+    )
+
+@admin.post("/invalidate")
+async def invalidate(request: Request):
+    """Drops a campaign ({"campaign_id"}) or one user state ({"campaign_id", "phone"}) in every worker."""
+    try:
+        body = await request.json()
+        campaign_id = body.get("campaign_id")
+        phone = body.get("phone")
+        if not campaign_id:
+            return {"detail": "Parâmetros obrigatórios ausentes"}
+        if phone:
+            if state_cache:
+                state_cache.evict(phone, campaign_id)
+            peers = cache_bus.publish_state(phone, campaign_id)
+            log_event("Estado invalidado", {"phone": phone, "campaign_id": campaign_id, "peers": peers})
+            return {"invalidated": "state", "phone": phone, "campaign_id": campaign_id, "peers": peers}
+        cached = campaign_cache.invalidate(campaign_id)
+        if state_cache:
+            state_cache.evict_campaign(campaign_id)
+        peers = cache_bus.publish_campaign(campaign_id)
+        log_event("Campanha invalidada", {"campaign_id": campaign_id, "cached": cached, "peers": peers})
+        return {"invalidated": "campaign", "campaign_id": campaign_id, "cached": cached, "peers": peers}
+    except Exception as e:
+        log_event("Erro ao invalidar cache", {"error": str(e)})
+        return {"detail": f"Erro ao invalidar cache: {str(e)}"}
+
+@admin.get("/cache")
+async def cache_stats():
+    return {
+        "campaigns": len(campaign_cache.entries),
+        "states": state_cache.snapshot() if state_cache else None,
+        "bus": dict(cache_bus.stats, transport=type(cache_bus.transport).__name__),
+    }
+
+app.include_router(admin)
@@ -1,304 +1,187 @@
-<?php
-// webhook.php
-
-require_once 'config.php';
-
-// Função para gravar logs estruturados em JSON
-function customLog($message, $data = [], $isTest = false) {
-    if ($isTest) return;
-    $log_file = __DIR__ . '/webhook_log.txt';
-    $timestamp = date('Y-m-d H:i:s');
-    $log_entry = [
-        'timestamp' => $timestamp,
-        'message' => $message,
-        'data' => $data
-    ];
-    file_put_contents($log_file, json_encode($log_entry) . "\n", FILE_APPEND);
-}
-
-// Função para gravar logs detalhados em survey_tracking_log.txt
-function writeSurveyTrackingLog($phoneNumber, $campaignId, $phoneNumberId, $eventType, $details, $isTest = false) {
-    if ($isTest) return;
-    $timestamp = date('Y-m-d H:i:s');
-    $log_entry = [
-        'timestamp' => $timestamp,
-        'phone_number' => $phoneNumber,
-        'campaign_id' => $campaignId,
-        'phone_number_id' => $phoneNumberId,
-        'event_type' => $eventType,
-        'details' => $details
-    ];
-    file_put_contents('survey_tracking_log.txt', json_encode($log_entry) . "\n", FILE_APPEND);
-}
-
-// Função para tratar erros de forma centralizada
-function handleError($from, $message, $phone_number_id, $campaign_id = null, $isTest = false) {
-    sendWhatsAppMessage($from, $message, $phone_number_id, $isTest);
-    customLog("Erro: $message", ['phone' => $from, 'campaign_id' => $campaign_id], $isTest);
-    writeSurveyTrackingLog($from, $campaign_id, $phone_number_id, 'error', [
-        'error_message' => $message
-    ], $isTest);
-    http_response_code(200);
-    exit;
-}
-
-// Função para buscar access_token e whatsapp_id do Supabase
-function getAccessToken($phone_number_id) {
-    $result = supabaseRequest('GET', "/iap_integration_configurations?select=config_data&config_data->>phone_id=eq.$phone_number_id");
-    if (!$result || !isset($result[0]['config_data']['access_token']) || !isset($result[0]['config_data']['whatsapp_id'])) {
-        customLog("Nenhum access_token ou whatsapp_id encontrado", ['phone_number_id' => $phone_number_id]);
-        return null;
-    }
+"""Migrates legacy iap_campaigns.questions_json flows into canonical flow_json.
+
+The engine prefers questions_json when it has questions and only falls back
+to flow_json. This tool writes, for every campaign, the flow the engine
+actually runs into flow_json in canonical form (string options become option
+objects, type and outro live next to the questions), so that flow_json alone
+yields the same compiled flow.
+
+Usage:
+    python migrate_questions_to_flow.py --dry-run
+    python migrate_questions_to_flow.py --checkpoint migration.json --concurrency 4
+"""
+import os
+import sys
+import json
+import difflib
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Any, List, Optional, Tuple
+
+from text_utils import normalize_text
+from flow_compiler import safe_json_load, determine_survey_type, flow_outro, normalize_questions
+from log_config import configure_logging
+
+DEFAULT_PAGE_SIZE = 200
+DEFAULT_CONCURRENCY = 4
+
+def to_canonical_flow(campaign: Dict) -> Dict:
+    """Builds the canonical flow_json for a campaign row.
+
+    Starts from the parsed source the engine uses today, so text is normalized
+    exactly once more when the engine loads the result, as it is now.
+    """
+    questions_json = safe_json_load(campaign.get("questions_json", {}))
+    flow_json = safe_json_load(campaign.get("flow_json", {}))
+    source = questions_json if questions_json.get("questions") else flow_json
+    questions = []
+    for q in source.get("questions", []):
+        canonical_q = dict(q)
+        canonical_q["id"] = str(q.get("id"))
+        if "options" in q:
+            # The engine normalizes string options but not option objects
+            canonical_q["options"] = [
+                opt if isinstance(opt, dict) else {"text": normalize_text(opt)}
+                for opt in q["options"]
+            ]
+        questions.append(canonical_q)
+    flow = {"type": determine_survey_type(campaign), "questions": questions}
+    outro = flow_outro(campaign)
+    if outro is not None:
+        flow["outro"] = outro
+    return flow
+
+def _comparable(questions: List[Dict]) -> List[Dict]:
+    """Normalized questions with option objects and bare option texts made equivalent."""
     return [
-        'access_token' => $result[0]['config_data']['access_token'],
-        'whatsapp_id' => $result[0]['config_data']['whatsapp_id']
-    ];
-}
-
-// Função para enviar mensagem pelo WhatsApp
-function sendWhatsAppMessage($to, $messageOrPayload, $phone_number_id, $isTest = false, $isQuickReply = false) {
-    $auth = getAccessToken($phone_number_id);
-    if (!$auth) {
-        customLog("Auth não encontrado", ['phone' => $to, 'phone_number_id' => $phone_number_id], $isTest);
-        writeSurveyTrackingLog($to, null, $phone_number_id, 'error', ['error_message' => 'Auth não encontrado'], $isTest);
-        return;
-    }
-    $access_token = $auth['access_token'];
-
-    if ($isQuickReply || (is_array($messageOrPayload) && isset($messageOrPayload['interactive']))) {
-        $payload = [
-            'messaging_product' => 'whatsapp',
-            'to' => $to,
-            'type' => 'interactive',
-            'interactive' => $messageOrPayload['interactive']
-        ];
-    } elseif (is_array($messageOrPayload) && isset($messageOrPayload['type']) && $messageOrPayload['type'] === 'template') {
-        $payload = $messageOrPayload;
-    } else {
-        $payload = [
-            'messaging_product' => 'whatsapp',
-            'to' => $to,
-            'type' => 'text',
-            'text' => ['body' => $messageOrPayload]
-        ];
-    }
-
-    $options = [
-        'http' => [
-            'header' => "Content-Type: application/json\r\nAuthorization: Bearer $access_token\r\n",
-            'method' => 'POST',
-            'content' => json_encode($payload)
-        ]
-    ];
-
-    $context = stream_context_create($options);
-    $result = @file_get_contents(WHATSAPP_API_URL . "$phone_number_id/messages", false, $context);
-    if ($result === false) {
-        customLog("Erro ao enviar mensagem", ['phone' => $to, 'phone_number_id' => $phone_number_id, 'response' => $http_response_header], $isTest);
-        writeSurveyTrackingLog($to, null, $phone_number_id, 'error', [
-            'error_message' => 'Falha ao enviar mensagem',
-            'response' => $http_response_header
-        ], $isTest);
-    } else {
-        customLog("Mensagem enviada", ['phone' => $to, 'phone_number_id' => $phone_number_id, 'payload' => $payload], $isTest);
-        writeSurveyTrackingLog($to, null, $phone_number_id, 'message_sent', [
-            'message_type' => $payload['type'],
-            'content' => $payload[$payload['type']]
-        ], $isTest);
-    }
-}
-
-// Função para verificar se o usuário já participou
-function hasParticipated($phone, $campaign_id, $isTest = false) {
-    if ($isTest) return false;
-    $result = supabaseRequest('GET', "/iap_survey_results?phone_number=eq.$phone&campaign_id=eq.$campaign_id&select=id,completed");
-    if ($result && !empty($result) && isset($result[0]['completed']) && $result[0]['completed'] === true) {
-        customLog("Usuário já participou", ['phone' => $phone, 'campaign_id' => $campaign_id], $isTest);
-        writeSurveyTrackingLog($phone, $campaign_id, null, 'participation_blocked', [], $isTest);
-        return true;
-    }
-    return false;
-}
-
-// Função para fazer requisições ao Supabase
-function supabaseRequest($method, $endpoint, $data = null) {
-    $url = SUPABASE_URL . '/rest/v1' . $endpoint;
-    $headers = [
-        "Content-Type: application/json",
-        "apikey: " . SUPABASE_KEY,
-        "Authorization: Bearer " . SUPABASE_KEY
-    ];
-    $options = [
-        'http' => [
-            'method' => $method,
-            'header' => implode("\r\n", $headers)
-        ]
-    ];
-    if ($data) {
-        $options['http']['content'] = json_encode($data);
-    }
-    $context = stream_context_create($options);
-    try {
-        $result = @file_get_contents($url, false, $context);
-        if ($result === false) {
-            customLog("Erro na requisição ao Supabase", ['method' => $method, 'endpoint' => $endpoint, 'response' => $http_response_header]);
-            return false;
-        }
-        return json_decode($result, true);
-    } catch (Exception $e) {
-        customLog("Exceção na requisição ao Supabase", ['method' => $method, 'endpoint' => $endpoint, 'error' => $e->getMessage()]);
-        return false;
-    }
-}
-
-// Função para carregar campanha
-function loadCampaign($identifier, $campaign_id = null) {
-    $endpoint = $campaign_id && preg_match('/^[a-f\d]{8}-([a-f\d]{4}-){3}[a-f\d]{12}$/i', $campaign_id)
-        ? "/iap_campaigns?campaign_id=eq.$campaign_id&select=campaign_id,title,phone_number_id,flow_json,questions_json,template_id,integration_id,send_report"
-        : "/iap_campaigns?phone_number_id=eq.$identifier&select=campaign_id,title,phone_number_id,flow_json,questions_json,template_id,integration_id,send_report&order=created_at.desc&limit=1";
-    $result = supabaseRequest('GET', $endpoint);
-    if ($result && !empty($result)) {
-        $campaign = $result[0];
-        $campaign['questions_json'] = isset($campaign['flow_json']) ? $campaign['flow_json'] : $campaign['questions_json'];
-        customLog("Campanha carregada", ['campaign' => $campaign]);
-        writeSurveyTrackingLog(null, $campaign_id, $identifier, 'campaign_loaded', ['result' => $campaign]);
-        return $campaign;
-    }
-    customLog("Nenhuma campanha encontrada", ['identifier' => $identifier, 'campaign_id' => $campaign_id]);
-    return null;
-}
-
-// Função para buscar campaign_id por código
-function getCampaignIdByCode($code) {
-    $result = supabaseRequest('GET', "/iap_campaign_codes?code=eq.$code&select=campaign_id");
-    if ($result && !empty($result)) {
-        return $result[0]['campaign_id'];
-    }
-    return null;
-}
-
-// Função para chamar o backend FastAPI
-function callFastAPI($phone, $campaign_id, $message, $phone_number_id, $isTest = false) {
-    $fastapi_url = "http://localhost:8000/process"; // Ajuste para a URL do seu servidor FastAPI
-    $payload = [
-        'phone' => $phone,
-        'campaign_id' => $campaign_id,
-        'message' => $message
-    ];
-    $options = [
-        'http' => [
-            'method' => 'POST',
-            'header' => "Content-Type: application/json\r\n",
-            'content' => json_encode($payload)
-        ]
-    ];
-    $context = stream_context_create($options);
-    $result = @file_get_contents($fastapi_url, false, $context);
-    if ($result === false) {
-        customLog("Erro ao chamar FastAPI", ['phone' => $phone, 'campaign_id' => $campaign_id, 'response' => $http_response_header], $isTest);
-        writeSurveyTrackingLog($phone, $campaign_id, $phone_number_id, 'error', [
-            'error_message' => 'Falha ao chamar FastAPI'
-        ], $isTest);
-        return null;
-    }
-    return json_decode($result, true);
-}
-
-// Verificar método da requisição
-$method = $_SERVER['REQUEST_METHOD'];
-
-if ($method === 'GET') {
-    $mode = $_GET['hub_mode'] ?? '';
-    $token = $_GET['hub_verify_token'] ?? '';
-    $challenge = $_GET['hub_challenge'] ?? '';
-
-    if ($mode === 'subscribe' && $token === VERIFY_TOKEN) {
-        echo $challenge;
-        customLog("Webhook verificado com sucesso");
-        http_response_code(200);
-    } else {
-        echo "Token inválido";
-        customLog("Falha na verificação do Webhook", ['error' => 'Token inválido']);
-        writeSurveyTrackingLog(null, null, null, 'error', ['error_message' => 'Token inválido']);
-        http_response_code(403);
-    }
-    exit;
-}
-
-if ($method === 'POST') {
-    $input = file_get_contents('php://input');
-    $data = json_decode($input, true);
-    customLog("Payload recebido", ['payload' => $input]);
-    
-    if (isset($data['entry'][0]['changes'][0]['value']['messages'][0])) {
-        $message = $data['entry'][0]['changes'][0]['value']['messages'][0];
-        $from = $message['from'];
-        $text = strtolower(trim($message['text']['body'] ?? ''));
-        $button_text = strtolower(trim($message['button']['text'] ?? $message['interactive']['button_reply']['id'] ?? $message['interactive']['button_reply']['title'] ?? ''));
-        $phone_number_id = $data['entry'][0]['changes'][0]['value']['metadata']['phone_number_id'];
-        $contact_name = $data['entry'][0]['changes'][0]['value']['contacts'][0]['profile']['name'] ?? '';
-        $isTest = isset($message['context']) && strpos($text, 'teste') !== false;
-
-        writeSurveyTrackingLog($from, null, $phone_number_id, 'payload_received', ['payload' => $input], $isTest);
-        customLog("Mensagem recebida", ['phone' => $from, 'text' => $text, 'button_text' => $button_text, 'isTest' => $isTest]);
-
-        $input_message = $button_text ?: $text;
-        $campaign = loadCampaign($phone_number_id);
-        if (!$campaign) {
-            handleError($from, "Nenhuma campanha ativa no momento.", $phone_number_id, null, $isTest);
-        }
-
-        if (hasParticipated($from, $campaign['campaign_id'], $isTest)) {
-            handleError($from, "Você já participou desta pesquisa!", $phone_number_id, $campaign['campaign_id'], $isTest);
-        }
-
-        // Lógica para "começar <código>"
-        if (preg_match('/^começar\s+([A-Z0-9]+)$/i', $text, $matches)) {
-            $campaign_code = strtoupper($matches[1]);
-            $campaign_id = getCampaignIdByCode($campaign_code);
-            if ($campaign_id) {
-                $campaign = loadCampaign($campaign_id, $campaign_id);
-                if ($campaign) {
-                    if (hasParticipated($from, $campaign['campaign_id'], $isTest)) {
-                        handleError($from, "Você já participou desta pesquisa!", $phone_number_id, $campaign['campaign_id'], $isTest);
-                    }
-                    $response = callFastAPI($from, $campaign['campaign_id'], 'começar', $phone_number_id, $isTest);
-                    if ($response && isset($response['next_message'])) {
-                        $isQuickReply = isset($campaign['questions_json']['questions'][0]['type']) && 
-                                       $campaign['questions_json']['questions'][0]['type'] === 'quick_reply' && 
-                                       count($campaign['questions_json']['questions'][0]['options']) <= 3;
-                        sendWhatsAppMessage($from, $response['next_message'], $phone_number_id, $isTest, $isQuickReply);
-                        writeSurveyTrackingLog($from, $campaign['campaign_id'], $phone_number_id, 'question_sent', [
-                            'message' => $response['next_message']
-                        ], $isTest);
-                    } else {
-                        handleError($from, "Erro ao iniciar a campanha. Tente novamente.", $phone_number_id, $campaign['campaign_id'], $isTest);
-                    }
-                } else {
-                    handleError($from, "Código de campanha inválido: $campaign_code.", $phone_number_id, null, $isTest);
-                }
-                exit;
-            }
-        }
-
-        // Processar mensagem normal
-        $response = callFastAPI($from, $campaign['campaign_id'], $input_message, $phone_number_id, $isTest);
-        if ($response && isset($response['next_message'])) {
-            $isQuickReply = isset($campaign['questions_json']['questions'][0]['type']) && 
-                           $campaign['questions_json']['questions'][0]['type'] === 'quick_reply' && 
-                           count($campaign['questions_json']['questions'][0]['options']) <= 3;
-            sendWhatsAppMessage($from, $response['next_message'], $phone_number_id, $isTest, $isQuickReply);
-            writeSurveyTrackingLog($from, $campaign['campaign_id'], $phone_number_id, 'question_sent', [
-                'message' => $response['next_message']
-            ], $isTest);
-        } elseif (isset($response['detail'])) {
-            handleError($from, "Erro ao processar sua resposta. Tente novamente.", $phone_number_id, $campaign['campaign_id'], $isTest);
-        }
-        http_response_code(200);
-        exit;
-    }
-    customLog("Nenhuma mensagem válida no payload");
-    http_response_code(200);
-    exit;
-}
-?>
\ No newline at end of file
+        dict(q, options=[dict(opt, action=opt.get("action"), target=opt.get("target")) for opt in q["options"]])
+        for q in questions
+    ]
+
+def plan_migration(campaign: Dict) -> Tuple[Optional[Dict], Optional[str]]:
+    """Returns (new_flow_json, error). new_flow_json is None when nothing changes."""
+    current = safe_json_load(campaign.get("flow_json", {}))
+    canonical = to_canonical_flow(campaign)
+    if not canonical["questions"]:
+        return None, None
+    if current == canonical:
+        return None, None
+    migrated = {"campaign_id": campaign.get("campaign_id"), "flow_json": canonical}
+    if _comparable(normalize_questions(migrated)) != _comparable(normalize_questions(campaign)) or \
+            determine_survey_type(migrated) != determine_survey_type(campaign) or \
+            flow_outro(migrated) != flow_outro(campaign):
+        return None, "canonical flow_json would change the compiled flow"
+    return canonical, None
+
+def diff_flows(campaign_id: str, old: Any, new: Dict) -> str:
+    old_text = json.dumps(safe_json_load(old), indent=2, ensure_ascii=False, sort_keys=True).splitlines()
+    new_text = json.dumps(new, indent=2, ensure_ascii=False, sort_keys=True).splitlines()
+    return "\n".join(difflib.unified_diff(
+        old_text, new_text,
+        fromfile=f"{campaign_id}/flow_json (atual)",
+        tofile=f"{campaign_id}/flow_json (migrado)",
+        lineterm=""
+    ))
+
+def load_checkpoint(path: Optional[str]) -> Dict:
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return {"last_key": None, "migrated": 0, "unchanged": 0, "errors": []}
+
+def save_checkpoint(path: Optional[str], checkpoint: Dict) -> None:
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def write_flows(rows: List[Dict]) -> bool:
+    """Sets flow_json on each campaign with a PATCH of that one column, so
+    concurrent edits to the other columns are kept."""
+    from supabase_client import update_rows
+
+    return all(
+        update_rows("iap_campaigns", {"campaign_id": f"eq.{row['campaign_id']}"},
+                    {"flow_json": row["flow_json"]}, returning="campaign_id") == 1
+        for row in rows
+    )
+
+def migrate(page_size: int = DEFAULT_PAGE_SIZE, concurrency: int = DEFAULT_CONCURRENCY,
+            checkpoint_path: Optional[str] = None, dry_run: bool = False, out=sys.stdout) -> Dict:
+    """Streams iap_campaigns and writes canonical flow_json back.
+
+    Pages are read sequentially and their writes run on a bounded pool. The
+    checkpoint only advances past a page once it and every earlier page are
+    written, so a crashed run resumes without skipping campaigns.
+    """
+    from supabase_client import iter_pages
+
+    checkpoint = load_checkpoint(checkpoint_path)
+    pending: deque = deque()  # (last_key, future, migrated, unchanged) in page order
+    failed = False
+
+    def settle(limit: int) -> None:
+        nonlocal failed
+        while pending and (len(pending) > limit or pending[0][1].done()):
+            last_key, future, migrated, unchanged = pending.popleft()
+            if not future.result():
+                failed = True
+                pending.clear()
+                return
+            checkpoint["last_key"] = last_key
+            checkpoint["migrated"] += migrated
+            checkpoint["unchanged"] += unchanged
+            if not dry_run:
+                save_checkpoint(checkpoint_path, checkpoint)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for page in iter_pages("iap_campaigns", select="*", key="campaign_id",
+                               page_size=page_size, after=checkpoint["last_key"]):
+            rows, unchanged = [], 0
+            for campaign in page:
+                new_flow, error = plan_migration(campaign)
+                if error:
+                    checkpoint["errors"].append({"campaign_id": campaign.get("campaign_id"), "error": error})
+                    print(f"{campaign.get('campaign_id')}: {error}", file=sys.stderr)
+                    continue
+                if new_flow is None:
+                    unchanged += 1
+                    continue
+                if dry_run:
+                    print(diff_flows(campaign.get("campaign_id"), campaign.get("flow_json"), new_flow), file=out)
+                rows.append({"campaign_id": campaign["campaign_id"], "flow_json": new_flow})
+            if dry_run:
+                future = Future()
+                future.set_result(True)
+            else:
+                future = pool.submit(write_flows, rows)
+            pending.append((page[-1]["campaign_id"], future, len(rows), unchanged))
+            # Bound the number of in-flight writes (and the pages held in memory)
+            settle(limit=concurrency)
+            if failed:
+                break
+        if not failed:
+            settle(limit=0)
+    checkpoint["failed"] = failed
+    return checkpoint
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Migrate questions_json flows to canonical flow_json.")
+    parser.add_argument("--dry-run", action="store_true", help="print a diff per campaign and write nothing")
+    parser.add_argument("--checkpoint", help="checkpoint file used to resume an interrupted run")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    args = parser.parse_args(argv)
+    configure_logging("supabase.log")
+
+    result = migrate(args.page_size, args.concurrency, args.checkpoint, args.dry_run)
+    action = "a migrar" if args.dry_run else "migradas"
+    print(f"{result['migrated']} campanhas {action}, {result['unchanged']} inalteradas, "
+          f"{len(result['errors'])} com erro; última chave: {result['last_key']}", file=sys.stderr)
+    return 1 if result["failed"] or result["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
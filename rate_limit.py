@@ -0,0 +1,186 @@
+"""Token-bucket flood protection, checked before a message reaches the engine.
+
+Every message takes one token from two buckets: the sender's, keyed by
+(campaign, phone), and the campaign's. A bucket refills at `rate` tokens
+per second up to `burst`. A message finding either bucket empty is
+rejected before any backend I/O. The first message a phone sends over its
+limit gets a warning reply. Later ones get no reply at all (`next_message`
+is left out, so webhook.php sends nothing) until a message gets through
+again, so a looping client costs one bucket lookup per message. Messages
+over the campaign's limit always get the warning, since they come from
+many different people.
+
+Limits come from RATE_LIMITS, a JSON object of scopes, each optional:
+
+    {"default": {"phone": [2, 20], "campaign": [200, 1000]},
+     "campanha-grande": {"campaign": [1000, 5000]}}
+
+Each pair is [rate per second, burst]; a missing or null pair disables that
+bucket. Campaign scopes override the default per bucket. RATE_LIMITS is
+empty by default, so nothing is limited until it is set; keep the phone
+burst well above what a person typing quickly sends, since WhatsApp users
+often answer in several short messages. RATE_LIMIT_IDLE_SECONDS (default
+300) is how long an idle bucket is kept at least.
+
+Buckets live in NumPy arrays forming an open-addressing hash table: key,
+tokens, last update and a warned flag, 21 bytes per slot, with half to
+three quarters of the slots in use. A bucket idle long enough to have refilled is the same as no bucket,
+so such entries are dropped whenever the table has to grow.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from typing import Dict, Any, Optional, Tuple
+
+import numpy as np
+
+RATE_LIMITS = os.getenv("RATE_LIMITS", "{}")  # off unless configured
+RATE_LIMIT_IDLE_SECONDS = float(os.getenv("RATE_LIMIT_IDLE_SECONDS", "300"))
+INITIAL_SLOTS = 1024
+MAX_LOAD = 0.75  # resize beyond this share of used slots
+RESIZED_LOAD = 0.5  # share of used slots right after a resize
+ALLOWED, REFUSED, COALESCED = range(3)  # results of TokenBuckets.take
+
+THROTTLED_RESPONSE = {
+    "next_message": "⏳ Você está enviando mensagens muito rápido. Aguarde alguns segundos e tente novamente.",
+    "throttled": True
+}
+COALESCED_RESPONSE = {"throttled": True}
+
+def log_event(message: str, data: Dict = {}):
+    log_entry = {'message': message, 'data': data}
+    logging.info(json.dumps(log_entry, ensure_ascii=False))
+
+def bucket_key(value: str) -> int:
+    """A non-zero 64-bit key; zero marks an empty slot."""
+    return (hash(value) & 0xFFFFFFFFFFFFFFFF) or 1
+
+class TokenBuckets:
+    """Token buckets in an array-backed hash table with linear probing."""
+    def __init__(self, slots: int = INITIAL_SLOTS, idle_seconds: float = RATE_LIMIT_IDLE_SECONDS):
+        self.idle_seconds = idle_seconds
+        self._allocate(slots)
+
+    def _allocate(self, slots: int) -> None:
+        self.keys = np.zeros(slots, dtype=np.uint64)
+        self.tokens = np.zeros(slots, dtype=np.float32)
+        self.stamps = np.zeros(slots, dtype=np.float64)
+        self.warned = np.zeros(slots, dtype=np.bool_)
+        self.used = 0
+        self._mask = slots - 1
+
+    def __len__(self) -> int:
+        return self.used
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.tokens.nbytes + self.stamps.nbytes + self.warned.nbytes
+
+    def _slot(self, key: int) -> Tuple[int, bool]:
+        """Slot holding `key`, or the empty slot where it belongs; and whether it was found."""
+        keys = self.keys
+        slot = key & self._mask
+        while True:
+            current = int(keys[slot])
+            if current == key:
+                return slot, True
+            if current == 0:
+                return slot, False
+            slot = (slot + 1) & self._mask
+
+    def take(self, key: int, rate: float, burst: float, now: float) -> int:
+        """Takes one token: ALLOWED, REFUSED for the first refusal since the
+        last allowed message, COALESCED for the ones after it."""
+        slot, found = self._slot(key)
+        if not found:
+            if self.used + 1 > len(self.keys) * MAX_LOAD:
+                self._resize(now)
+                slot, _ = self._slot(key)
+            self.keys[slot] = key
+            self.used += 1
+            tokens = float(burst)
+        else:
+            tokens = min(float(burst), float(self.tokens[slot]) + (now - float(self.stamps[slot])) * rate)
+        self.stamps[slot] = now
+        if tokens >= 1:
+            self.tokens[slot] = tokens - 1
+            self.warned[slot] = False
+            return ALLOWED
+        self.tokens[slot] = tokens
+        if self.warned[slot]:
+            return COALESCED
+        self.warned[slot] = True
+        return REFUSED
+
+    def _resize(self, now: float) -> None:
+        """Drops idle buckets, growing the table if it is still too full."""
+        live = (self.keys != 0) & (now - self.stamps < self.idle_seconds)
+        keys, tokens, stamps, warned = self.keys[live], self.tokens[live], self.stamps[live], self.warned[live]
+        slots = len(self.keys)
+        while len(keys) + 1 > slots * RESIZED_LOAD:
+            slots *= 2
+        self._allocate(slots)
+        for key, token, stamp, flag in zip(keys.tolist(), tokens.tolist(), stamps.tolist(), warned.tolist()):
+            slot, _ = self._slot(key)
+            self.keys[slot] = key
+            self.tokens[slot] = token
+            self.stamps[slot] = stamp
+            self.warned[slot] = flag
+        self.used = len(keys)
+
+def parse_limits(spec: str) -> Dict[str, Dict[str, Optional[Tuple[float, float]]]]:
+    """RATE_LIMITS JSON -> {scope: {"phone"/"campaign": (rate, burst) or None}}."""
+    limits = {}
+    for scope, buckets in (json.loads(spec) if spec else {}).items():
+        limits[scope] = {kind: (float(pair[0]), float(pair[1])) if pair else None
+                         for kind, pair in buckets.items()}
+    return limits
+
+class RateLimiter:
+    """Per-phone and per-campaign buckets with per-campaign limits."""
+    def __init__(self, limits: Optional[Dict[str, Dict[str, Any]]] = None,
+                 idle_seconds: float = RATE_LIMIT_IDLE_SECONDS):
+        self.limits = limits if limits is not None else parse_limits(RATE_LIMITS)
+        # An idle bucket may only be dropped once it would have refilled anyway
+        for scope in self.limits.values():
+            for pair in scope.values():
+                if pair and pair[0] > 0:
+                    idle_seconds = max(idle_seconds, pair[1] / pair[0])
+        self.phones = TokenBuckets(idle_seconds=idle_seconds)
+        self.campaigns = TokenBuckets(idle_seconds=idle_seconds)
+        self.stats = {"allowed": 0, "throttled": 0, "coalesced": 0}
+        self._lock = threading.Lock()
+
+    def limit(self, campaign_id: str, kind: str) -> Optional[Tuple[float, float]]:
+        scope = self.limits.get(campaign_id)
+        if scope is not None and kind in scope:
+            return scope[kind]
+        return self.limits.get("default", {}).get(kind)
+
+    def check(self, phone: str, campaign_id: str) -> Optional[Dict[str, Any]]:
+        """None if the message may go on; otherwise the response to return instead."""
+        now = time.monotonic()
+        phone_limit = self.limit(campaign_id, "phone")
+        campaign_limit = self.limit(campaign_id, "campaign")
+        with self._lock:
+            result = ALLOWED
+            if phone_limit:
+                result = self.phones.take(bucket_key(f"{campaign_id}\0{phone}"), *phone_limit, now)
+            if result == ALLOWED and campaign_limit:
+                if self.campaigns.take(bucket_key(campaign_id), *campaign_limit, now) != ALLOWED:
+                    result = REFUSED
+            if result == ALLOWED:
+                self.stats["allowed"] += 1
+                return None
+            self.stats["throttled" if result == REFUSED else "coalesced"] += 1
+        if result == REFUSED:
+            log_event("Mensagens acima do limite", {"phone": phone, "campaign_id": campaign_id})
+            return THROTTLED_RESPONSE
+        return COALESCED_RESPONSE
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.stats, phones=len(self.phones), campaigns=len(self.campaigns),
+                        bytes=self.phones.nbytes + self.campaigns.nbytes)
@@ -0,0 +1,358 @@
+"""Follow-up reminders for sessions left open mid-survey.
+
+Every processed message re-arms the idle deadline of its (phone, campaign_id)
+session in a hierarchical timing wheel, and a completed survey cancels it.
+Nothing scans whatsapp_user_states: the only backend reads happen when a
+deadline fires, to confirm the session is still open and find the question
+to repeat.
+
+The wheel uses lazy cancellation. `deadlines` holds the one live deadline
+per session; re-arming only overwrites it and drops a new entry into a slot,
+and entries that no longer match `deadlines` are discarded when their slot
+comes up. Insert and cancel are O(1), and a tick costs O(entries in the
+slot).
+
+Each session gets at most one reminder per REMINDER_WINDOW_HOURS. After it
+fires, the session is kept in `reminded` until the survey is completed or
+the window expires, whichever comes first; expired entries are pruned on
+every tick, oldest first, so `reminded` stays bounded by the sessions
+reminded within one window.
+
+A snapshot of the armed deadlines and the reminded sessions is written
+periodically and at shutdown, and loaded at startup. Deadlines that passed
+while the service was down fire on the first tick. Every process keeps its
+own wheel (web workers via main.py, queue consumers via event_queue.py). A
+process only sees the messages it handled, so before sending it checks the
+state's updated_at (the activity column of archive_states.py) and skips
+sessions active within the idle time, which another process has re-armed.
+Each process also claims its own snapshot file: REMINDER_SNAPSHOT for the first,
+then reminders.snapshot.1.gz and so on, held with an exclusive lock for the
+life of the process. A restarted process takes over a free file, and with
+it the sessions of the process it replaces.
+
+Reminders are free-form messages, so REMINDER_AFTER_MINUTES has to stay
+inside WhatsApp's 24-hour customer service window.
+"""
+import os
+import json
+import gzip
+import time
+import fcntl
+import asyncio
+import logging
+import threading
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Deque, Dict, Any, Callable, IO, Iterable, List, Optional, Tuple
+
+from flow_model import Flow
+
+REMINDER_AFTER_MINUTES = float(os.getenv("REMINDER_AFTER_MINUTES", "0"))
+REMINDER_WINDOW_HOURS = float(os.getenv("REMINDER_WINDOW_HOURS", "24"))
+REMINDER_SNAPSHOT = os.getenv("REMINDER_SNAPSHOT", "reminders.snapshot.gz")
+REMINDER_MESSAGE = os.getenv(
+    "REMINDER_MESSAGE",
+    "👋 Você ainda não terminou a pesquisa. Responda para continuar de onde parou:"
+)
+REMINDER_CONCURRENCY = 8
+SNAPSHOT_INTERVAL = 300  # seconds
+SNAPSHOT_SLOTS = 64  # processes per host that can keep a snapshot
+TICK_SECONDS = 1.0
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+LEVELS = 5  # 64**5 ticks: about 34 years at one tick per second
+
+Key = Tuple[str, str]
+
+def log_event(message: str, data: Dict = {}):
+    log_entry = {'message': message, 'data': data}
+    logging.info(json.dumps(log_entry, ensure_ascii=False))
+
+class TimingWheel:
+    """Hierarchical timing wheel over integer ticks with lazy cancellation."""
+    def __init__(self, now_tick: int = 0):
+        self.current = now_tick
+        self.wheels: List[List[list]] = [[[] for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self.deadlines: Dict[Any, int] = {}
+        self.due: list = []  # entries already expired when scheduled
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def _place(self, key: Any, tick: int) -> None:
+        delta = tick - self.current
+        if delta <= 0:
+            self.due.append((key, tick))
+            return
+        for level in range(LEVELS):
+            if delta < SLOTS ** (level + 1) or level == LEVELS - 1:
+                # Beyond the top level's span the entry waits in its last slot and is re-placed on cascade
+                slot_tick = min(tick, self.current + SLOTS ** LEVELS - 1)
+                slot = (slot_tick >> (SLOT_BITS * level)) & (SLOTS - 1)
+                self.wheels[level][slot].append((key, tick))
+                return
+
+    def schedule(self, key: Any, tick: int) -> None:
+        self.deadlines[key] = tick
+        self._place(key, tick)
+
+    def cancel(self, key: Any) -> None:
+        self.deadlines.pop(key, None)
+
+    def _live(self, entries: Iterable[tuple]) -> List[Any]:
+        fired = []
+        for key, tick in entries:
+            if self.deadlines.get(key) == tick:
+                del self.deadlines[key]
+                fired.append(key)
+        return fired
+
+    def advance(self, now_tick: int) -> List[Any]:
+        """Moves the wheel up to `now_tick` and returns the keys whose deadline passed."""
+        fired = self._live(self.due)
+        self.due = []
+        while self.current < now_tick:
+            self.current += 1
+            # Cascade: every 64**level ticks one higher slot is redistributed downwards
+            for level in range(1, LEVELS):
+                if self.current & ((1 << (SLOT_BITS * level)) - 1):
+                    break
+                slot = (self.current >> (SLOT_BITS * level)) & (SLOTS - 1)
+                entries, self.wheels[level][slot] = self.wheels[level][slot], []
+                for key, tick in entries:
+                    if self.deadlines.get(key) == tick:
+                        self._place(key, tick)
+            slot = self.current & (SLOTS - 1)
+            entries, self.wheels[0][slot] = self.wheels[0][slot], []
+            fired.extend(self._live(entries))
+            if self.due:
+                fired.extend(self._live(self.due))
+                self.due = []
+        return fired
+
+def claim_snapshot_path(path: str, slots: int = SNAPSHOT_SLOTS) -> Tuple[Optional[str], Optional[IO]]:
+    """The first snapshot file of `path`'s series that no other live process holds.
+
+    Returns the path and the open lock file, which must stay open for as long
+    as the path is used; (None, None) when every slot is taken.
+    """
+    root, ext = os.path.splitext(path)
+    for slot in range(slots):
+        candidate = path if slot == 0 else f"{root}.{slot}{ext}"
+        lock_file = open(f"{candidate}.lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        return candidate, lock_file
+    return None, None
+
+class ReminderScheduler:
+    """Tracks idle deadlines of open sessions and sends one reminder per session."""
+    def __init__(self, idle_seconds: float, send: Optional[Callable[[str, str], bool]] = None,
+                 snapshot_path: Optional[str] = REMINDER_SNAPSHOT, tick_seconds: float = TICK_SECONDS,
+                 window_seconds: float = REMINDER_WINDOW_HOURS * 3600):
+        self.idle_ticks = max(1, int(idle_seconds / tick_seconds))
+        self.window_ticks = max(1, int(window_seconds / tick_seconds))
+        self.tick_seconds = tick_seconds
+        self.send = send or functools.partial(send_reminder, idle_seconds=idle_seconds)
+        self.snapshot_base = snapshot_path
+        self.snapshot_path: Optional[str] = None  # claimed on first use
+        self.wheel = TimingWheel(self._tick())
+        # Reminded session -> tick it was reminded at; the deque keeps them in that order for pruning
+        self.reminded: Dict[Key, int] = {}
+        self._reminded_order: Deque[Tuple[Key, int]] = deque()
+        self._campaign_ids: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._snapshot_lock: Optional[IO] = None
+
+    def _tick(self, now: Optional[float] = None) -> int:
+        return int((time.time() if now is None else now) / self.tick_seconds)
+
+    def _key(self, phone: str, campaign_id: str) -> Key:
+        # Millions of sessions share a handful of campaign ids
+        campaign_id = self._campaign_ids.setdefault(campaign_id, campaign_id)
+        return (phone, campaign_id)
+
+    def touch(self, phone: str, campaign_id: str, completed: bool = False, now: Optional[float] = None) -> None:
+        """Records activity on a session after a processed message."""
+        key = self._key(phone, campaign_id)
+        with self._lock:
+            if completed:
+                self.wheel.cancel(key)
+                self.reminded.pop(key, None)
+            elif key not in self.reminded:
+                self.wheel.schedule(key, self._tick(now) + self.idle_ticks)
+
+    def _mark_reminded(self, key: Key, tick: int) -> None:
+        self.reminded[key] = tick
+        self._reminded_order.append((key, tick))
+
+    def _prune(self, now_tick: int) -> None:
+        order = self._reminded_order
+        while order and order[0][1] + self.window_ticks <= now_tick:
+            key, tick = order.popleft()
+            # Skips sessions completed or reminded again since
+            if self.reminded.get(key) == tick:
+                del self.reminded[key]
+
+    def due(self, now: Optional[float] = None) -> List[Key]:
+        """Advances the wheel and returns the sessions to remind, marking them reminded."""
+        now_tick = self._tick(now)
+        with self._lock:
+            self._prune(now_tick)
+            fired = self.wheel.advance(now_tick)
+            for key in fired:
+                self._mark_reminded(key, now_tick)
+        return fired
+
+    def _claim(self) -> Optional[str]:
+        if self.snapshot_path is None and self.snapshot_base:
+            self.snapshot_path, self._snapshot_lock = claim_snapshot_path(self.snapshot_base)
+            if self.snapshot_path is None:
+                log_event("Nenhum arquivo de snapshot de lembretes livre", {"path": self.snapshot_base})
+        return self.snapshot_path
+
+    def snapshot(self) -> Optional[str]:
+        """Writes the armed deadlines and reminded sessions as gzip TSV."""
+        path = self._claim()
+        if not path:
+            return None
+        with self._lock:
+            armed = list(self.wheel.deadlines.items())
+            reminded = list(self.reminded.items())
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=1) as f:
+            f.write(f"# {self.tick_seconds}\n")
+            for (phone, campaign_id), tick in armed:
+                f.write(f"{phone}\t{campaign_id}\t{tick}\n")
+            for (phone, campaign_id), tick in reminded:
+                f.write(f"{phone}\t{campaign_id}\t-\t{tick}\n")
+        os.replace(tmp_path, path)
+        return path
+
+    def restore(self) -> int:
+        """Loads the snapshot written by a previous process; returns the sessions restored."""
+        path = self._claim()
+        if not path or not os.path.exists(path):
+            return 0
+        count = 0
+        reminded = []
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = f.readline()
+            scale = float(header[2:]) / self.tick_seconds if header.startswith("# ") else 1.0
+            with self._lock:
+                for line in f:
+                    phone, campaign_id, tick, *rest = line.rstrip("\n").split("\t")
+                    key = self._key(phone, campaign_id)
+                    if tick == "-":
+                        # Older snapshots did not record when; count the window from now
+                        reminded.append((int(int(rest[0]) * scale) if rest else self._tick(), key))
+                    else:
+                        self.wheel.schedule(key, int(int(tick) * scale))
+                    count += 1
+                for tick, key in sorted(reminded):
+                    self._mark_reminded(key, tick)
+                self._prune(self._tick())
+        return count
+
+    def _remind(self, phone: str, campaign_id: str) -> None:
+        try:
+            self.send(phone, campaign_id)
+        except Exception as e:
+            log_event("Erro ao enviar lembrete", {"phone": phone, "campaign_id": campaign_id, "error": str(e)})
+
+    async def run(self, stop: asyncio.Event) -> None:
+        """Ticks until `stop` is set, sending due reminders off the event loop."""
+        semaphore = asyncio.Semaphore(REMINDER_CONCURRENCY)
+        last_snapshot = time.monotonic()
+
+        async def remind(phone: str, campaign_id: str) -> None:
+            async with semaphore:
+                await asyncio.to_thread(self._remind, phone, campaign_id)
+
+        while not stop.is_set():
+            for phone, campaign_id in self.due():
+                asyncio.create_task(remind(phone, campaign_id))
+            if time.monotonic() - last_snapshot >= SNAPSHOT_INTERVAL:
+                await asyncio.to_thread(self.snapshot)
+                last_snapshot = time.monotonic()
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=self.tick_seconds)
+            except asyncio.TimeoutError:
+                pass
+        await asyncio.to_thread(self.snapshot)
+
+    def run_blocking(self, stop: threading.Event) -> None:
+        """Same as run, for processes without an event loop such as the queue consumers."""
+        last_snapshot = time.monotonic()
+        with ThreadPoolExecutor(max_workers=REMINDER_CONCURRENCY) as pool:
+            while not stop.is_set():
+                for phone, campaign_id in self.due():
+                    pool.submit(self._remind, phone, campaign_id)
+                if time.monotonic() - last_snapshot >= SNAPSHOT_INTERVAL:
+                    self.snapshot()
+                    last_snapshot = time.monotonic()
+                stop.wait(self.tick_seconds)
+        self.snapshot()
+
+def reminder_payload(phone: str, flow: Flow, step: str) -> Optional[Dict[str, Any]]:
+    """The reminder for a session at `step`: the current question, introduced by REMINDER_MESSAGE."""
+    from engine import SurveyProcessor
+    from whatsapp_client import response_payload
+
+    processor = SurveyProcessor.from_flow(flow)
+    question = processor._find_question(step)
+    if not question:
+        return None
+    if question.is_choice and question.options:
+        response = processor._format_options(question)
+        response["interactive"]["header"] = {"type": "text", "text": REMINDER_MESSAGE[:60]}
+        return response_payload(phone, response)
+    return response_payload(phone, {"next_message": f"{REMINDER_MESSAGE}\n\n{question.text}"})
+
+def last_activity(state: Dict[str, Any]) -> Optional[float]:
+    """The state's updated_at as epoch seconds, or None without the column."""
+    value = state.get("updated_at")
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+def send_reminder(phone: str, campaign_id: str, idle_seconds: float = 0) -> bool:
+    """Reminds one session through the outbound path if it is still open and idle."""
+    import supabase_client
+    from flow_compiler import get_compiled_flow
+    from whatsapp_client import send_message
+
+    campaign = supabase_client.get_campaign(campaign_id)
+    if not campaign or not campaign.get("phone_number_id"):
+        return False
+    flow = get_compiled_flow(campaign)
+    state = supabase_client.get_user_state(phone, campaign_id, flow)
+    step = state.get("current_step")
+    if not step:
+        # Completed, archived or never started
+        return False
+    updated_at = last_activity(state)
+    if updated_at is not None and updated_at > time.time() - idle_seconds:
+        # Answered through another process since this one armed the reminder
+        log_event("Lembrete ignorado: sessão ativa", {"phone": phone, "campaign_id": campaign_id, "step": step})
+        return False
+    payload = reminder_payload(phone, flow, step)
+    if payload is None:
+        return False
+    ok, status, _ = send_message(payload, campaign["phone_number_id"])
+    log_event("Lembrete enviado" if ok else "Falha ao enviar lembrete", {
+        "phone": phone,
+        "campaign_id": campaign_id,
+        "step": step,
+        "status_code": status
+    })
+    return ok
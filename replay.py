@@ -0,0 +1,226 @@
+"""Replays production traffic from engine logs against the current engine.
+
+Reads engine.log/app.log (plain or .gz, any number of rotated files) line by
+line, merged by timestamp, so multi-GB logs are never loaded into memory.
+Every "Processing message" entry is re-sent through process_message with an
+in-memory state store; conversations are keyed by (phone, campaign_id) and
+replayed in their original order. When the logs also hold the responses
+("Mensagem processada com sucesso"), each replayed response is compared with
+the one served in production.
+
+Usage:
+    python replay.py /home/flow_engine/engine.log app.log --campaigns-dir campaigns/
+    python replay.py engine.log.1.gz --speed 60 --json
+"""
+import os
+import sys
+import json
+import gzip
+import glob
+import time
+import heapq
+import asyncio
+import logging
+import argparse
+from array import array
+from collections import deque
+from datetime import datetime
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+from state_store import InMemoryStateStore
+
+REQUEST_MESSAGE = "Processing message"
+RESPONSE_MESSAGE = "Mensagem processada com sucesso"
+START_KEYWORDS = ("participar", "começar", "assinar")
+MAX_DIVERGENCE_SAMPLES = 20
+
+def _open_log(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+def iter_log_events(path: str) -> Iterator[Tuple[str, str, Dict]]:
+    """Yields (timestamp, kind, data) for request and response entries of one log file."""
+    with _open_log(path) as f:
+        for line in f:
+            # Cheap substring checks keep json.loads off the vast majority of lines
+            if REQUEST_MESSAGE in line:
+                kind = "request"
+            elif RESPONSE_MESSAGE in line:
+                kind = "response"
+            else:
+                continue
+            parts = line.split(" - ", 2)
+            if len(parts) != 3:
+                continue
+            try:
+                entry = json.loads(parts[2])
+            except json.JSONDecodeError:
+                continue
+            if entry.get("message") not in (REQUEST_MESSAGE, RESPONSE_MESSAGE):
+                continue
+            yield parts[0], kind, entry.get("data", {})
+
+def iter_events(paths: List[str]) -> Iterator[Tuple[str, str, Dict]]:
+    """Merges several logs into one timestamp-ordered stream."""
+    return heapq.merge(*(iter_log_events(p) for p in paths), key=lambda e: e[0])
+
+def parse_timestamp(value: str) -> float:
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S,%f").timestamp()
+
+class ReplayStore(InMemoryStateStore):
+    """In-memory state with campaigns from exported files, or fetched once from Supabase."""
+    def __init__(self, campaigns: Dict[str, Dict], fetch: bool):
+        super().__init__(campaigns)
+        self.fetch = fetch
+
+    def get_campaign(self, campaign_id: str) -> Optional[Dict]:
+        if campaign_id not in self.campaigns and self.fetch:
+            from supabase_client import get_campaign
+            self.campaigns[campaign_id] = get_campaign(campaign_id)
+        return super().get_campaign(campaign_id)
+
+    def get_campaign_by_code(self, code: str) -> Optional[Dict]:
+        if code not in self.codes and self.fetch:
+            from supabase_client import get_campaign_by_code
+            campaign = get_campaign_by_code(code)
+            if campaign:
+                self.campaigns[campaign["campaign_id"]] = campaign
+                self.codes[code] = campaign["campaign_id"]
+        return super().get_campaign_by_code(code)
+
+def _percentiles(values: array) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "p50_ms": round(pick(0.50) * 1000, 3),
+        "p90_ms": round(pick(0.90) * 1000, 3),
+        "p99_ms": round(pick(0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+async def replay(paths: List[str], store: ReplayStore, speed: float = 0, limit: Optional[int] = None,
+                 skip_partial: bool = True) -> Dict[str, Any]:
+    """Replays the logged requests and returns throughput, latency and divergence figures."""
+    from engine import process_message
+
+    latencies = array("d")
+    produced: Dict[tuple, deque] = {}  # replayed responses awaiting their logged counterpart
+    expected: Dict[tuple, deque] = {}  # logged responses awaiting their replayed counterpart
+    skipped_conversations = set()
+    started_conversations = set()
+    divergences, samples = 0, []
+    compared = skipped = 0
+    first_ts = None
+    wall_start = time.perf_counter()
+    busy = 0.0
+
+    def compare(key: tuple) -> None:
+        nonlocal divergences, compared
+        while produced.get(key) and expected.get(key):
+            message, got = produced[key].popleft()
+            want = expected[key].popleft()
+            compared += 1
+            if got != want:
+                divergences += 1
+                if len(samples) < MAX_DIVERGENCE_SAMPLES:
+                    samples.append({"phone": key[0], "campaign_id": key[1], "message": message,
+                                    "logged": want, "replayed": got})
+        for queues in (produced, expected):
+            if key in queues and not queues[key]:
+                del queues[key]
+
+    for ts, kind, data in iter_events(paths):
+        key = (data.get("phone"), data.get("campaign_id"))
+        if key in skipped_conversations:
+            continue
+        if kind == "response":
+            if key in started_conversations:
+                expected.setdefault(key, deque()).append(json.loads(json.dumps(data.get("response"))))
+                compare(key)
+            continue
+
+        message = data.get("message") or ""
+        if key not in started_conversations:
+            if skip_partial and not message.lower().startswith(START_KEYWORDS):
+                # Joined mid-survey: the state it depends on predates the logs
+                skipped_conversations.add(key)
+                skipped += 1
+                continue
+            started_conversations.add(key)
+
+        if speed:
+            event_ts = parse_timestamp(ts)
+            if first_ts is None:
+                first_ts = event_ts
+            delay = (event_ts - first_ts) / speed - (time.perf_counter() - wall_start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        t0 = time.perf_counter()
+        response = await process_message(key[0], key[1], message, store)
+        elapsed = time.perf_counter() - t0
+        busy += elapsed
+        latencies.append(elapsed)
+        produced.setdefault(key, deque()).append((message, json.loads(json.dumps(response))))
+        compare(key)
+        if limit and len(latencies) >= limit:
+            break
+
+    wall = time.perf_counter() - wall_start
+    return {
+        "messages": len(latencies),
+        "conversations": len(started_conversations),
+        "skipped_conversations": skipped,
+        "wall_seconds": round(wall, 3),
+        "throughput_per_s": round(len(latencies) / wall, 1) if wall else 0.0,
+        "engine_throughput_per_s": round(len(latencies) / busy, 1) if busy else 0.0,
+        "latency": _percentiles(latencies),
+        "compared": compared,
+        "divergences": divergences,
+        "divergence_samples": samples,
+    }
+
+def load_campaigns(directory: Optional[str]) -> Dict[str, Dict]:
+    from flow_compiler import load_campaign_file
+    campaigns = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))) if directory else []:
+        campaign = load_campaign_file(path)
+        campaigns[campaign["campaign_id"]] = campaign
+    return campaigns
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Replay logged conversations against the engine.")
+    parser.add_argument("logs", nargs="+", help="engine.log/app.log files, optionally gzipped")
+    parser.add_argument("--campaigns-dir", help="directory of exported campaign rows (<campaign_id>.json)")
+    parser.add_argument("--no-fetch", action="store_true", help="never fetch missing campaigns from Supabase")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="time compression: 1 keeps the original pacing, 60 replays an hour per minute, 0 (default) runs flat out")
+    parser.add_argument("--limit", type=int, help="stop after this many messages")
+    parser.add_argument("--include-partial", action="store_true",
+                        help="also replay conversations that were already mid-survey when the logs start")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    store = ReplayStore(load_campaigns(args.campaigns_dir), fetch=not args.no_fetch)
+    logging.disable(logging.CRITICAL)
+    report = asyncio.run(replay(args.logs, store, args.speed, args.limit, not args.include_partial))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return 0
+    latency = report["latency"]
+    print(f"{report['messages']} mensagens, {report['conversations']} conversas "
+          f"({report['skipped_conversations']} ignoradas por começarem no meio)")
+    print(f"vazão: {report['throughput_per_s']}/s total, {report['engine_throughput_per_s']}/s no engine")
+    if latency:
+        print(f"latência: p50 {latency['p50_ms']}ms, p90 {latency['p90_ms']}ms, "
+              f"p99 {latency['p99_ms']}ms, máx {latency['max_ms']}ms")
+    print(f"respostas comparadas: {report['compared']}, divergentes: {report['divergences']}")
+    for sample in report["divergence_samples"]:
+        print(json.dumps(sample, ensure_ascii=False))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
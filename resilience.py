@@ -0,0 +1,231 @@
+"""Deadlines, circuit breakers and hedged reads for Supabase requests.
+
+Every supabase_client request goes through request():
+
+- Deadline: the HTTP handler sets an absolute deadline for the message
+  (deadline_at), kept in a context variable. Each request's timeout is
+  then the smaller of its own timeout and the time left, so a slow backend
+  costs one request budget, not 10 s per call. Once the budget is spent,
+  requests fail at once.
+- Circuit breaker, one per endpoint (table or RPC): BREAKER_FAILURES
+  failures in a row open it, and requests fail at once for
+  BREAKER_RESET_SECONDS. After that a single probe request decides whether
+  it closes again. Network errors, 429 and 5xx count as failures.
+- Hedged reads: a GET still unanswered after the endpoint's recent p95
+  latency is sent a second time, and the first answer wins. Hedges are
+  capped at HEDGE_MAX_RATIO of the endpoint's requests.
+
+All of these raise BackendUnavailable, which callers can tell apart from
+an empty answer.
+"""
+import os
+import time
+import json
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Iterator, Optional
+
+import requests
+
+import tracing
+
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "8"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "10"))
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "1") == "1"
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 256
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+_hedge_pool = ThreadPoolExecutor(max_workers=int(os.getenv("HEDGE_WORKERS", "16")), thread_name_prefix="hedge")
+
+def log_event(message: str, data: Dict = {}):
+    log_entry = {'message': message, 'data': data}
+    logging.info(json.dumps(log_entry, ensure_ascii=False))
+
+class BackendUnavailable(Exception):
+    """The backend could not answer: network error, open breaker, spent deadline or bad status."""
+
+@contextmanager
+def deadline_at(expires: Optional[float]) -> Iterator[None]:
+    """Bounds every request made inside the block by `expires` (time.monotonic())."""
+    token = _deadline.set(expires)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def time_left() -> Optional[float]:
+    expires = _deadline.get()
+    return None if expires is None else expires - time.monotonic()
+
+def budget(timeout: float) -> float:
+    """The timeout to use for one request; raises once the deadline has passed."""
+    left = time_left()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise BackendUnavailable("prazo da requisição esgotado")
+    return min(timeout, left)
+
+class Endpoint:
+    """Breaker state and recent latencies of one table or RPC."""
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._p95: Optional[float] = None
+        self._samples_since_p95 = 0
+        self.requests = 0
+        self.hedges = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def admit(self) -> None:
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < BREAKER_RESET_SECONDS or self.probing:
+                    self.rejected += 1
+                    raise BackendUnavailable(f"circuito aberto: {self.name}")
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN:
+                if self.probing:
+                    self.rejected += 1
+                    raise BackendUnavailable(f"circuito em teste: {self.name}")
+                self.probing = True
+            self.requests += 1
+            if self.requests >= 10000:
+                # Keep the hedge ratio about recent traffic
+                self.requests //= 2
+                self.hedges //= 2
+
+    def release(self) -> None:
+        """Ends an admitted request that was never sent."""
+        with self._lock:
+            self.probing = False
+
+    def record(self, ok: bool, elapsed: Optional[float] = None) -> None:
+        with self._lock:
+            self.probing = False
+            if ok:
+                if self.state != CLOSED:
+                    log_event("Circuito fechado", {"endpoint": self.name})
+                self.state = CLOSED
+                self.failures = 0
+                if elapsed is not None:
+                    self.latencies.append(elapsed)
+                    self._samples_since_p95 += 1
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= BREAKER_FAILURES:
+                if self.state != OPEN:
+                    log_event("Circuito aberto", {"endpoint": self.name, "failures": self.failures})
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def hedge_delay(self) -> Optional[float]:
+        """The recent p95 latency if a hedge may be sent now, else None."""
+        with self._lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES or self.hedges >= self.requests * HEDGE_MAX_RATIO:
+                return None
+            if self._p95 is None or self._samples_since_p95 >= 16:
+                ordered = sorted(self.latencies)
+                self._p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+                self._samples_since_p95 = 0
+            return self._p95
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            ordered = sorted(self.latencies)
+        p = lambda q: round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000, 1) if ordered else None
+        return {"state": self.state, "failures": self.failures, "requests": self.requests,
+                "hedges": self.hedges, "rejected": self.rejected, "p50_ms": p(0.5), "p95_ms": p(0.95)}
+
+_endpoints: Dict[str, Endpoint] = {}
+_endpoints_lock = threading.Lock()
+
+def endpoint_name(url: str) -> str:
+    """`.../rest/v1/whatsapp_user_states?x=y` -> "whatsapp_user_states"."""
+    path = url.split("/rest/v1/", 1)[-1]
+    return path.split("?", 1)[0]
+
+def endpoint(name: str) -> Endpoint:
+    found = _endpoints.get(name)
+    if found is None:
+        with _endpoints_lock:
+            found = _endpoints.setdefault(name, Endpoint(name))
+    return found
+
+def _failed(response: requests.Response) -> bool:
+    return response.status_code == 429 or response.status_code >= 500
+
+def _hedged(send: Callable[[float], requests.Response], target: Endpoint, delay: float,
+            timeout: float) -> requests.Response:
+    first = _hedge_pool.submit(send, timeout)
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+    with target._lock:
+        target.hedges += 1
+    # The duplicate gets what is left of the first one's timeout
+    second = _hedge_pool.submit(send, max(timeout - delay, 0.001))
+    pending = {first, second}
+    error: Optional[BaseException] = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                response = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if not _failed(response) or not pending:
+                return response
+    raise error
+
+def request(method: str, url: str, timeout: float = 10, **kwargs) -> requests.Response:
+    """A Supabase request under the deadline, breaker and (for GET) hedging."""
+    target = endpoint(endpoint_name(url))
+    target.admit()
+    settled = False
+    try:
+        timeout = budget(timeout)
+        with tracing.span(f"supabase:{target.name}", method=method) as span:
+            parent = tracing.traceparent()
+            if parent:
+                kwargs["headers"] = dict(kwargs.get("headers") or {}, traceparent=parent)
+            send = lambda seconds: requests.request(method, url, timeout=seconds, **kwargs)
+            delay = target.hedge_delay() if HEDGE_ENABLED and method == "GET" else None
+            started = time.monotonic()
+            try:
+                if delay is not None and delay < timeout:
+                    response = _hedged(send, target, delay, timeout)
+                    span.set(hedge_after_ms=round(delay * 1000, 1))
+                else:
+                    response = send(timeout)
+            except requests.RequestException as e:
+                settled = True
+                target.record(False)
+                raise BackendUnavailable(f"{target.name}: {e}") from e
+            span.set(status=response.status_code)
+        failed = _failed(response)
+        settled = True
+        target.record(not failed, None if failed else time.monotonic() - started)
+        return response
+    finally:
+        if not settled:
+            # Out of budget, or an error that says nothing about the endpoint:
+            # give back the admission (and a half-open probe) without a verdict
+            target.release()
+
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    return {name: found.snapshot() for name, found in list(_endpoints.items())}
@@ -0,0 +1,93 @@
+-- Live answer counts kept by tallies.py. One row per
+-- (campaign, question, answer). answer is an option text for choice
+-- questions, and '' holds how many respondents answered the question at all.
+-- question_id '_completed' holds the number of completed sessions.
+create table if not exists whatsapp_answer_tallies (
+    campaign_id text not null,
+    question_id text not null,
+    answer text not null,
+    count bigint not null default 0,
+    primary key (campaign_id, question_id, answer)
+);
+
+-- One row per campaign recounted by `tallies.py --rebuild`. Deltas recorded
+-- (epoch seconds, by the service) before fenced_at are already in the
+-- recount. While rebuilding, deltas recorded after the fence are also set
+-- aside in whatsapp_tally_holds, so the recount can add them back.
+create table if not exists whatsapp_tally_fences (
+    campaign_id text primary key,
+    fenced_at bigint not null,
+    rebuilding boolean not null default false
+);
+
+create table if not exists whatsapp_tally_holds (
+    campaign_id text not null,
+    question_id text not null,
+    answer text not null,
+    count bigint not null default 0,
+    primary key (campaign_id, question_id, answer)
+);
+
+-- Adds a batch of deltas, [{"campaign_id", "question_id", "answer", "delta", "recorded_at"}].
+-- Used by tallies.TallyCounter.flush. Deltas recorded before their campaign's
+-- fence are dropped. The fence row is read with a share lock, so a batch
+-- waits for a running whatsapp_replace_tallies of its campaign.
+create or replace function whatsapp_add_tallies(p_deltas jsonb) returns void
+language sql
+as $$
+    with batch as (
+        select *
+          from jsonb_to_recordset(p_deltas)
+               as d(campaign_id text, question_id text, answer text, delta bigint, recorded_at bigint)
+    ), fences as (
+        select campaign_id, fenced_at, rebuilding from whatsapp_tally_fences
+         where campaign_id in (select campaign_id from batch)
+           for share
+    ), deltas as (
+        select b.campaign_id, b.question_id, b.answer, sum(b.delta) as delta,
+               coalesce(bool_or(f.rebuilding), false) as held
+          from batch b
+          left join fences f on f.campaign_id = b.campaign_id
+         where f.fenced_at is null or b.recorded_at is null or b.recorded_at >= f.fenced_at
+         group by b.campaign_id, b.question_id, b.answer
+    ), held as (
+        insert into whatsapp_tally_holds as h (campaign_id, question_id, answer, count)
+        select campaign_id, question_id, answer, delta from deltas where held
+        on conflict (campaign_id, question_id, answer)
+        do update set count = h.count + excluded.count
+    )
+    insert into whatsapp_answer_tallies as t (campaign_id, question_id, answer, count)
+    select campaign_id, question_id, answer, delta from deltas
+    on conflict (campaign_id, question_id, answer)
+    do update set count = t.count + excluded.count;
+$$;
+
+-- Starts a rebuild of one campaign at `p_fenced_at` (epoch seconds).
+create or replace function whatsapp_fence_tallies(p_campaign_id text, p_fenced_at bigint) returns void
+language sql
+as $$
+    insert into whatsapp_tally_fences as f (campaign_id, fenced_at, rebuilding)
+    values (p_campaign_id, p_fenced_at, true)
+    on conflict (campaign_id) do update set fenced_at = excluded.fenced_at, rebuilding = true;
+    delete from whatsapp_tally_holds where campaign_id = p_campaign_id;
+$$;
+
+-- Replaces every count of one campaign with a recount, plus the deltas set
+-- aside since whatsapp_fence_tallies, and ends the rebuild.
+create or replace function whatsapp_replace_tallies(p_campaign_id text, p_counts jsonb) returns void
+language sql
+as $$
+    select 1 from whatsapp_tally_fences where campaign_id = p_campaign_id for update;
+    delete from whatsapp_answer_tallies where campaign_id = p_campaign_id;
+    insert into whatsapp_answer_tallies (campaign_id, question_id, answer, count)
+    select p_campaign_id, c.question_id, c.answer, sum(c.count)
+      from (
+          select question_id, answer, count
+            from jsonb_to_recordset(p_counts) as c(question_id text, answer text, count bigint)
+          union all
+          select question_id, answer, count from whatsapp_tally_holds where campaign_id = p_campaign_id
+      ) c
+     group by c.question_id, c.answer;
+    delete from whatsapp_tally_holds where campaign_id = p_campaign_id;
+    update whatsapp_tally_fences set rebuilding = false where campaign_id = p_campaign_id;
+$$;
@@ -0,0 +1,29 @@
+-- Atomic single-answer step used by supabase_client.step_user_state
+-- (STATE_WRITE_MODE=delta). Merges p_answers into the stored answers and moves
+-- the row to p_next_step, but only while it is still at p_expected_step.
+-- Returns the updated row, or no rows when another writer got there first.
+--
+-- Compact answers (state_codec.py) carry a "_v" marker naming the flow version
+-- their option indices refer to. A patch for another version is refused
+-- (no rows) instead of relabelling the stored indices; the engine then writes
+-- the whole state, re-encoded against the current flow.
+create or replace function whatsapp_step_user_state(
+    p_phone whatsapp_user_states.phone%type,
+    p_campaign_id whatsapp_user_states.campaign_id%type,
+    p_expected_step whatsapp_user_states.current_step%type,
+    p_next_step whatsapp_user_states.current_step%type,
+    p_answers jsonb
+) returns setof whatsapp_user_states
+language sql
+as $$
+    update whatsapp_user_states
+       set answers = coalesce(answers, '{}'::jsonb) || p_answers,
+           current_step = p_next_step
+     where phone = p_phone
+       and campaign_id = p_campaign_id
+       and current_step is not distinct from p_expected_step
+       and (answers -> '_v' is null
+            or p_answers -> '_v' is null
+            or answers -> '_v' = p_answers -> '_v')
+    returning *;
+$$;
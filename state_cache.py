@@ -0,0 +1,139 @@
+"""Write-through cache of user states in front of the state backend.
+
+Reads of a cached (phone, campaign) skip the whatsapp_user_states request.
+Writes go to the backend first and, once it accepted them, replace the
+cached state and are announced on the cache bus, so every other process
+drops its copy (see cache_bus.py). Announcements carry no version: clocks
+differ between hosts, and dropping a copy that was already current only
+costs one read. A read that was in flight while its key was invalidated is
+not cached; only dropping a whole campaign (bumping the epoch) discards
+every read in flight. A failed step_user_state means the cached state was
+stale, so it is dropped.
+
+Every writer of whatsapp_user_states has to reach the bus: web workers
+(main.py) and queue consumers (event_queue.py) write through their own
+StateCache, while broadcast.py and archive_states.py announce the states
+they seed or delete (cache_bus.publisher). A writer outside these, e.g. a
+manual SQL update, needs POST /admin/invalidate.
+
+StateCache wraps the backend like campaign_cache.CampaignCache: anything
+other than the state functions is passed through. It is off unless
+STATE_CACHE_SIZE is set, since without the bus a second worker would serve
+stale states.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "0"))
+
+def _copy(state: Dict) -> Dict:
+    # Callers may change the answers dict; the cached one must stay as stored
+    return dict(state, answers=dict(state.get("answers") or {}))
+
+class StateCache:
+    """LRU of up to `capacity` states, kept coherent through `bus`."""
+    def __init__(self, backend: Any = None, bus: Any = None, capacity: int = 100_000):
+        if backend is None:
+            import supabase_client as backend
+        self.backend = backend
+        self.bus = bus
+        self.capacity = capacity
+        self.entries: "OrderedDict[Tuple[str, str], Dict]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._epoch = 0  # bumped by bulk invalidations only
+        # Backend reads in flight per key, and the keys invalidated during one
+        self._reading: Dict[Tuple[str, str], int] = {}
+        self._stale: set = set()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        return getattr(self.backend, name)
+
+    def _put(self, key: Tuple[str, str], state: Dict) -> None:
+        self.entries[key] = _copy(state)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def _announce(self, phone: str, campaign_id: str, state: Dict) -> None:
+        with self._lock:
+            self._put((phone, campaign_id), state)
+        if self.bus is not None:
+            self.bus.publish_state(phone, campaign_id)
+
+    def get_user_state(self, phone: str, campaign_id: str, flow: Any = None) -> Dict:
+        key = (phone, campaign_id)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return _copy(entry)
+            self.stats["misses"] += 1
+            epoch = self._epoch
+            self._reading[key] = self._reading.get(key, 0) + 1
+        state = None
+        try:
+            state = self.backend.get_user_state(phone, campaign_id, flow)
+        finally:
+            with self._lock:
+                readers = self._reading.pop(key) - 1
+                if readers:
+                    self._reading[key] = readers
+                # Invalidated while reading, this state may predate the change
+                stale = key in self._stale or self._epoch != epoch
+                if not readers:
+                    self._stale.discard(key)
+                # An entry stored meanwhile came from a write, which is newer
+                if state is not None and not stale and key not in self.entries:
+                    self._put(key, state)
+        return state if stale else _copy(state)
+
+    def save_user_state(self, phone: str, campaign_id: str, step: Optional[str], answers: Dict,
+                        flow: Any = None) -> bool:
+        if not self.backend.save_user_state(phone, campaign_id, step, answers, flow):
+            self.evict(phone, campaign_id)
+            return False
+        self._announce(phone, campaign_id, {
+            "phone": phone,
+            "campaign_id": campaign_id,
+            "current_step": str(step) if step else None,
+            "answers": answers,
+        })
+        return True
+
+    def step_user_state(self, phone: str, campaign_id: str, expected_step: Optional[str],
+                        next_step: Optional[str], question_id: str, answer: Any,
+                        flow: Any = None) -> Optional[Dict]:
+        state = self.backend.step_user_state(phone, campaign_id, expected_step, next_step,
+                                             question_id, answer, flow)
+        if state is None:
+            self.evict(phone, campaign_id)
+            return None
+        self._announce(phone, campaign_id, state)
+        return state
+
+    def evict(self, phone: str, campaign_id: str) -> None:
+        """Drops a cached state, and any read of it in flight."""
+        key = (phone, campaign_id)
+        with self._lock:
+            if key in self._reading:
+                self._stale.add(key)
+            if self.entries.pop(key, None) is not None:
+                self.stats["evictions"] += 1
+
+    def evict_campaign(self, campaign_id: str) -> int:
+        """Drops every cached state of a campaign; returns how many."""
+        with self._lock:
+            self._epoch += 1
+            keys = [key for key in self.entries if key[1] == campaign_id]
+            for key in keys:
+                del self.entries[key]
+            self.stats["evictions"] += len(keys)
+        return len(keys)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats, size=len(self.entries), capacity=self.capacity)
@@ -0,0 +1,84 @@
+"""Compact encoding of the answers stored in whatsapp_user_states.
+
+In compact mode a choice answer is stored as the index of the chosen option
+instead of its text, and the answers carry a schema marker naming the
+compiled flow they were encoded against:
+
+    {"_v": "c1:3f2a9b0c1d2e4f5a", "1": 0, "2": "texto livre", "3": 2}
+
+Answers without the marker are plain and pass through untouched, so rows
+written before the switch (or with STATE_ENCODING=plain) keep working.
+
+Indices only mean something against the flow that wrote them. When the
+marker names another flow version, they are not looked up in the current
+flow (its options may have been reordered, added or removed); each one is
+kept undecoded as "#<index>", which matches no option and is written back
+as text, so it is never taken for an index of the new flow.
+"""
+import os
+import json
+import logging
+from typing import Dict, Any, Optional
+
+from flow_model import Flow
+
+STATE_ENCODING = os.getenv("STATE_ENCODING", "plain").lower()
+STATE_CODEC_VERSION = 1
+SCHEMA_KEY = "_v"
+UNRESOLVED_PREFIX = "#"
+
+def log_event(message: str, data: Dict = {}):
+    log_entry = {'message': message, 'data': data}
+    logging.info(json.dumps(log_entry, ensure_ascii=False))
+
+def compact_enabled() -> bool:
+    return STATE_ENCODING == "compact"
+
+def flow_schema(flow: Flow) -> str:
+    """Schema marker tying encoded answers to one compiled flow."""
+    return f"c{STATE_CODEC_VERSION}:{flow.source_hash}"
+
+def is_compact(answers: Any) -> bool:
+    return isinstance(answers, dict) and SCHEMA_KEY in answers
+
+def encode_answers(answers: Dict, flow: Flow) -> Dict:
+    """Replaces choice answers by option indices; other answers are kept as text."""
+    if not answers:
+        return {}
+    codes = flow.option_codes()
+    encoded = {SCHEMA_KEY: flow_schema(flow)}
+    for question_id, answer in answers.items():
+        index = codes.get(question_id, {}).get(answer) if isinstance(answer, str) else None
+        encoded[question_id] = index if index is not None else answer
+    return encoded
+
+def decode_answers(stored: Dict, flow: Optional[Flow]) -> Dict:
+    """Inverse of encode_answers; plain answers are returned unchanged."""
+    if not is_compact(stored) or flow is None:
+        return stored
+    schema = stored[SCHEMA_KEY]
+    current = schema == flow_schema(flow)
+    if not current:
+        log_event("Answers encoded for another flow version", {
+            "stored_schema": schema,
+            "current_schema": flow_schema(flow)
+        })
+    decoded = {}
+    for question_id, answer in stored.items():
+        if question_id == SCHEMA_KEY:
+            continue
+        if isinstance(answer, int) and not isinstance(answer, bool):
+            if not current:
+                decoded[question_id] = f"{UNRESOLVED_PREFIX}{answer}"
+                continue
+            question = flow.find(question_id)
+            options = question.options if question is not None else ()
+            answer = options[answer].text if 0 <= answer < len(options) else str(answer)
+        decoded[question_id] = answer
+    return decoded
+
+def answers_for_storage(answers: Dict, flow: Optional[Flow]) -> Dict:
+    """The answers as they are written (and logged) under the configured encoding."""
+    if compact_enabled() and flow is not None:
+        return encode_answers(answers, flow)
+    return answers
@@ -0,0 +1,82 @@
+"""In-process stand-in for the Supabase state backend.
+
+InMemoryStateStore exposes the same functions the engine calls on
+supabase_client (get_campaign, get_campaign_by_code, get_user_state,
+save_user_state, step_user_state) with the same semantics, including the
+whatsapp_step_user_state RPC and compact answer encoding. Pass it as
+`store` to process_message/SurveyProcessor to run the engine without a
+backend, e.g. in tests, replays and simulations.
+"""
+import copy
+import threading
+from typing import Dict, Any, Optional
+
+from state_codec import SCHEMA_KEY, decode_answers, answers_for_storage
+
+class InMemoryStateStore:
+    """Thread-safe dict-backed state store keyed by (phone, campaign_id)."""
+    def __init__(self, campaigns: Optional[Dict[str, Dict]] = None, codes: Optional[Dict[str, str]] = None):
+        self.campaigns = campaigns if campaigns is not None else {}
+        self.codes = codes if codes is not None else {}
+        self.rows: Dict[tuple, Dict] = {}
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def get_campaign(self, campaign_id: str) -> Optional[Dict]:
+        self._count("get_campaign")
+        return self.campaigns.get(campaign_id)
+
+    def get_campaign_by_code(self, code: str) -> Optional[Dict]:
+        self._count("get_campaign_by_code")
+        campaign_id = self.codes.get(code)
+        return self.campaigns.get(campaign_id) if campaign_id else None
+
+    def get_user_state(self, phone: str, campaign_id: str, flow: Optional[Dict] = None) -> Dict:
+        self._count("get_user_state")
+        with self._lock:
+            row = self.rows.get((phone, campaign_id))
+            if row is None:
+                return {"current_step": None, "answers": {}}
+            state = copy.deepcopy(row)
+        if state.get("answers"):
+            state["answers"] = decode_answers(state["answers"], flow)
+        return state
+
+    def save_user_state(self, phone: str, campaign_id: str, step: Optional[str], answers: Dict,
+                        flow: Optional[Dict] = None) -> bool:
+        self._count("save_user_state")
+        if not isinstance(answers, dict):
+            return False
+        stored = copy.deepcopy(answers_for_storage(answers, flow))
+        with self._lock:
+            self.rows[(phone, campaign_id)] = {
+                "phone": phone,
+                "campaign_id": campaign_id,
+                "current_step": str(step) if step else None,
+                "answers": stored,
+            }
+        return True
+
+    def step_user_state(self, phone: str, campaign_id: str, expected_step: Optional[str],
+                        next_step: Optional[str], question_id: str, answer: Any,
+                        flow: Optional[Dict] = None) -> Optional[Dict]:
+        """Same contract as the whatsapp_step_user_state RPC."""
+        self._count("step_user_state")
+        expected = str(expected_step) if expected_step else None
+        patch = answers_for_storage({question_id: answer}, flow)
+        with self._lock:
+            row = self.rows.get((phone, campaign_id))
+            if row is None or row["current_step"] != expected:
+                return None
+            stored_schema = (row.get("answers") or {}).get(SCHEMA_KEY)
+            if stored_schema and SCHEMA_KEY in patch and patch[SCHEMA_KEY] != stored_schema:
+                return None  # indices of another flow version; the engine rewrites the state
+            row["answers"] = dict(row.get("answers") or {}, **copy.deepcopy(patch))
+            row["current_step"] = str(next_step) if next_step else None
+            state = copy.deepcopy(row)
+        if state.get("answers"):
+            state["answers"] = decode_answers(state["answers"], flow)
+        return state
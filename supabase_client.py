@@ -1,23 +1,15 @@
 import os
-import requests
 from dotenv import load_dotenv
 import logging
 import json
-from typing import Dict, Any, Optional
+import queue
+import threading
+from typing import Dict, Any, Iterator, List, Optional
+from state_codec import decode_answers, answers_for_storage
+from resilience import BackendUnavailable, request
 
-# Configurar logging para supabase.log
-logging.basicConfig(
-    filename='supabase.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-
-# Configuração de log específico para petition.log
+# Handlers são configurados por log_config.configure_logging()
 petition_logger = logging.getLogger('petition')
-petition_handler = logging.FileHandler('/home/flow_engine/petition.log')
-petition_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-petition_logger.addHandler(petition_handler)
-petition_logger.setLevel(logging.INFO)
 
 def log_event(message: str, data: Dict = {}):
     log_entry = {'message': message, 'data': data}
@@ -27,25 +19,36 @@ def log_petition_event(message: str, data: Dict = {}):
     log_entry = {'message': message, 'data': data}
     petition_logger.info(json.dumps(log_entry, ensure_ascii=False))
 
-load_dotenv()
-
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
+# Lidos do .env/ambiente no primeiro acesso, não na importação
+SUPABASE_URL: Optional[str] = None
+SUPABASE_KEY: Optional[str] = None
+HEADERS: Dict[str, str] = {}
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    log_event("Erro: Variáveis de ambiente SUPABASE_URL ou SUPABASE_KEY não definidas")
-    raise ValueError("Supabase URL ou Key não configurados")
+def configure(url: Optional[str] = None, key: Optional[str] = None) -> None:
+    """Loads the Supabase credentials from the arguments, .env or the environment."""
+    global SUPABASE_URL, SUPABASE_KEY
+    load_dotenv()
+    url = url or os.getenv("SUPABASE_URL")
+    key = key or os.getenv("SUPABASE_SERVICE_KEY")
+    if not url or not key:
+        log_event("Erro: Variáveis de ambiente SUPABASE_URL ou SUPABASE_KEY não definidas")
+        raise ValueError("Supabase URL ou Key não configurados")
+    HEADERS.update({
+        "apikey": key,
+        "Authorization": f"Bearer {key}",
+        "Content-Type": "application/json",
+    })
+    SUPABASE_URL, SUPABASE_KEY = url, key
 
-HEADERS = {
-    "apikey": SUPABASE_KEY,
-    "Authorization": f"Bearer {SUPABASE_KEY}",
-    "Content-Type": "application/json",
-}
+def _rest_url(path: str) -> str:
+    if not SUPABASE_URL:
+        configure()
+    return f"{SUPABASE_URL}/rest/v1/{path}"
 
 def get_campaign(campaign_id: str) -> Optional[Dict]:
-    url = f"{SUPABASE_URL}/rest/v1/iap_campaigns?campaign_id=eq.{campaign_id}"
+    url = _rest_url(f"iap_campaigns?campaign_id=eq.{campaign_id}")
     try:
-        res = requests.get(url, headers=HEADERS, timeout=10)
+        res = request("GET", url, headers=HEADERS, timeout=10)
         if res.status_code == 200 and res.json():
             campaign = res.json()[0]
             log_event("Campanha carregada", {"campaign_id": campaign_id, "campaign": campaign})
@@ -61,9 +64,9 @@ def get_campaign(campaign_id: str) -> Optional[Dict]:
         return None
 
 def get_campaign_by_code(code: str) -> Optional[Dict]:
-    url = f"{SUPABASE_URL}/rest/v1/iap_campaign_codes?code=eq.{code}&select=campaign_id"
+    url = _rest_url(f"iap_campaign_codes?code=eq.{code}&select=campaign_id")
     try:
-        res = requests.get(url, headers=HEADERS, timeout=10)
+        res = request("GET", url, headers=HEADERS, timeout=10)
         if res.status_code == 200 and res.json():
             campaign_id = res.json()[0]['campaign_id']
             log_event("Campanha encontrada por código", {"code": code, "campaign_id": campaign_id})
@@ -78,35 +81,51 @@ def get_campaign_by_code(code: str) -> Optional[Dict]:
         log_event("Erro ao buscar campanha por código", {"code": code, "error": str(e)})
         return None
 
-def get_user_state(phone: str, campaign_id: str) -> Dict:
-    url = f"{SUPABASE_URL}/rest/v1/whatsapp_user_states?phone=eq.{phone}&campaign_id=eq.{campaign_id}&limit=1"
+def get_user_state(phone: str, campaign_id: str, flow: Optional[Dict] = None) -> Dict:
+    """Loads a user's state; compact answers are decoded against `flow`.
+
+    Raises BackendUnavailable when the state could not be read, so a failed
+    read never looks like a user without state.
+    """
+    url = _rest_url(f"whatsapp_user_states?phone=eq.{phone}&campaign_id=eq.{campaign_id}&limit=1")
     try:
-        res = requests.get(url, headers=HEADERS, timeout=10)
-        if res.status_code == 200 and res.json():
-            state = res.json()[0]
-            log_event("Estado do usuário carregado", {
-                "phone": phone,
-                "campaign_id": campaign_id,
-                "state": state
-            })
-            return state
-        log_event("Nenhum estado encontrado, retornando padrão", {
+        res = request("GET", url, headers=HEADERS, timeout=10)
+        rows = res.json() if res.status_code == 200 else None
+    except (BackendUnavailable, ValueError) as e:
+        log_event("Erro ao carregar estado do usuário", {
+            "phone": phone,
+            "campaign_id": campaign_id,
+            "error": str(e)
+        })
+        raise BackendUnavailable(str(e)) from e
+    if rows is None:
+        log_event("Falha ao carregar estado do usuário", {
             "phone": phone,
             "campaign_id": campaign_id,
             "status_code": res.status_code,
             "response": res.text
         })
-        return {"current_step": None, "answers": {}}
-    except Exception as e:
-        log_event("Erro ao carregar estado do usuário", {
+        raise BackendUnavailable(f"whatsapp_user_states: {res.status_code}")
+    if rows:
+        state = rows[0]
+        log_event("Estado do usuário carregado", {
             "phone": phone,
             "campaign_id": campaign_id,
-            "error": str(e)
+            "state": state
         })
-        return {"current_step": None, "answers": {}}
+        if state.get("answers"):
+            state["answers"] = decode_answers(state["answers"], flow)
+        return state
+    log_event("Nenhum estado encontrado, retornando padrão", {
+        "phone": phone,
+        "campaign_id": campaign_id
+    })
+    return {"current_step": None, "answers": {}}
 
-def save_user_state(phone: str, campaign_id: str, step: Optional[str], answers: Dict) -> bool:
-    url = f"{SUPABASE_URL}/rest/v1/whatsapp_user_states"
+def save_user_state(phone: str, campaign_id: str, step: Optional[str], answers: Dict,
+                    flow: Optional[Dict] = None) -> bool:
+    """Upserts a user's state; with STATE_ENCODING=compact and a `flow`, answers are stored compactly."""
+    url = _rest_url("whatsapp_user_states")
     # Validação do payload
     if not isinstance(answers, dict):
         log_event("Erro: answers não é um dicionário", {
@@ -125,6 +144,7 @@ def save_user_state(phone: str, campaign_id: str, step: Optional[str], answers:
             "error": str(e)
         })
         return False
+    answers = answers_for_storage(answers, flow)
     payload = {
         "phone": phone,
         "campaign_id": campaign_id,
@@ -143,7 +163,7 @@ def save_user_state(phone: str, campaign_id: str, step: Optional[str], answers:
         "answers": answers
     })
     try:
-        res = requests.post(url, headers=headers, params=params, json=payload, timeout=10)
+        res = request("POST", url, headers=headers, params=params, json=payload, timeout=10)
         success = res.status_code in (200, 201)
         log_event("Resultado do salvamento de estado", {
             "phone": phone,
@@ -177,4 +197,233 @@ def save_user_state(phone: str, campaign_id: str, step: Optional[str], answers:
             "answers": answers,
             "error": str(e)
         })
-        return False
\ No newline at end of file
+        return False
+
+def step_user_state(phone: str, campaign_id: str, expected_step: Optional[str], next_step: Optional[str],
+                    question_id: str, answer: Any, flow: Optional[Dict] = None) -> Optional[Dict]:
+    """Records one answer and moves to `next_step` in a single atomic RPC.
+
+    Only the new answer travels; the server merges it into the stored answers
+    if the row is still at `expected_step` and its compact answers were encoded
+    against the same flow. Returns the updated state, or None when the step
+    moved on concurrently, the stored answers belong to another flow version,
+    or the call failed.
+    """
+    url = _rest_url("rpc/whatsapp_step_user_state")
+    payload = {
+        "p_phone": phone,
+        "p_campaign_id": campaign_id,
+        "p_expected_step": str(expected_step) if expected_step else None,
+        "p_next_step": str(next_step) if next_step else None,
+        "p_answers": answers_for_storage({question_id: answer}, flow),
+    }
+    try:
+        res = request("POST", url, headers=HEADERS, json=payload, timeout=10)
+        if res.status_code == 200 and res.json():
+            state = res.json()[0]
+            log_event("Estado do usuário avançado", {
+                "phone": phone,
+                "campaign_id": campaign_id,
+                "expected_step": expected_step,
+                "next_step": next_step,
+                "answer": payload["p_answers"]
+            })
+            if state.get("answers"):
+                state["answers"] = decode_answers(state["answers"], flow)
+            return state
+        log_event("Conflito ou falha ao avançar estado do usuário", {
+            "phone": phone,
+            "campaign_id": campaign_id,
+            "expected_step": expected_step,
+            "status_code": res.status_code,
+            "response": res.text
+        })
+        return None
+    except Exception as e:
+        log_event("Erro ao avançar estado do usuário", {
+            "phone": phone,
+            "campaign_id": campaign_id,
+            "expected_step": expected_step,
+            "error": str(e)
+        })
+        return None
+
+def select_rows(table: str, params: Dict[str, str], timeout: int = 30) -> List[Dict]:
+    """Runs a filtered select. Raises on errors so batch jobs never mistake a failed read for no rows."""
+    url = _rest_url(table)
+    try:
+        res = request("GET", url, headers=HEADERS, params=params, timeout=timeout)
+    except Exception as e:
+        log_event("Erro ao consultar tabela", {"table": table, "params": params, "error": str(e)})
+        raise
+    if res.status_code != 200:
+        log_event("Falha ao consultar tabela", {
+            "table": table,
+            "params": params,
+            "status_code": res.status_code,
+            "response": res.text
+        })
+        raise RuntimeError(f"Falha ao consultar {table}: {res.status_code}")
+    return res.json()
+
+def iter_pages(table: str, select: str = "*", key: str = "id", page_size: int = 1000,
+               after: Optional[str] = None, filters: Optional[Dict[str, str]] = None,
+               prefetch: int = 0) -> Iterator[List[Dict]]:
+    """Streams a table in pages ordered by `key`, using keyset pagination.
+
+    `after` resumes after a previously seen key; `filters` are extra PostgREST
+    filters such as {"campaign_id": "eq.X"}. With `prefetch`, up to that many
+    pages are fetched ahead in a background thread while the caller works.
+    """
+    pages = _iter_pages(table, select, key, page_size, after, filters)
+    return _prefetched(pages, prefetch) if prefetch > 0 else pages
+
+def _iter_pages(table: str, select: str, key: str, page_size: int, after: Optional[str],
+                filters: Optional[Dict[str, str]]) -> Iterator[List[Dict]]:
+    while True:
+        params = dict(filters or {})
+        params.update({"select": select, "order": f"{key}.asc", "limit": str(page_size)})
+        if after is not None:
+            params[key] = f"gt.{after}"
+        rows = select_rows(table, params)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        after = rows[-1][key]
+
+_DONE = object()
+
+def _prefetched(items: Iterator, depth: int) -> Iterator:
+    """Runs `items` in a daemon thread, at most `depth` items ahead; errors reach the caller."""
+    buffer: queue.Queue = queue.Queue(maxsize=depth)
+    abandoned = threading.Event()
+
+    def produce() -> None:
+        try:
+            for item in items:
+                while not abandoned.is_set():
+                    try:
+                        buffer.put(item, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+                if abandoned.is_set():
+                    return
+            buffer.put(_DONE)
+        except BaseException as e:
+            buffer.put(e)
+
+    threading.Thread(target=produce, name="prefetch", daemon=True).start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        abandoned.set()
+
+def bulk_upsert(table: str, rows: List[Dict], on_conflict: str, ignore_duplicates: bool = False) -> bool:
+    """Upserts many rows in a single request."""
+    if not rows:
+        return True
+    url = _rest_url(table)
+    headers = HEADERS.copy()
+    headers["Prefer"] = "resolution=ignore-duplicates" if ignore_duplicates else "resolution=merge-duplicates"
+    try:
+        res = request("POST", url, headers=headers, params={"on_conflict": on_conflict}, json=rows, timeout=60)
+        success = res.status_code in (200, 201, 204)
+        log_event("Resultado do upsert em lote", {
+            "table": table,
+            "rows": len(rows),
+            "status_code": res.status_code,
+            "response": res.text if not success else "",
+            "success": success
+        })
+        return success
+    except Exception as e:
+        log_event("Erro no upsert em lote", {"table": table, "rows": len(rows), "error": str(e)})
+        return False
+
+def insert_rows(table: str, rows: List[Dict]) -> bool:
+    """Inserts many rows in a single request."""
+    if not rows:
+        return True
+    url = _rest_url(table)
+    try:
+        res = request("POST", url, headers=HEADERS, json=rows, timeout=60)
+        success = res.status_code in (200, 201, 204)
+        log_event("Resultado da inserção em lote", {
+            "table": table,
+            "rows": len(rows),
+            "status_code": res.status_code,
+            "response": res.text if not success else "",
+            "success": success
+        })
+        return success
+    except Exception as e:
+        log_event("Erro na inserção em lote", {"table": table, "rows": len(rows), "error": str(e)})
+        return False
+
+def call_rpc(function: str, params: Dict[str, Any], timeout: int = 60) -> bool:
+    """Calls a database function whose result is not needed; returns whether it succeeded."""
+    url = _rest_url(f"rpc/{function}")
+    try:
+        res = request("POST", url, headers=HEADERS, json=params, timeout=timeout)
+        success = res.status_code in (200, 204)
+        if not success:
+            log_event("Falha ao chamar função", {
+                "function": function,
+                "status_code": res.status_code,
+                "response": res.text
+            })
+        return success
+    except Exception as e:
+        log_event("Erro ao chamar função", {"function": function, "error": str(e)})
+        return False
+
+def update_rows(table: str, params: Dict[str, str], values: Dict[str, Any], returning: str = "*") -> Optional[int]:
+    """Sets `values` on the rows matching PostgREST filters, leaving every other
+    column alone; returns how many rows changed, or None on failure."""
+    url = _rest_url(table)
+    headers = HEADERS.copy()
+    headers["Prefer"] = "return=representation"
+    try:
+        res = request("PATCH", url, headers=headers, params=dict(params, select=returning), json=values, timeout=60)
+        if res.status_code in (200, 204):
+            return len(res.json()) if res.text else 0
+        log_event("Falha ao atualizar linhas", {
+            "table": table,
+            "status_code": res.status_code,
+            "response": res.text
+        })
+        return None
+    except Exception as e:
+        log_event("Erro ao atualizar linhas", {"table": table, "error": str(e)})
+        return None
+
+def delete_rows(table: str, params: Dict[str, str], returning: str = "*") -> Optional[int]:
+    """Deletes the rows matching PostgREST filters; returns how many, or None on failure.
+
+    `returning` selects the columns echoed back to count the deleted rows.
+    """
+    url = _rest_url(table)
+    headers = HEADERS.copy()
+    headers["Prefer"] = "return=representation"
+    try:
+        res = request("DELETE", url, headers=headers, params=dict(params, select=returning), timeout=60)
+        if res.status_code in (200, 204):
+            return len(res.json()) if res.text else 0
+        log_event("Falha ao remover linhas", {
+            "table": table,
+            "status_code": res.status_code,
+            "response": res.text
+        })
+        return None
+    except Exception as e:
+        log_event("Erro ao remover linhas", {"table": table, "error": str(e)})
+        return None
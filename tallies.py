@@ -0,0 +1,252 @@
+"""Live answer counts per campaign, question and option.
+
+process() reports every successful state change to the process-wide
+`tally_counter` as the difference between the answers before and after.
+A changed answer moves one count from the old option to the new one. A
+restarted survey takes its answers back out. Only deltas are kept in
+memory. They are flushed in batches through the whatsapp_add_tallies RPC
+(sql/whatsapp_answer_tallies.sql), and a failed flush keeps them for the
+next attempt.
+
+Counts therefore survive restarts. Only deltas that were not yet flushed
+are lost when a process dies. `python tallies.py --rebuild` recomputes a
+campaign from whatsapp_user_states, plus the sessions archive_states.py
+moved out (--archive-table / --archive-dir, as in analytics.py), whose
+counts were never taken back out; run it after a crash.
+
+A rebuild runs while the service keeps counting, so it is fenced:
+pending deltas are kept per second of recording, and the rebuild starts
+its recount on a whole second, its fence. whatsapp_add_tallies drops the
+deltas recorded before the fence, which the recount already holds, and
+sets aside those recorded after it while the rebuild runs.
+whatsapp_replace_tallies then writes the recount plus what was set aside.
+Sessions that change while the recount pages past them are the
+remaining race; the boundary also assumes hosts with synced clocks.
+
+Reading a campaign's tallies costs one select of its tally rows, one per
+option, plus this process's unflushed deltas, whatever the number of
+respondents.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import threading
+from collections import defaultdict
+from typing import Dict, Any, List, Optional, Tuple
+
+from flow_model import Flow
+
+TALLY_FLUSH_SECONDS = float(os.getenv("TALLY_FLUSH_SECONDS", "5"))
+TALLY_FLUSH_BATCH = 1000  # deltas per RPC call
+TALLIES_TABLE = "whatsapp_answer_tallies"
+ANSWERED = ""  # answer key counting respondents of a question
+COMPLETED = "_completed"  # question key counting completed sessions
+
+def log_event(message: str, data: Dict = {}):
+    log_entry = {'message': message, 'data': data}
+    logging.info(json.dumps(log_entry, ensure_ascii=False))
+
+def _is_completed(state: Dict) -> bool:
+    return state.get("current_step") is None and bool(state.get("answers"))
+
+def transition_deltas(flow: Flow, before: Dict, after: Dict) -> Dict[Tuple[str, str], int]:
+    """Count changes, {(question_id, answer): delta}, of moving from state `before` to `after`."""
+    deltas: Dict[Tuple[str, str], int] = defaultdict(int)
+    old = before.get("answers") or {}
+    new = after.get("answers") or {}
+
+    def add(question_id: str, answer: Any, delta: int) -> None:
+        question = flow.find(question_id)
+        if question is None:
+            return
+        deltas[(question.id, ANSWERED)] += delta
+        if question.is_choice:
+            deltas[(question.id, str(answer))] += delta
+
+    if old is not new:
+        for question_id in old.keys() | new.keys():
+            previous, current = old.get(question_id), new.get(question_id)
+            if previous == current:
+                continue
+            if previous is not None:
+                add(question_id, previous, -1)
+            if current is not None:
+                add(question_id, current, 1)
+    completed = _is_completed(after) - _is_completed(before)
+    if completed:
+        deltas[(COMPLETED, ANSWERED)] += completed
+    return {key: delta for key, delta in deltas.items() if delta}
+
+class TallyCounter:
+    """Unflushed count deltas, by campaign; safe to use from any thread."""
+    def __init__(self, backend: Any = None):
+        self._backend = backend
+        # campaign_id -> {(question_id, answer, second recorded): delta}
+        self.pending: Dict[str, Dict[Tuple[str, str, int], int]] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    @property
+    def backend(self) -> Any:
+        if self._backend is None:
+            import supabase_client
+            self._backend = supabase_client
+        return self._backend
+
+    def record(self, campaign_id: str, flow: Flow, before: Dict, after: Dict) -> None:
+        deltas = transition_deltas(flow, before, after)
+        if not deltas:
+            return
+        self.merge(campaign_id, deltas)
+
+    def merge(self, campaign_id: str, deltas: Dict[Tuple[str, str], int], recorded_at: Optional[int] = None) -> None:
+        second = int(time.time()) if recorded_at is None else recorded_at
+        with self._lock:
+            pending = self.pending.setdefault(campaign_id, {})
+            for (question_id, answer), delta in deltas.items():
+                key = (question_id, answer, second)
+                pending[key] = pending.get(key, 0) + delta
+
+    def pending_for(self, campaign_id: str) -> Dict[Tuple[str, str], int]:
+        totals: Dict[Tuple[str, str], int] = defaultdict(int)
+        with self._lock:
+            for (question_id, answer, _), delta in self.pending.get(campaign_id, {}).items():
+                totals[(question_id, answer)] += delta
+        return dict(totals)
+
+    def flush(self) -> int:
+        """Sends every pending delta; returns how many were stored."""
+        with self._flush_lock:
+            with self._lock:
+                taken, self.pending = self.pending, {}
+            rows = [
+                {"campaign_id": campaign_id, "question_id": question_id, "answer": answer, "delta": delta,
+                 "recorded_at": second}
+                for campaign_id, deltas in taken.items()
+                for (question_id, answer, second), delta in deltas.items() if delta
+            ]
+            stored = 0
+            for start in range(0, len(rows), TALLY_FLUSH_BATCH):
+                batch = rows[start:start + TALLY_FLUSH_BATCH]
+                if not self.backend.call_rpc("whatsapp_add_tallies", {"p_deltas": batch}):
+                    # Put the rest back; deltas commute, so later records simply add up
+                    for row in rows[start:]:
+                        self.merge(row["campaign_id"], {(row["question_id"], row["answer"]): row["delta"]},
+                                   row["recorded_at"])
+                    log_event("Falha ao gravar contagens; nova tentativa no próximo ciclo",
+                              {"pending": len(rows) - start})
+                    break
+                stored += len(batch)
+            return stored
+
+    async def run(self, stop: asyncio.Event, interval: float = TALLY_FLUSH_SECONDS) -> None:
+        """Flushes every `interval` seconds until `stop` is set, then once more."""
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                log_event("Erro ao gravar contagens", {"error": str(e)})
+
+# Shared by every SurveyProcessor in the process
+tally_counter = TallyCounter()
+
+def campaign_tallies(campaign_id: str, flow: Flow, counter: Optional[TallyCounter] = None) -> Dict[str, Any]:
+    """Stored counts plus this process's unflushed deltas, in flow order."""
+    from supabase_client import select_rows
+
+    counter = counter or tally_counter
+    counts: Dict[Tuple[str, str], int] = defaultdict(int)
+    rows = select_rows(TALLIES_TABLE, {
+        "select": "question_id,answer,count",
+        "campaign_id": f"eq.{campaign_id}",
+    })
+    for row in rows:
+        counts[(row["question_id"], row["answer"])] += row["count"]
+    for key, delta in counter.pending_for(campaign_id).items():
+        counts[key] += delta
+    questions = []
+    for question in flow.questions:
+        entry = {"id": question.id, "text": question.text, "answered": counts.get((question.id, ANSWERED), 0)}
+        if question.is_choice:
+            entry["options"] = {opt.text: counts.get((question.id, opt.text), 0) for opt in question.options}
+        questions.append(entry)
+    return {
+        "campaign_id": campaign_id,
+        "completed": counts.get((COMPLETED, ANSWERED), 0),
+        "questions": questions,
+    }
+
+def rebuild(campaign: Dict, page_size: int = 1000, archive_table: Optional[str] = None,
+            archive_key: str = "id", archive_dir: Optional[str] = None) -> Dict[str, int]:
+    """Recounts a campaign from its live and archived sessions and replaces its stored tallies."""
+    from analytics import iter_archive_files
+    from flow_compiler import get_compiled_flow
+    from state_codec import decode_answers
+    import supabase_client
+
+    campaign_id = campaign["campaign_id"]
+    flow = get_compiled_flow(campaign)
+    # Deltas fall wholly before or after a fence on a whole second. The fence
+    # is set ahead of time, so every delta from that second on is set aside.
+    fence = int(time.time()) + 2
+    if not supabase_client.call_rpc("whatsapp_fence_tallies", {"p_campaign_id": campaign_id, "p_fenced_at": fence}):
+        raise RuntimeError(f"Falha ao iniciar a recontagem de {campaign_id}")
+    time.sleep(max(0.0, fence - time.time()))
+    filters = {"campaign_id": f"eq.{campaign_id}"}
+    sources = [supabase_client.iter_pages("whatsapp_user_states", select="phone,current_step,answers",
+                                          key="phone", page_size=page_size, filters=filters)]
+    if archive_table:
+        # Archived sessions repeat phones, so they are paged by the table's own unique key
+        sources.append(supabase_client.iter_pages(archive_table, select=f"{archive_key},current_step,answers",
+                                                  key=archive_key, page_size=page_size, filters=filters))
+    if archive_dir:
+        sources.append(iter_archive_files(archive_dir, campaign_id, page_size))
+    empty = {"current_step": None, "answers": {}}
+    counts: Dict[Tuple[str, str], int] = defaultdict(int)
+    states = 0
+    for pages in sources:
+        for page in pages:
+            for row in page:
+                row["answers"] = decode_answers(row.get("answers") or {}, flow)
+                for key, delta in transition_deltas(flow, empty, row).items():
+                    counts[key] += delta
+                states += 1
+    payload = [{"question_id": q, "answer": a, "count": c} for (q, a), c in counts.items() if c]
+    if not supabase_client.call_rpc("whatsapp_replace_tallies", {"p_campaign_id": campaign_id, "p_counts": payload}):
+        raise RuntimeError(f"Falha ao gravar contagens de {campaign_id}")
+    return {"states": states, "rows": len(payload)}
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Show or rebuild a campaign's answer tallies.")
+    parser.add_argument("--campaign-id", required=True)
+    parser.add_argument("--rebuild", action="store_true", help="recount from whatsapp_user_states")
+    parser.add_argument("--archive-table", help="with --rebuild, also recount sessions archived to this table")
+    parser.add_argument("--archive-key", default="id", help="unique column to page the archive table by")
+    parser.add_argument("--archive-dir", help="with --rebuild, also recount archive_states.py NDJSON files")
+    args = parser.parse_args(argv)
+
+    from log_config import configure_logging
+    from flow_compiler import get_compiled_flow
+    from supabase_client import get_campaign
+    configure_logging("supabase.log")
+    campaign = get_campaign(args.campaign_id)
+    if not campaign:
+        print(f"{args.campaign_id}: campanha não encontrada", file=sys.stderr)
+        return 1
+    if args.rebuild:
+        result = rebuild(campaign, archive_table=args.archive_table, archive_key=args.archive_key,
+                         archive_dir=args.archive_dir)
+        print(f"{result['states']} estados recontados, {result['rows']} contagens gravadas", file=sys.stderr)
+    print(json.dumps(campaign_tallies(args.campaign_id, get_compiled_flow(campaign)), ensure_ascii=False, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
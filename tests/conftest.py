@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Nothing may reach a real backend from the tests
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_SERVICE_KEY", "test")
+os.environ.setdefault("FLOW_ENGINE_LOG_DIR", tempfile.mkdtemp(prefix="flow_engine_logs"))
+os.environ.setdefault("CACHE_BUS_DIR", tempfile.mkdtemp(prefix="flow_engine_bus"))
+os.environ.setdefault("FLOW_ARTIFACT_DIR", os.path.join(ROOT, "tests", "compiled_flows"))
@@ -0,0 +1,35 @@
+"""Every /admin route goes through main.require_admin."""
+import pytest
+from fastapi.routing import APIRoute
+from fastapi.testclient import TestClient
+
+import main
+
+ADMIN_ROUTES = sorted((route.path, method) for route in main.app.routes + main.admin.routes
+                      if isinstance(route, APIRoute) and route.path.startswith("/admin")
+                      for method in route.methods)
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "s3cret")
+    return TestClient(main.app)
+
+@pytest.mark.parametrize("path,method", ADMIN_ROUTES)
+def test_admin_routes_need_the_token(client, path, method):
+    assert client.request(method, path).status_code == 401
+    assert client.request(method, path, headers={"Authorization": "Bearer errado"}).status_code == 401
+
+def test_export_needs_the_token(client):
+    assert client.get("/campaigns/abc/export").status_code == 401
+
+def test_token_accepted_in_either_header(client):
+    assert client.get("/admin/admission", headers={"Authorization": "Bearer s3cret"}).status_code == 200
+    assert client.get("/admin/admission", headers={"X-Admin-Token": "s3cret"}).status_code == 200
+
+def test_admin_routes_closed_without_configured_token(client, monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "")
+    assert client.get("/admin/admission", headers={"X-Admin-Token": ""}).status_code == 503
+
+def test_traces_need_the_token(client):
+    assert client.get("/admin/traces").status_code == 401
+    assert client.get("/admin/traces", headers={"X-Admin-Token": "s3cret"}).status_code == 200
@@ -0,0 +1,19 @@
+"""archive_states: deleted sessions are announced to the state caches."""
+import archive_states
+
+def test_deleted_sessions_are_announced(monkeypatch):
+    import supabase_client
+
+    announced = []
+
+    class Bus:
+        def publish_states(self, campaign_id, phones):
+            announced.append((campaign_id, phones))
+
+    monkeypatch.setattr(supabase_client, "delete_rows", lambda table, params, returning=None: 3)
+    rows = [{"phone": "55", "campaign_id": "a", "current_step": None},
+            {"phone": "56", "campaign_id": "b", "current_step": None},
+            {"phone": "57", "campaign_id": "a", "current_step": "2"}]
+    monkeypatch.setattr(archive_states, "write_archive_file", lambda directory, records: "x")
+    assert archive_states.archive_batch(rows, None, "/unused", "updated_at", Bus()) == 3
+    assert sorted(announced) == [("a", ["55", "57"]), ("b", ["56"])]
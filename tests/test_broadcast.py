@@ -0,0 +1,112 @@
+"""broadcast.py against a fake Graph sender and a fake bulk upsert."""
+import csv
+import json
+import threading
+
+import pytest
+
+import broadcast
+
+CAMPAIGN = {
+    "campaign_id": "camp-broadcast",
+    "questions_json": {"questions": [{"id": "1", "text": "Você participa?", "type": "text"}]},
+}
+
+class FakeGraph:
+    """Stands in for send_message; phones in `failing` get a 400, in `raising` an exception."""
+    def __init__(self, failing=(), raising=()):
+        self.failing = set(failing)
+        self.raising = set(raising)
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def __call__(self, payload, phone_number_id, session=None):
+        to = payload["to"]
+        if to in self.raising:
+            raise RuntimeError("access token not found")
+        with self._lock:
+            self.sent.append(to)
+        if to in self.failing:
+            return False, 400, '{"error": "invalid"}'
+        return True, 200, "{}"
+
+@pytest.fixture
+def contacts(tmp_path):
+    path = tmp_path / "contacts.csv"
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["phone", "nome"])
+        for i in range(10):
+            writer.writerow([f"55119999900{i:02d}", f"Pessoa {i}"])
+    return str(path)
+
+@pytest.fixture
+def seeded(monkeypatch):
+    batches = []
+    monkeypatch.setattr(broadcast, "seed_states", lambda campaign_id, first_step, phones: batches.append(phones))
+    return batches
+
+def run(path, tmp_path, **kwargs):
+    return broadcast.broadcast(path, CAMPAIGN, "abertura", "123", batch_size=4, concurrency=4, rate=0,
+                               checkpoint_path=str(tmp_path / "checkpoint.json"),
+                               failures_path=str(tmp_path / "failures.csv"), **kwargs)
+
+def read_failures(tmp_path):
+    with open(tmp_path / "failures.csv", newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+def test_sends_and_seeds_every_contact(contacts, tmp_path, seeded, monkeypatch):
+    graph = FakeGraph()
+    monkeypatch.setattr(broadcast, "send_message", graph)
+    result = run(contacts, tmp_path)
+    assert sorted(graph.sent) == [f"55119999900{i:02d}" for i in range(10)]
+    assert [len(batch) for batch in seeded] == [4, 4, 2]
+    assert (result["rows_done"], result["seeded"], result["sent"], result["failed"]) == (10, 10, 10, 0)
+
+def test_send_exceptions_are_recorded_not_raised(contacts, tmp_path, seeded, monkeypatch):
+    graph = FakeGraph(failing={"5511999990001"}, raising={"5511999990002", "5511999990007"})
+    monkeypatch.setattr(broadcast, "send_message", graph)
+    result = run(contacts, tmp_path)
+    assert (result["rows_done"], result["sent"], result["failed"]) == (10, 7, 3)
+    failures = read_failures(tmp_path)
+    assert sorted(row["phone"] for row in failures) == ["5511999990001", "5511999990002", "5511999990007"]
+    assert any("RuntimeError" in row["error"] for row in failures)
+    with open(tmp_path / "checkpoint.json", encoding="utf-8") as f:
+        assert json.load(f)["rows_done"] == 10
+
+def test_checkpoint_saved_when_run_stops(contacts, tmp_path, monkeypatch):
+    graph = FakeGraph()
+    monkeypatch.setattr(broadcast, "send_message", graph)
+    calls = []
+
+    def seed_states(campaign_id, first_step, phones):
+        calls.append(phones)
+        if len(calls) == 3:
+            raise RuntimeError("Falha ao semear lote")
+
+    monkeypatch.setattr(broadcast, "seed_states", seed_states)
+    with pytest.raises(RuntimeError):
+        run(contacts, tmp_path)
+    # Both batches sent before the failure are settled and checkpointed
+    with open(tmp_path / "checkpoint.json", encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    assert (checkpoint["rows_done"], checkpoint["seeded"], checkpoint["sent"]) == (8, 8, 8)
+
+    # The resumed run only handles the rest
+    graph.sent.clear()
+    monkeypatch.setattr(broadcast, "seed_states", lambda campaign_id, first_step, phones: None)
+    result = run(contacts, tmp_path)
+    assert sorted(graph.sent) == ["5511999990008", "5511999990009"]
+    assert (result["rows_done"], result["sent"]) == (10, 10)
+
+def test_seeded_states_are_announced(contacts, tmp_path, seeded, monkeypatch):
+    monkeypatch.setattr(broadcast, "send_message", FakeGraph())
+    announced = []
+
+    class Bus:
+        def publish_states(self, campaign_id, phones):
+            announced.append((campaign_id, list(phones)))
+
+    run(contacts, tmp_path, bus=Bus())
+    assert [phones for _, phones in announced] == seeded
+    assert {campaign_id for campaign_id, _ in announced} == {CAMPAIGN["campaign_id"]}
@@ -0,0 +1,39 @@
+"""Only responses the engine handled are kept for redeliveries."""
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from admission import Overloaded
+from dedup import Deduplicator
+
+BODY = {"phone": "5511999990000", "campaign_id": "c1", "message": "oi", "message_id": "wamid.1"}
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "deduplicator", Deduplicator(path=""))
+    monkeypatch.setattr(main, "reminder_scheduler", None)
+    return TestClient(main.app)
+
+def test_handled_response_is_replayed(client, monkeypatch):
+    monkeypatch.setattr(main, "run_engine", lambda *args: {"next_message": "Obrigado"})
+    assert client.post("/process", json=BODY).json() == {"next_message": "Obrigado"}
+    assert client.post("/process", json=BODY).json() == {"next_message": "Obrigado", "duplicate": True}
+
+def test_throttled_message_is_not_cached(client, monkeypatch):
+    monkeypatch.setattr(main.rate_limiter, "check", lambda phone, campaign_id: {"throttled": True})
+    assert client.post("/process", json=BODY).json() == {"throttled": True}
+    assert main.deduplicator.seen(BODY["message_id"]) is None
+
+def test_rejected_message_is_not_cached(client, monkeypatch):
+    def overloaded(*args):
+        raise Overloaded()
+    monkeypatch.setattr(main, "run_engine", overloaded)
+    assert client.post("/process", json=BODY).json() == main.BUSY_RESPONSE
+    assert main.deduplicator.seen(BODY["message_id"]) is None
+
+def test_failed_message_is_not_cached(client, monkeypatch):
+    def broken(*args):
+        raise RuntimeError("falhou")
+    monkeypatch.setattr(main, "run_engine", broken)
+    assert "detail" in client.post("/process", json=BODY).json()
+    assert main.deduplicator.seen(BODY["message_id"]) is None
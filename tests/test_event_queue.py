@@ -0,0 +1,64 @@
+"""Event queue leases: renewal while handling and fencing of a lost lease."""
+import threading
+import time
+
+from event_queue import EventQueue, consume
+from state_store import InMemoryStateStore
+
+CAMPAIGN = {
+    "campaign_id": "camp-queue",
+    "questions_json": {"questions": [{"id": "1", "text": "Qual seu nome?", "type": "text"}]},
+}
+
+class SlowStore(InMemoryStateStore):
+    """Counts engine runs; each one takes `delay` seconds."""
+    def __init__(self, delay: float):
+        super().__init__({CAMPAIGN["campaign_id"]: CAMPAIGN})
+        self.delay = delay
+        self.runs = 0
+
+    def get_campaign(self, campaign_id):
+        self.runs += 1
+        time.sleep(self.delay)
+        return super().get_campaign(campaign_id)
+
+def test_extend_renews_only_own_leases(tmp_path):
+    queue = EventQueue(str(tmp_path / "events.db"))
+    event_id = queue.enqueue("55", "c", "oi")
+    assert [event["id"] for event in queue.lease("a", lease_seconds=0.1)] == [event_id]
+    assert queue.extend([event_id], "b", 60) == 0
+    assert queue.extend([event_id], "a", 60) == 1
+    time.sleep(0.2)
+    assert queue.lease("b") == []
+
+def test_lost_lease_is_not_recorded(tmp_path):
+    queue = EventQueue(str(tmp_path / "events.db"))
+    event_id = queue.enqueue("55", "c", "oi")
+    queue.lease("a", lease_seconds=0.05)
+    time.sleep(0.1)
+    assert queue.lease("b")
+    assert not queue.record_response(event_id, "a", {"next_message": "x"})
+    assert queue.record_response(event_id, "b", {"next_message": "x"})
+
+def test_slow_handler_keeps_its_event(tmp_path):
+    queue = EventQueue(str(tmp_path / "events.db"))
+    queue.enqueue("5511999990000", CAMPAIGN["campaign_id"], "começar")
+    store = SlowStore(delay=1.0)
+    stop = threading.Event()
+    results = []
+
+    def consumer():
+        results.append(consume(queue, store, workers=1, lease_seconds=0.3, idle_sleep=0.05,
+                               stop=stop, send=False))
+
+    threads = [threading.Thread(target=consumer) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    deadline = time.time() + 5
+    while queue.stats()["pending"] and time.time() < deadline:
+        time.sleep(0.05)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert store.runs == 1
+    assert sum(result["processed"] for result in results) == 1
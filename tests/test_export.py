@@ -0,0 +1,51 @@
+"""Campaign export: live and archived sessions."""
+import csv
+import gzip
+import io
+import json
+
+import supabase_client
+from export import export_stream
+
+CAMPAIGN = {
+    "campaign_id": "camp-export",
+    "questions_json": {"questions": [
+        {"id": "1", "text": "Você concorda?", "type": "quick_reply", "options": [{"text": "Sim"}, {"text": "Não"}]},
+        {"id": "2", "text": "Por quê?", "type": "text"},
+    ]},
+}
+
+def test_export_includes_archived_sessions(tmp_path, monkeypatch):
+    tables = {
+        "whatsapp_user_states": [[{"phone": "551", "current_step": "2", "answers": {"1": "Sim"}}]],
+        "whatsapp_user_states_archive": [[{"id": 9, "phone": "552", "current_step": None,
+                                           "answers": {"1": "Não", "2": "caro"}}]],
+    }
+    selects = {}
+
+    def iter_pages(table, select, key, page_size, filters=None, prefetch=0):
+        selects[table] = (select, key, filters)
+        return iter(tables[table])
+
+    monkeypatch.setattr(supabase_client, "iter_pages", iter_pages)
+    with gzip.open(tmp_path / "whatsapp_user_states-1.ndjson.gz", "wt", encoding="utf-8") as f:
+        f.write(json.dumps({"phone": "553", "campaign_id": "camp-export", "current_step": None,
+                            "answers": {"1": "Sim", "2": "bom"}}) + "\n")
+    body = b"".join(export_stream(CAMPAIGN, "csv", archive_table="whatsapp_user_states_archive",
+                                  archive_key="id", archive_dir=str(tmp_path))).decode("utf-8")
+    rows = list(csv.DictReader(io.StringIO(body)))
+    assert [(row["phone"], row["archived"], row["1"], row["2"]) for row in rows] == [
+        ("551", "False", "Sim", ""),
+        ("552", "True", "Não", "caro"),
+        ("553", "True", "Sim", "bom"),
+    ]
+    assert selects["whatsapp_user_states_archive"] == (
+        "id,phone,current_step,answers", "id", {"campaign_id": "eq.camp-export"})
+
+def test_export_without_archive_reads_live_table_only(monkeypatch):
+    calls = []
+    monkeypatch.setattr(supabase_client, "iter_pages",
+                        lambda table, *args, **kwargs: calls.append(table) or iter([]))
+    body = b"".join(export_stream(CAMPAIGN, "ndjson", archive_table="", archive_dir=""))
+    assert body == b""
+    assert calls == ["whatsapp_user_states"]
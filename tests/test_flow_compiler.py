@@ -0,0 +1,31 @@
+"""get_compiled_flow: a campaign row is hashed when first seen, not on every message."""
+import flow_compiler
+from flow_compiler import get_compiled_flow
+
+def campaign(*options):
+    return {
+        "campaign_id": "camp-compiled",
+        "questions_json": {"questions": [
+            {"id": "1", "text": "Você concorda?", "type": "quick_reply",
+             "options": [{"text": text} for text in options]},
+        ]},
+    }
+
+def test_same_row_is_hashed_once(monkeypatch):
+    calls = []
+    real = flow_compiler.source_hash
+    monkeypatch.setattr(flow_compiler, "source_hash", lambda row: calls.append(row) or real(row))
+    row = campaign("Sim", "Não")
+    flow = get_compiled_flow(row)
+    calls.clear()
+    assert get_compiled_flow(row) is flow
+    assert get_compiled_flow(row) is flow
+    assert calls == []
+
+def test_changed_row_gets_its_own_flow():
+    first = get_compiled_flow(campaign("Sim", "Não"))
+    second = get_compiled_flow(campaign("Não", "Sim"))
+    assert [o.text for o in second.questions[0].options] == ["Não", "Sim"]
+    assert second.source_hash != first.source_hash
+    # An equal row fetched again compiles to the cached flow
+    assert get_compiled_flow(campaign("Não", "Sim")) is second
@@ -0,0 +1,20 @@
+"""Inbound rate limiting: off by default, token buckets when configured."""
+from rate_limit import COALESCED_RESPONSE, THROTTLED_RESPONSE, RateLimiter, parse_limits
+
+def test_off_without_configuration():
+    limiter = RateLimiter(parse_limits("{}"))
+    assert all(limiter.check("55", "c") is None for _ in range(100))
+
+def test_phone_burst_then_warning_once():
+    limiter = RateLimiter(parse_limits('{"default": {"phone": [0.001, 3]}}'))
+    assert [limiter.check("55", "c") for _ in range(3)] == [None, None, None]
+    assert limiter.check("55", "c") == THROTTLED_RESPONSE
+    assert limiter.check("55", "c") == COALESCED_RESPONSE
+    # Other senders have their own bucket
+    assert limiter.check("56", "c") is None
+
+def test_campaign_scope_overrides_default():
+    limiter = RateLimiter(parse_limits('{"default": {"phone": [0.001, 1]}, "grande": {"phone": null}}'))
+    assert limiter.check("55", "c") is None
+    assert limiter.check("55", "c") == THROTTLED_RESPONSE
+    assert all(limiter.check("55", "grande") is None for _ in range(10))
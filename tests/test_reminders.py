@@ -0,0 +1,86 @@
+"""ReminderScheduler: one reminder per window, bounded state, one snapshot per process."""
+import time
+
+from reminders import ReminderScheduler, claim_snapshot_path
+
+def scheduler(tmp_path, **kwargs):
+    return ReminderScheduler(60, send=lambda phone, campaign_id: True,
+                             snapshot_path=str(tmp_path / "reminders.snapshot.gz"), **kwargs)
+
+def test_fires_once_per_session_until_window_expires(tmp_path):
+    t0 = time.time()
+    s = scheduler(tmp_path, window_seconds=3600)
+    s.touch("55", "c", now=t0)
+    assert s.due(now=t0 + 30) == []
+    assert s.due(now=t0 + 61) == [("55", "c")]
+    # Activity after the reminder does not arm a second one within the window
+    s.touch("55", "c", now=t0 + 100)
+    assert s.due(now=t0 + 200) == []
+    assert ("55", "c") in s.reminded
+    # Once the window is over the entry is pruned and the session can be reminded again
+    s.due(now=t0 + 61 + 3600)
+    assert s.reminded == {}
+    s.touch("55", "c", now=t0 + 4000)
+    assert s.due(now=t0 + 4061) == [("55", "c")]
+
+def test_completion_forgets_the_session(tmp_path):
+    t0 = time.time()
+    s = scheduler(tmp_path)
+    s.touch("55", "c", now=t0)
+    s.due(now=t0 + 61)
+    s.touch("55", "c", completed=True, now=t0 + 70)
+    assert s.reminded == {}
+    assert len(s.wheel) == 0
+
+def test_snapshot_round_trip(tmp_path):
+    t0 = time.time()
+    s = scheduler(tmp_path, window_seconds=86400)
+    s.touch("55", "a", now=t0 - 7200)
+    s.due(now=t0 - 7000)  # reminded two hours ago
+    s.touch("56", "b", now=t0 - 100)
+    s.due(now=t0)  # reminded just now
+    s.touch("57", "c", now=t0)
+    path = s.snapshot()
+    s._snapshot_lock.close()  # as if the process exited
+
+    restored = scheduler(tmp_path, window_seconds=3600)
+    assert restored.restore() == 3
+    assert restored.snapshot_path == path
+    # Under a shorter window the older reminder is pruned on load
+    assert list(restored.reminded) == [("56", "b")]
+    assert list(restored.wheel.deadlines) == [("57", "c")]
+
+def test_each_process_claims_its_own_snapshot(tmp_path):
+    base = str(tmp_path / "reminders.snapshot.gz")
+    # flock is held per open file, so a second claim stands in for another process
+    first, first_lock = claim_snapshot_path(base)
+    second, second_lock = claim_snapshot_path(base)
+    assert first == base
+    assert second == str(tmp_path / "reminders.snapshot.1.gz")
+    first_lock.close()
+    again, again_lock = claim_snapshot_path(base)
+    assert again == base
+    again_lock.close()
+    second_lock.close()
+
+def test_send_skips_sessions_active_elsewhere(monkeypatch):
+    from datetime import datetime, timedelta, timezone
+    import supabase_client
+    import whatsapp_client
+    from reminders import send_reminder
+
+    campaign = {"campaign_id": "c", "phone_number_id": "123", "questions_json": {"questions": [
+        {"id": "1", "text": "Você concorda?", "type": "text"}]}}
+    state = {"current_step": "1", "answers": {}}
+    sent = []
+    monkeypatch.setattr(supabase_client, "get_campaign", lambda campaign_id: campaign)
+    monkeypatch.setattr(supabase_client, "get_user_state", lambda phone, campaign_id, flow=None: dict(state))
+    monkeypatch.setattr(whatsapp_client, "send_message", lambda payload, phone_number_id: sent.append(payload) or (True, 200, {}))
+
+    state["updated_at"] = (datetime.now(timezone.utc) - timedelta(seconds=30)).isoformat()
+    assert send_reminder("55", "c", idle_seconds=600) is False
+    state["updated_at"] = (datetime.now(timezone.utc) - timedelta(seconds=900)).isoformat()
+    assert send_reminder("55", "c", idle_seconds=600) is True
+    del state["updated_at"]
+    assert send_reminder("55", "c", idle_seconds=600) is True
+    assert len(sent) == 2
@@ -0,0 +1,40 @@
+"""Breaker bookkeeping of resilience.request."""
+import pytest
+import requests
+
+import resilience
+from resilience import BackendUnavailable, HALF_OPEN, OPEN
+
+URL = "http://127.0.0.1:9/rest/v1/test_probe_table"
+
+class Response:
+    status_code = 200
+
+@pytest.fixture
+def half_open(monkeypatch):
+    target = resilience.endpoint(resilience.endpoint_name(URL))
+    target.state, target.opened_at, target.probing = OPEN, 0.0, False
+    yield target
+    target.state, target.failures, target.probing = resilience.CLOSED, 0, False
+
+def test_unexpected_error_releases_the_probe(half_open, monkeypatch):
+    def broken(*args, **kwargs):
+        raise ValueError("bad header")
+
+    monkeypatch.setattr(requests, "request", broken)
+    with pytest.raises(ValueError):
+        resilience.request("POST", URL)
+    assert half_open.state == HALF_OPEN and not half_open.probing
+    # The next request may probe, and closes the breaker
+    monkeypatch.setattr(requests, "request", lambda *args, **kwargs: Response())
+    assert resilience.request("POST", URL).status_code == 200
+    assert half_open.state == resilience.CLOSED
+
+def test_request_error_reopens_the_breaker(half_open, monkeypatch):
+    def refused(*args, **kwargs):
+        raise requests.ConnectionError("refused")
+
+    monkeypatch.setattr(requests, "request", refused)
+    with pytest.raises(BackendUnavailable):
+        resilience.request("POST", URL)
+    assert half_open.state == OPEN and not half_open.probing
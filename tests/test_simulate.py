@@ -0,0 +1,26 @@
+"""simulate._run_chunk always ends every respondent."""
+import logging
+
+import pytest
+
+import simulate
+from flow_compiler import compile_campaign
+
+@pytest.fixture
+def worker():
+    def start(questions):
+        simulate._init_worker(compile_campaign({"campaign_id": "c-sim", "questions_json": {"questions": questions}}))
+    yield start
+    logging.disable(logging.NOTSET)
+
+def test_question_accepting_no_answer_is_capped(worker):
+    worker([{"id": "1", "text": "Quando?", "type": "date"}])
+    result = simulate._run_chunk((3, 0, 0.0, 0.0, 10))
+    assert result["capped"] == 3
+    assert result["steps"] == 3 * 11  # the start message and ten refused answers
+    assert result["paths"] == {("capped", ("1",)): 3}
+
+def test_valid_flow_completes(worker):
+    worker([{"id": "1", "text": "Concorda?", "type": "quick_reply", "options": [{"text": "Sim"}, {"text": "Não"}]}])
+    result = simulate._run_chunk((5, 0, 0.0, 0.0, 10))
+    assert result["completed"] == 5
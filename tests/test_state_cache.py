@@ -0,0 +1,88 @@
+"""StateCache: per-key invalidation of reads in flight."""
+import threading
+
+from state_cache import StateCache
+
+class BlockingBackend:
+    """get_user_state waits for `release` once `block` is set."""
+    def __init__(self):
+        self.block = threading.Event()
+        self.reading = threading.Event()
+        self.release = threading.Event()
+        self.reads = 0
+
+    def get_user_state(self, phone, campaign_id, flow=None):
+        self.reads += 1
+        if self.block.is_set():
+            self.reading.set()
+            self.release.wait(5)
+        return {"phone": phone, "campaign_id": campaign_id, "current_step": "1", "answers": {}}
+
+def read_while(cache, backend, invalidate, key=("55", "c")):
+    backend.block.set()
+    thread = threading.Thread(target=cache.get_user_state, args=key)
+    thread.start()
+    assert backend.reading.wait(5)
+    invalidate()
+    backend.release.set()
+    thread.join()
+    backend.block.clear()
+
+def test_read_is_cached():
+    backend = BlockingBackend()
+    cache = StateCache(backend)
+    cache.get_user_state("55", "c")
+    cache.get_user_state("55", "c")
+    assert backend.reads == 1
+
+def test_evicting_another_key_keeps_the_read():
+    backend = BlockingBackend()
+    cache = StateCache(backend)
+    read_while(cache, backend, lambda: cache.evict("56", "c"))
+    assert ("55", "c") in cache.entries
+
+def test_evicting_the_same_key_drops_the_read():
+    backend = BlockingBackend()
+    cache = StateCache(backend)
+    read_while(cache, backend, lambda: cache.evict("55", "c"))
+    assert ("55", "c") not in cache.entries
+    # The next read is cached again
+    cache.get_user_state("55", "c")
+    assert ("55", "c") in cache.entries
+
+def test_evicting_the_campaign_drops_the_read():
+    backend = BlockingBackend()
+    cache = StateCache(backend)
+    read_while(cache, backend, lambda: cache.evict_campaign("c"))
+    assert ("55", "c") not in cache.entries
+
+def test_announced_write_drops_any_cached_copy():
+    from cache_bus import CacheBus, connect
+
+    backend = BlockingBackend()
+    cache = StateCache(backend)
+    bus = connect(CacheBus(), state_cache=cache)
+    cache.get_user_state("55", "c")
+    # No version to compare: another process's write always wins
+    bus._deliver(b'{"kind": "state", "phone": "55", "campaign_id": "c", "origin": "other"}')
+    assert ("55", "c") not in cache.entries
+
+def test_batch_job_states_are_dropped():
+    from cache_bus import STATES_PER_MESSAGE, CacheBus, connect
+
+    backend = BlockingBackend()
+    cache = StateCache(backend)
+    phones = [str(n) for n in range(STATES_PER_MESSAGE + 5)]
+    for phone in phones + ["keep"]:
+        cache.get_user_state(phone, "c")
+
+    class Loopback:
+        def publish(self, data):
+            receiver._deliver(data)
+            return 1
+
+    receiver = connect(CacheBus(), state_cache=cache)
+    sender = CacheBus(Loopback())
+    assert sender.publish_states("c", phones) == 1
+    assert sender.stats["published"] == 2
+    assert list(cache.entries) == [("keep", "c")]
@@ -0,0 +1,135 @@
+"""Delta state writes: the whatsapp_step_user_state RPC and its local stand-in."""
+import asyncio
+
+import pytest
+
+import engine
+import state_codec
+import supabase_client
+from flow_compiler import get_compiled_flow
+from state_store import InMemoryStateStore
+
+CAMPAIGN = {
+    "campaign_id": "camp-step",
+    "questions_json": {
+        "questions": [
+            {"id": "1", "text": "Você concorda?", "type": "quick_reply",
+             "options": [{"text": "Sim"}, {"text": "Não"}]},
+            {"id": "2", "text": "Por quê?", "type": "text"},
+        ],
+        "outro": "Fim",
+    },
+}
+
+def run(store, message, phone="5511999990000"):
+    return asyncio.run(engine.process_message(phone, CAMPAIGN["campaign_id"], message, store))
+
+@pytest.fixture
+def store():
+    return InMemoryStateStore({CAMPAIGN["campaign_id"]: CAMPAIGN})
+
+@pytest.fixture
+def delta(monkeypatch):
+    monkeypatch.setattr(engine, "STATE_WRITE_MODE", "delta")
+
+def test_step_merges_answer_and_moves_on(store):
+    store.save_user_state("55", "c", "1", {"0": "a"})
+    state = store.step_user_state("55", "c", "1", "2", "1", "Sim")
+    assert state["current_step"] == "2"
+    assert state["answers"] == {"0": "a", "1": "Sim"}
+
+def test_step_refuses_when_step_moved_on(store):
+    store.save_user_state("55", "c", "2", {"1": "Sim"})
+    assert store.step_user_state("55", "c", "1", "2", "1", "Não") is None
+    assert store.get_user_state("55", "c")["answers"] == {"1": "Sim"}
+
+def test_step_refuses_missing_row(store):
+    assert store.step_user_state("55", "c", None, "1", "1", "Sim") is None
+
+def test_step_encodes_compact_answers(store, monkeypatch):
+    monkeypatch.setattr(state_codec, "STATE_ENCODING", "compact")
+    flow = get_compiled_flow(CAMPAIGN)
+    store.save_user_state("55", "c", "1", {}, flow)
+    state = store.step_user_state("55", "c", "1", "2", "1", "Não", flow)
+    assert store.rows[("55", "c")]["answers"] == {state_codec.SCHEMA_KEY: state_codec.flow_schema(flow), "1": 1}
+    assert state["answers"] == {"1": "Não"}
+
+def test_engine_delta_mode_uses_one_step_call_per_answer(store, delta):
+    run(store, "começar")
+    run(store, "Sim")
+    response = run(store, "porque sim")
+    assert response.get("completed") is True
+    assert store.calls.get("step_user_state") == 2
+    assert store.calls.get("save_user_state") == 1  # the initial state only
+    state = store.get_user_state("5511999990000", CAMPAIGN["campaign_id"])
+    assert state == {"phone": "5511999990000", "campaign_id": CAMPAIGN["campaign_id"],
+                     "current_step": None, "answers": {"1": "Sim", "2": "porque sim"}}
+
+def test_engine_delta_mode_reports_conflict(store, delta):
+    phone, campaign_id = "5511999990000", CAMPAIGN["campaign_id"]
+    run(store, "começar", phone)
+    processor = engine.SurveyProcessor(CAMPAIGN, phone, campaign_id, store)
+    # Another delivery answered in between
+    store.step_user_state(phone, campaign_id, "1", "2", "1", "Não")
+    response = asyncio.run(processor.process("Sim"))
+    assert response == {"next_message": "⚠️ Erro ao salvar resposta. Tente novamente."}
+    assert store.get_user_state(phone, campaign_id)["answers"] == {"1": "Não"}
+
+def test_client_sends_only_the_new_answer(monkeypatch):
+    sent = {}
+
+    class Response:
+        status_code = 200
+        text = ""
+
+        def json(self):
+            return [{"phone": "55", "campaign_id": "c", "current_step": "2", "answers": {"0": "a", "1": "Sim"}}]
+
+    def fake_request(method, url, **kwargs):
+        sent.update(kwargs["json"], method=method, url=url)
+        return Response()
+
+    monkeypatch.setattr(supabase_client, "request", fake_request)
+    state = supabase_client.step_user_state("55", "c", "1", "2", "1", "Sim")
+    assert sent["method"] == "POST"
+    assert sent["url"].endswith("/rest/v1/rpc/whatsapp_step_user_state")
+    assert sent["p_answers"] == {"1": "Sim"}
+    assert (sent["p_expected_step"], sent["p_next_step"]) == ("1", "2")
+    assert state["answers"] == {"0": "a", "1": "Sim"}
+
+def test_client_returns_none_on_conflict(monkeypatch):
+    class Response:
+        status_code = 200
+        text = "[]"
+
+        def json(self):
+            return []
+
+    monkeypatch.setattr(supabase_client, "request", lambda method, url, **kwargs: Response())
+    assert supabase_client.step_user_state("55", "c", "1", "2", "1", "Sim") is None
+
+EDITED = dict(CAMPAIGN, questions_json=dict(CAMPAIGN["questions_json"], questions=[
+    dict(CAMPAIGN["questions_json"]["questions"][0], options=[{"text": "Não"}, {"text": "Sim"}]),
+    CAMPAIGN["questions_json"]["questions"][1],
+]))
+
+def test_step_refuses_answers_of_another_flow_version(store, monkeypatch):
+    monkeypatch.setattr(state_codec, "STATE_ENCODING", "compact")
+    old, new = get_compiled_flow(CAMPAIGN), get_compiled_flow(EDITED)
+    store.save_user_state("55", "c", "2", {"1": "Sim"}, old)
+    assert store.step_user_state("55", "c", "2", None, "2", "porque", new) is None
+    assert store.rows[("55", "c")]["answers"] == {state_codec.SCHEMA_KEY: state_codec.flow_schema(old), "1": 0}
+
+def test_engine_delta_step_across_a_flow_edit(store, delta, monkeypatch):
+    monkeypatch.setattr(state_codec, "STATE_ENCODING", "compact")
+    phone, campaign_id = "5511999990000", CAMPAIGN["campaign_id"]
+    run(store, "começar", phone)
+    run(store, "Sim", phone)
+    # The options are reordered while the respondent is at question 2
+    store.campaigns[campaign_id] = EDITED
+    response = run(store, "porque sim", phone)
+    assert response.get("completed") is True
+    state = store.get_user_state(phone, campaign_id, get_compiled_flow(EDITED))
+    assert state["current_step"] is None
+    assert state["answers"]["1"] != "Não"
+    assert state["answers"]["2"] == "porque sim"
@@ -0,0 +1,68 @@
+"""Tally deltas, their recording time, and the fenced rebuild."""
+import gzip
+import json
+
+import supabase_client
+import tallies
+from flow_compiler import get_compiled_flow
+from tallies import ANSWERED, COMPLETED, TallyCounter
+
+CAMPAIGN = {
+    "campaign_id": "camp-tallies",
+    "questions_json": {"questions": [
+        {"id": "1", "text": "Você concorda?", "type": "quick_reply", "options": [{"text": "Sim"}, {"text": "Não"}]},
+    ]},
+}
+
+class Backend:
+    def __init__(self, ok=True):
+        self.ok = ok
+        self.calls = []
+
+    def call_rpc(self, function, params):
+        self.calls.append((function, params))
+        return self.ok
+
+def test_flush_sends_recording_second_and_keeps_failed_deltas():
+    backend = Backend(ok=False)
+    counter = TallyCounter(backend)
+    counter.merge("c", {("1", "Sim"): 1}, recorded_at=100)
+    counter.merge("c", {("1", "Sim"): 2}, recorded_at=101)
+    assert counter.pending_for("c") == {("1", "Sim"): 3}
+    assert counter.flush() == 0
+    rows = sorted(backend.calls[0][1]["p_deltas"], key=lambda row: row["recorded_at"])
+    assert [(row["delta"], row["recorded_at"]) for row in rows] == [(1, 100), (2, 101)]
+    # Put back with their seconds, so a later flush can still be fenced
+    assert counter.pending == {"c": {("1", "Sim", 100): 1, ("1", "Sim", 101): 2}}
+
+def test_rebuild_counts_archived_sessions(tmp_path, monkeypatch):
+    live = [{"phone": "1", "current_step": "1", "answers": {}},
+            {"phone": "2", "current_step": None, "answers": {"1": "Sim"}}]
+    archived = [{"id": 7, "current_step": None, "answers": {"1": "Não"}}]
+    with gzip.open(tmp_path / "whatsapp_user_states-1.ndjson.gz", "wt", encoding="utf-8") as f:
+        f.write(json.dumps({"phone": "3", "campaign_id": CAMPAIGN["campaign_id"],
+                            "current_step": None, "answers": {"1": "Sim"}}) + "\n")
+        f.write(json.dumps({"phone": "4", "campaign_id": "outra", "current_step": None,
+                            "answers": {"1": "Sim"}}) + "\n")
+    pages = {"whatsapp_user_states": [live], "whatsapp_user_states_archive": [archived]}
+    backend = Backend()
+    monkeypatch.setattr(supabase_client, "iter_pages", lambda table, **kwargs: iter(pages[table]))
+    monkeypatch.setattr(supabase_client, "call_rpc", backend.call_rpc)
+    monkeypatch.setattr(tallies.time, "sleep", lambda seconds: None)
+
+    result = tallies.rebuild(CAMPAIGN, archive_table="whatsapp_user_states_archive", archive_dir=str(tmp_path))
+    assert result["states"] == 4
+    (fence_call, fence), (replace_call, replace) = backend.calls
+    assert fence_call == "whatsapp_fence_tallies"
+    assert fence["p_campaign_id"] == CAMPAIGN["campaign_id"] and isinstance(fence["p_fenced_at"], int)
+    assert replace_call == "whatsapp_replace_tallies"
+    counts = {(row["question_id"], row["answer"]): row["count"] for row in replace["p_counts"]}
+    assert counts == {("1", ANSWERED): 3, ("1", "Sim"): 2, ("1", "Não"): 1, (COMPLETED, ANSWERED): 3}
+
+def test_transition_moves_a_changed_answer():
+    flow = get_compiled_flow(CAMPAIGN)
+    before = {"current_step": "1", "answers": {"1": "Sim"}}
+    after = {"current_step": None, "answers": {"1": "Não"}}
+    assert tallies.transition_deltas(flow, before, after) == {
+        ("1", "Sim"): -1, ("1", "Não"): 1, (COMPLETED, ANSWERED): 1,
+    }
@@ -0,0 +1,32 @@
+import re
+import html
+import logging
+import unicodedata
+from typing import Any
+
+def normalize_text(text: Any) -> str:
+    """Normalizes special characters and HTML entities, handling non-string inputs."""
+    if text is None:
+        return ""
+    if not isinstance(text, str):
+        logging.warning(f"Non-string input received in normalize_text: {type(text)} - {text}")
+        return str(text) if text else ""
+    text = html.unescape(text)
+    text = unicodedata.normalize('NFKD', text)
+    return text.encode('utf-8', 'ignore').decode('utf-8')
+
+def is_valid_cpf(cpf: str) -> bool:
+    """Validates a CPF with character cleaning."""
+    try:
+        cpf = re.sub(r'[^0-9]', '', normalize_text(cpf))
+        if len(cpf) != 11 or cpf == cpf[0] * 11:
+            return False
+        soma = sum(int(cpf[i]) * (10 - i) for i in range(9))
+        d1 = (soma * 10) % 11
+        d1 = d1 if d1 < 10 else 0
+        soma = sum(int(cpf[i]) * (11 - i) for i in range(10))
+        d2 = (soma * 10) % 11
+        d2 = d2 if d2 < 10 else 0
+        return cpf[-2:] == f"{d1}{d2}"
+    except Exception:
+        return False
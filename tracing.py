@@ -0,0 +1,224 @@
+"""Request tracing from the webhook to Supabase, kept in an in-process ring buffer.
+
+A trace follows one inbound message. webhook.php starts it and sends a W3C
+`traceparent` header (00-<trace id>-<parent id>-<flags>) to /process or
+/enqueue, together with X-Webhook-Started-Ms, the time it received Meta's
+POST. main.py continues that trace, or starts one if the header is missing.
+The current span lives in a context variable, so process_message,
+SurveyProcessor and supabase_client see it without extra arguments.
+Every Supabase request carries a traceparent header with the trace id
+(resilience.request), and engine log lines carry "trace_id".
+
+Spans are recorded only for sampled traces. A trace is sampled when the
+caller's flags say so, or with probability TRACE_SAMPLE_RATE. Unsampled
+traces still pass the trace id on, but record nothing. With the rate at
+0 and no header, span() returns a shared no-op object, so tracing costs a
+context variable lookup.
+
+A finished trace goes into a ring buffer of the last TRACE_BUFFER_SIZE
+traces, read by GET /admin/traces. Traces slower than TRACE_LOG_SLOW_MS
+are also logged with their breakdown; that is how the event queue
+consumers, which serve no HTTP, report theirs.
+
+Span names:
+    process / enqueue    the whole request (main.py)
+    event                one queued event in a consumer (event_queue.py)
+    webhook              webhook.php, from Meta's POST until it called us
+    admission.wait       waiting for an engine slot
+    queue.wait           time from /enqueue until a consumer leased the event
+    engine               process_message, end to end
+    get_campaign         campaign lookup (cache or Supabase)
+    state.read           user state read
+    state.write          user state write (upsert or step RPC)
+    supabase:<endpoint>  one Supabase request
+    graph.send           one WhatsApp Cloud API send, retries included
+"""
+import os
+import re
+import json
+import time
+import random
+import logging
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "1000"))
+TRACE_LOG_SLOW_MS = float(os.getenv("TRACE_LOG_SLOW_MS", "0"))  # 0 = do not log
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+def log_event(message: str, data: Dict = {}):
+    log_entry = {'message': message, 'data': data}
+    logging.info(json.dumps(log_entry, ensure_ascii=False))
+
+class Trace:
+    """One trace: its id, whether it is recorded, and its finished spans."""
+    __slots__ = ("trace_id", "sampled", "remote_parent", "started_at", "start", "spans")
+
+    def __init__(self, trace_id: str, sampled: bool, remote_parent: Optional[str] = None):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.remote_parent = remote_parent
+        self.started_at = time.time()
+        self.start = time.perf_counter_ns()
+        # (name, span id, parent span id, start offset ns, duration ns, attrs)
+        self.spans: List[tuple] = []
+
+class Span:
+    """A timed operation; use as a context manager."""
+    __slots__ = ("trace", "name", "span_id", "parent_id", "attrs", "start", "_token")
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[int], attrs: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = random.getrandbits(64) or 1
+        self.parent_id = parent_id
+        self.attrs = attrs
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter_ns()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        duration = time.perf_counter_ns() - self.start
+        _current.reset(self._token)
+        trace = self.trace
+        if trace.sampled:
+            if exc_type is not None:
+                self.attrs["error"] = exc_type.__name__
+            trace.spans.append((self.name, self.span_id, self.parent_id, self.start - trace.start,
+                                duration, self.attrs))
+            if self.parent_id is None:
+                _finish(trace, duration)
+        return False
+
+    def set(self, **attrs: Any) -> None:
+        if self.trace.sampled:
+            self.attrs.update(attrs)
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace.trace_id}-{self.span_id:016x}-{'01' if self.trace.sampled else '00'}"
+
+class _NoSpan:
+    """Stands in for a span when nothing is recorded."""
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+NO_SPAN = _NoSpan()
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("span", default=None)
+_traces: Deque[Trace] = deque(maxlen=TRACE_BUFFER_SIZE)  # appends are atomic; no lock needed
+
+def start(name: str, traceparent: Optional[str] = None, **attrs: Any):
+    """The root span of a request, continuing the caller's trace if it sent a traceparent.
+
+    Returns NO_SPAN when there is nothing to carry: no header and not sampled.
+    """
+    match = _TRACEPARENT.match(traceparent) if traceparent else None
+    sampled = TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+    if match:
+        trace = Trace(match.group(1), sampled or bool(int(match.group(3), 16) & 1), match.group(2))
+    elif sampled:
+        trace = Trace(f"{random.getrandbits(128):032x}", True)
+    else:
+        return NO_SPAN
+    return Span(trace, name, None, attrs)
+
+def span(name: str, **attrs: Any):
+    """A child of the current span, or NO_SPAN outside a sampled trace."""
+    parent = _current.get()
+    if parent is None or not parent.trace.sampled:
+        return NO_SPAN
+    return Span(parent.trace, name, parent.span_id, attrs)
+
+def record(name: str, seconds: float, **attrs: Any) -> None:
+    """Records a span that ended now and lasted `seconds`, e.g. time spent waiting."""
+    parent = _current.get()
+    if parent is None or not parent.trace.sampled:
+        return
+    trace = parent.trace
+    duration = int(max(0.0, seconds) * 1e9)
+    end = time.perf_counter_ns() - trace.start
+    trace.spans.append((name, random.getrandbits(64) or 1, parent.span_id, end - duration, duration, attrs))
+
+def annotate(**attrs: Any) -> None:
+    """Adds attributes to the current span."""
+    found = _current.get()
+    if found is not None:
+        found.set(**attrs)
+
+def current() -> Optional[Span]:
+    """The current span, to hand to another thread (see activate)."""
+    return _current.get()
+
+@contextmanager
+def activate(parent: Optional[Span]) -> Iterator[None]:
+    """Makes `parent` the current span in this thread, e.g. inside a thread pool."""
+    token = _current.set(parent)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+def trace_id() -> Optional[str]:
+    found = _current.get()
+    return found.trace.trace_id if found is not None else None
+
+def traceparent() -> Optional[str]:
+    """Header value for an outgoing request, or None outside a trace."""
+    found = _current.get()
+    return found.traceparent() if found is not None else None
+
+def _finish(trace: Trace, duration: int) -> None:
+    _traces.append(trace)
+    if TRACE_LOG_SLOW_MS and duration >= TRACE_LOG_SLOW_MS * 1e6:
+        exported = export(trace)
+        log_event("Requisição lenta", {key: exported[key] for key in ("trace_id", "name", "duration_ms", "breakdown")})
+
+def export(trace: Trace) -> Dict[str, Any]:
+    """A trace as JSON-ready data: spans in start order and total time per span name."""
+    spans = sorted(trace.spans, key=lambda item: item[3])
+    root = next((item for item in spans if item[2] is None), None)
+    breakdown: Dict[str, float] = {}
+    for name, _, parent_id, _, duration, _ in spans:
+        if parent_id is not None:
+            breakdown[name] = breakdown.get(name, 0.0) + duration / 1e6
+    return {
+        "trace_id": trace.trace_id,
+        "name": root[0] if root else None,
+        "started_at": trace.started_at,
+        "duration_ms": round(root[4] / 1e6, 3) if root else None,
+        "attrs": root[5] if root else {},
+        "remote_parent": trace.remote_parent,
+        "breakdown": {name: round(ms, 3) for name, ms in breakdown.items()},
+        "spans": [dict(attrs, name=name, span_id=f"{span_id:016x}",
+                       parent_id=f"{parent_id:016x}" if parent_id else None,
+                       offset_ms=round(offset / 1e6, 3), duration_ms=round(duration / 1e6, 3))
+                  for name, span_id, parent_id, offset, duration, attrs in spans],
+    }
+
+def traces(limit: int = 50, min_ms: float = 0, trace_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """The latest finished traces, newest first."""
+    found = []
+    for trace in reversed(list(_traces)):
+        if trace_id and trace.trace_id != trace_id:
+            continue
+        exported = export(trace)
+        if (exported["duration_ms"] or 0) < min_ms:
+            continue
+        found.append(exported)
+        if len(found) >= limit:
+            break
+    return found
@@ -0,0 +1,422 @@
+<?php
+// webhook.php
+
+require_once 'config.php';
+
+// Função para gravar logs estruturados em JSON
+function customLog($message, $data = [], $isTest = false) {
+    if ($isTest) return;
+    $log_file = __DIR__ . '/webhook_log.txt';
+    $timestamp = date('Y-m-d H:i:s');
+    $log_entry = [
+        'timestamp' => $timestamp,
+        'message' => $message,
+        'data' => $data
+    ];
+    file_put_contents($log_file, json_encode($log_entry) . "\n", FILE_APPEND);
+}
+
+// Função para gravar logs detalhados em survey_tracking_log.txt
+function writeSurveyTrackingLog($phoneNumber, $campaignId, $phoneNumberId, $eventType, $details, $isTest = false) {
+    if ($isTest) return;
+    $timestamp = date('Y-m-d H:i:s');
+    $log_entry = [
+        'timestamp' => $timestamp,
+        'phone_number' => $phoneNumber,
+        'campaign_id' => $campaignId,
+        'phone_number_id' => $phoneNumberId,
+        'event_type' => $eventType,
+        'details' => $details
+    ];
+    file_put_contents('survey_tracking_log.txt', json_encode($log_entry) . "\n", FILE_APPEND);
+}
+
+// Rastreamento: cada mensagem recebe um traceparent (W3C), repassado ao FastAPI e ao Supabase.
+// TRACE_SAMPLE_RATE (config.php) define a fração de mensagens com spans gravados no FastAPI;
+// os tempos do webhook são registrados para essas e para as que passarem de TRACE_LOG_SLOW_MS.
+function startTrace() {
+    $rate = defined('TRACE_SAMPLE_RATE') ? TRACE_SAMPLE_RATE : 0;
+    $GLOBALS['trace'] = [
+        'trace_id' => bin2hex(random_bytes(16)),
+        'span_id' => bin2hex(random_bytes(8)),
+        'sampled' => $rate > 0 && mt_rand() / mt_getrandmax() < $rate,
+        'started' => microtime(true),
+        'timings' => ['supabase_ms' => 0, 'fastapi_ms' => 0, 'send_ms' => 0]
+    ];
+    register_shutdown_function('logTrace');
+}
+
+function traceparent() {
+    $trace = $GLOBALS['trace'] ?? null;
+    if (!$trace) return null;
+    return "00-{$trace['trace_id']}-{$trace['span_id']}-" . ($trace['sampled'] ? '01' : '00');
+}
+
+function addTiming($key, $started) {
+    if (isset($GLOBALS['trace'])) {
+        $GLOBALS['trace']['timings'][$key] += round((microtime(true) - $started) * 1000, 1);
+    }
+}
+
+function logTrace() {
+    $trace = $GLOBALS['trace'] ?? null;
+    if (!$trace) return;
+    $total = round((microtime(true) - $trace['started']) * 1000, 1);
+    $slow = defined('TRACE_LOG_SLOW_MS') ? TRACE_LOG_SLOW_MS : 0;
+    if ($trace['sampled'] || ($slow > 0 && $total >= $slow)) {
+        customLog("Tempos do webhook", array_merge(['trace_id' => $trace['trace_id'], 'total_ms' => $total], $trace['timings']));
+    }
+}
+
+// Função para tratar erros de forma centralizada
+function handleError($from, $message, $phone_number_id, $campaign_id = null, $isTest = false) {
+    sendWhatsAppMessage($from, $message, $phone_number_id, $isTest);
+    customLog("Erro: $message", ['phone' => $from, 'campaign_id' => $campaign_id], $isTest);
+    writeSurveyTrackingLog($from, $campaign_id, $phone_number_id, 'error', [
+        'error_message' => $message
+    ], $isTest);
+    http_response_code(200);
+    exit;
+}
+
+// Função para buscar access_token e whatsapp_id do Supabase
+function getAccessToken($phone_number_id) {
+    $result = supabaseRequest('GET', "/iap_integration_configurations?select=config_data&config_data->>phone_id=eq.$phone_number_id");
+    if (!$result || !isset($result[0]['config_data']['access_token']) || !isset($result[0]['config_data']['whatsapp_id'])) {
+        customLog("Nenhum access_token ou whatsapp_id encontrado", ['phone_number_id' => $phone_number_id]);
+        return null;
+    }
+    return [
+        'access_token' => $result[0]['config_data']['access_token'],
+        'whatsapp_id' => $result[0]['config_data']['whatsapp_id']
+    ];
+}
+
+// Função para enviar mensagem pelo WhatsApp
+function sendWhatsAppMessage($to, $messageOrPayload, $phone_number_id, $isTest = false, $isQuickReply = false) {
+    $auth = getAccessToken($phone_number_id);
+    if (!$auth) {
+        customLog("Auth não encontrado", ['phone' => $to, 'phone_number_id' => $phone_number_id], $isTest);
+        writeSurveyTrackingLog($to, null, $phone_number_id, 'error', ['error_message' => 'Auth não encontrado'], $isTest);
+        return;
+    }
+    $access_token = $auth['access_token'];
+
+    if ($isQuickReply || (is_array($messageOrPayload) && isset($messageOrPayload['interactive']))) {
+        $payload = [
+            'messaging_product' => 'whatsapp',
+            'to' => $to,
+            'type' => 'interactive',
+            'interactive' => $messageOrPayload['interactive']
+        ];
+    } elseif (is_array($messageOrPayload) && isset($messageOrPayload['type']) && $messageOrPayload['type'] === 'template') {
+        $payload = $messageOrPayload;
+    } else {
+        $payload = [
+            'messaging_product' => 'whatsapp',
+            'to' => $to,
+            'type' => 'text',
+            'text' => ['body' => $messageOrPayload]
+        ];
+    }
+
+    $options = [
+        'http' => [
+            'header' => "Content-Type: application/json\r\nAuthorization: Bearer $access_token\r\n",
+            'method' => 'POST',
+            'content' => json_encode($payload)
+        ]
+    ];
+
+    $context = stream_context_create($options);
+    $started = microtime(true);
+    $result = @file_get_contents(WHATSAPP_API_URL . "$phone_number_id/messages", false, $context);
+    addTiming('send_ms', $started);
+    if ($result === false) {
+        customLog("Erro ao enviar mensagem", ['phone' => $to, 'phone_number_id' => $phone_number_id, 'response' => $http_response_header], $isTest);
+        writeSurveyTrackingLog($to, null, $phone_number_id, 'error', [
+            'error_message' => 'Falha ao enviar mensagem',
+            'response' => $http_response_header
+        ], $isTest);
+    } else {
+        customLog("Mensagem enviada", ['phone' => $to, 'phone_number_id' => $phone_number_id, 'payload' => $payload], $isTest);
+        writeSurveyTrackingLog($to, null, $phone_number_id, 'message_sent', [
+            'message_type' => $payload['type'],
+            'content' => $payload[$payload['type']]
+        ], $isTest);
+    }
+}
+
+// Função para verificar se o usuário já participou
+function hasParticipated($phone, $campaign_id, $isTest = false) {
+    if ($isTest) return false;
+    $result = supabaseRequest('GET', "/iap_survey_results?phone_number=eq.$phone&campaign_id=eq.$campaign_id&select=id,completed");
+    if ($result && !empty($result) && isset($result[0]['completed']) && $result[0]['completed'] === true) {
+        customLog("Usuário já participou", ['phone' => $phone, 'campaign_id' => $campaign_id], $isTest);
+        writeSurveyTrackingLog($phone, $campaign_id, null, 'participation_blocked', [], $isTest);
+        return true;
+    }
+    return false;
+}
+
+// Função para fazer requisições ao Supabase
+function supabaseRequest($method, $endpoint, $data = null) {
+    $url = SUPABASE_URL . '/rest/v1' . $endpoint;
+    $headers = [
+        "Content-Type: application/json",
+        "apikey: " . SUPABASE_KEY,
+        "Authorization: Bearer " . SUPABASE_KEY
+    ];
+    if (traceparent()) {
+        $headers[] = "traceparent: " . traceparent();
+    }
+    $options = [
+        'http' => [
+            'method' => $method,
+            'header' => implode("\r\n", $headers)
+        ]
+    ];
+    if ($data) {
+        $options['http']['content'] = json_encode($data);
+    }
+    $context = stream_context_create($options);
+    try {
+        $started = microtime(true);
+        $result = @file_get_contents($url, false, $context);
+        addTiming('supabase_ms', $started);
+        if ($result === false) {
+            customLog("Erro na requisição ao Supabase", ['method' => $method, 'endpoint' => $endpoint, 'response' => $http_response_header]);
+            return false;
+        }
+        return json_decode($result, true);
+    } catch (Exception $e) {
+        customLog("Exceção na requisição ao Supabase", ['method' => $method, 'endpoint' => $endpoint, 'error' => $e->getMessage()]);
+        return false;
+    }
+}
+
+// Função para carregar campanha
+function loadCampaign($identifier, $campaign_id = null) {
+    $endpoint = $campaign_id && preg_match('/^[a-f\d]{8}-([a-f\d]{4}-){3}[a-f\d]{12}$/i', $campaign_id)
+        ? "/iap_campaigns?campaign_id=eq.$campaign_id&select=campaign_id,title,phone_number_id,flow_json,questions_json,template_id,integration_id,send_report"
+        : "/iap_campaigns?phone_number_id=eq.$identifier&select=campaign_id,title,phone_number_id,flow_json,questions_json,template_id,integration_id,send_report&order=created_at.desc&limit=1";
+    $result = supabaseRequest('GET', $endpoint);
+    if ($result && !empty($result)) {
+        $campaign = $result[0];
+        $campaign['questions_json'] = isset($campaign['flow_json']) ? $campaign['flow_json'] : $campaign['questions_json'];
+        customLog("Campanha carregada", ['campaign' => $campaign]);
+        writeSurveyTrackingLog(null, $campaign_id, $identifier, 'campaign_loaded', ['result' => $campaign]);
+        return $campaign;
+    }
+    customLog("Nenhuma campanha encontrada", ['identifier' => $identifier, 'campaign_id' => $campaign_id]);
+    return null;
+}
+
+// Função para buscar campaign_id por código
+function getCampaignIdByCode($code) {
+    $result = supabaseRequest('GET', "/iap_campaign_codes?code=eq.$code&select=campaign_id");
+    if ($result && !empty($result)) {
+        return $result[0]['campaign_id'];
+    }
+    return null;
+}
+
+// Cabeçalhos que ligam a requisição ao FastAPI ao trace desta mensagem
+function fastAPITraceHeaders() {
+    if (!traceparent()) return "";
+    return "traceparent: " . traceparent() . "\r\nX-Webhook-Started-Ms: " . round($GLOBALS['trace']['started'] * 1000) . "\r\n";
+}
+
+// Função para chamar o backend FastAPI
+// $message_id: id da mensagem no WhatsApp; o FastAPI ignora reentregas do mesmo id
+function callFastAPI($phone, $campaign_id, $message, $phone_number_id, $isTest = false, $message_id = null) {
+    $fastapi_url = "http://localhost:8000/process"; // Ajuste para a URL do seu servidor FastAPI
+    $payload = [
+        'phone' => $phone,
+        'campaign_id' => $campaign_id,
+        'message' => $message,
+        'message_id' => $message_id
+    ];
+    $options = [
+        'http' => [
+            'method' => 'POST',
+            'header' => "Content-Type: application/json\r\n" . fastAPITraceHeaders(),
+            'content' => json_encode($payload)
+        ]
+    ];
+    $context = stream_context_create($options);
+    $started = microtime(true);
+    $result = @file_get_contents($fastapi_url, false, $context);
+    addTiming('fastapi_ms', $started);
+    if ($result === false) {
+        customLog("Erro ao chamar FastAPI", ['phone' => $phone, 'campaign_id' => $campaign_id, 'response' => $http_response_header], $isTest);
+        writeSurveyTrackingLog($phone, $campaign_id, $phone_number_id, 'error', [
+            'error_message' => 'Falha ao chamar FastAPI'
+        ], $isTest);
+        return null;
+    }
+    return json_decode($result, true);
+}
+
+// Modo fila: o FastAPI só grava a mensagem e os consumidores (event_queue.py) enviam a resposta
+function queueModeEnabled() {
+    return defined('FASTAPI_QUEUE_MODE') && FASTAPI_QUEUE_MODE;
+}
+
+function enqueueFastAPI($phone, $campaign_id, $message, $phone_number_id, $isTest = false, $message_id = null) {
+    $fastapi_url = "http://localhost:8000/enqueue"; // Ajuste para a URL do seu servidor FastAPI
+    $payload = [
+        'phone' => $phone,
+        'campaign_id' => $campaign_id,
+        'message' => $message,
+        'phone_number_id' => $phone_number_id,
+        'message_id' => $message_id
+    ];
+    $options = [
+        'http' => [
+            'method' => 'POST',
+            'header' => "Content-Type: application/json\r\n" . fastAPITraceHeaders(),
+            'content' => json_encode($payload)
+        ]
+    ];
+    $context = stream_context_create($options);
+    $started = microtime(true);
+    $result = @file_get_contents($fastapi_url, false, $context);
+    addTiming('fastapi_ms', $started);
+    $response = $result === false ? null : json_decode($result, true);
+    if ($response && !empty($response['duplicate'])) {
+        // Reentrega de uma mensagem já enfileirada
+        customLog("Mensagem duplicada ignorada", ['phone' => $phone, 'message_id' => $message_id], $isTest);
+        return true;
+    }
+    if (!$response || empty($response['queued'])) {
+        customLog("Erro ao enfileirar mensagem", ['phone' => $phone, 'campaign_id' => $campaign_id, 'response' => $result], $isTest);
+        writeSurveyTrackingLog($phone, $campaign_id, $phone_number_id, 'error', [
+            'error_message' => 'Falha ao enfileirar mensagem'
+        ], $isTest);
+        return false;
+    }
+    writeSurveyTrackingLog($phone, $campaign_id, $phone_number_id, 'message_queued', ['id' => $response['id']], $isTest);
+    return true;
+}
+
+// Verificar método da requisição
+$method = $_SERVER['REQUEST_METHOD'];
+
+if ($method === 'GET') {
+    $mode = $_GET['hub_mode'] ?? '';
+    $token = $_GET['hub_verify_token'] ?? '';
+    $challenge = $_GET['hub_challenge'] ?? '';
+
+    if ($mode === 'subscribe' && $token === VERIFY_TOKEN) {
+        echo $challenge;
+        customLog("Webhook verificado com sucesso");
+        http_response_code(200);
+    } else {
+        echo "Token inválido";
+        customLog("Falha na verificação do Webhook", ['error' => 'Token inválido']);
+        writeSurveyTrackingLog(null, null, null, 'error', ['error_message' => 'Token inválido']);
+        http_response_code(403);
+    }
+    exit;
+}
+
+if ($method === 'POST') {
+    startTrace();
+    $input = file_get_contents('php://input');
+    $data = json_decode($input, true);
+    customLog("Payload recebido", ['payload' => $input]);
+    
+    if (isset($data['entry'][0]['changes'][0]['value']['messages'][0])) {
+        $message = $data['entry'][0]['changes'][0]['value']['messages'][0];
+        $from = $message['from'];
+        $message_id = $message['id'] ?? null;
+        $text = strtolower(trim($message['text']['body'] ?? ''));
+        $button_text = strtolower(trim($message['button']['text'] ?? $message['interactive']['button_reply']['id'] ?? $message['interactive']['button_reply']['title'] ?? ''));
+        $phone_number_id = $data['entry'][0]['changes'][0]['value']['metadata']['phone_number_id'];
+        $contact_name = $data['entry'][0]['changes'][0]['value']['contacts'][0]['profile']['name'] ?? '';
+        $isTest = isset($message['context']) && strpos($text, 'teste') !== false;
+
+        writeSurveyTrackingLog($from, null, $phone_number_id, 'payload_received', ['payload' => $input], $isTest);
+        customLog("Mensagem recebida", ['phone' => $from, 'text' => $text, 'button_text' => $button_text, 'isTest' => $isTest, 'trace_id' => $GLOBALS['trace']['trace_id']]);
+
+        $input_message = $button_text ?: $text;
+        $campaign = loadCampaign($phone_number_id);
+        if (!$campaign) {
+            handleError($from, "Nenhuma campanha ativa no momento.", $phone_number_id, null, $isTest);
+        }
+
+        if (hasParticipated($from, $campaign['campaign_id'], $isTest)) {
+            handleError($from, "Você já participou desta pesquisa!", $phone_number_id, $campaign['campaign_id'], $isTest);
+        }
+
+        // Lógica para "começar <código>"
+        if (preg_match('/^começar\s+([A-Z0-9]+)$/i', $text, $matches)) {
+            $campaign_code = strtoupper($matches[1]);
+            $campaign_id = getCampaignIdByCode($campaign_code);
+            if ($campaign_id) {
+                $campaign = loadCampaign($campaign_id, $campaign_id);
+                if ($campaign) {
+                    if (hasParticipated($from, $campaign['campaign_id'], $isTest)) {
+                        handleError($from, "Você já participou desta pesquisa!", $phone_number_id, $campaign['campaign_id'], $isTest);
+                    }
+                    if (queueModeEnabled()) {
+                        if (!enqueueFastAPI($from, $campaign['campaign_id'], 'começar', $phone_number_id, $isTest, $message_id)) {
+                            handleError($from, "Erro ao iniciar a campanha. Tente novamente.", $phone_number_id, $campaign['campaign_id'], $isTest);
+                        }
+                        http_response_code(200);
+                        exit;
+                    }
+                    $response = callFastAPI($from, $campaign['campaign_id'], 'começar', $phone_number_id, $isTest, $message_id);
+                    if ($response && !empty($response['duplicate'])) {
+                        // A primeira entrega desta mensagem já respondeu
+                        customLog("Mensagem duplicada ignorada", ['phone' => $from, 'message_id' => $message_id], $isTest);
+                    } elseif ($response && isset($response['next_message'])) {
+                        $isQuickReply = isset($campaign['questions_json']['questions'][0]['type']) && 
+                                       $campaign['questions_json']['questions'][0]['type'] === 'quick_reply' && 
+                                       count($campaign['questions_json']['questions'][0]['options']) <= 3;
+                        sendWhatsAppMessage($from, $response['next_message'], $phone_number_id, $isTest, $isQuickReply);
+                        writeSurveyTrackingLog($from, $campaign['campaign_id'], $phone_number_id, 'question_sent', [
+                            'message' => $response['next_message']
+                        ], $isTest);
+                    } else {
+                        handleError($from, "Erro ao iniciar a campanha. Tente novamente.", $phone_number_id, $campaign['campaign_id'], $isTest);
+                    }
+                } else {
+                    handleError($from, "Código de campanha inválido: $campaign_code.", $phone_number_id, null, $isTest);
+                }
+                exit;
+            }
+        }
+
+        // Processar mensagem normal
+        if (queueModeEnabled()) {
+            if (!enqueueFastAPI($from, $campaign['campaign_id'], $input_message, $phone_number_id, $isTest, $message_id)) {
+                handleError($from, "Erro ao processar sua resposta. Tente novamente.", $phone_number_id, $campaign['campaign_id'], $isTest);
+            }
+            http_response_code(200);
+            exit;
+        }
+        $response = callFastAPI($from, $campaign['campaign_id'], $input_message, $phone_number_id, $isTest, $message_id);
+        if ($response && !empty($response['duplicate'])) {
+            // A primeira entrega desta mensagem já respondeu
+            customLog("Mensagem duplicada ignorada", ['phone' => $from, 'message_id' => $message_id], $isTest);
+        } elseif ($response && isset($response['next_message'])) {
+            $isQuickReply = isset($campaign['questions_json']['questions'][0]['type']) && 
+                           $campaign['questions_json']['questions'][0]['type'] === 'quick_reply' && 
+                           count($campaign['questions_json']['questions'][0]['options']) <= 3;
+            sendWhatsAppMessage($from, $response['next_message'], $phone_number_id, $isTest, $isQuickReply);
+            writeSurveyTrackingLog($from, $campaign['campaign_id'], $phone_number_id, 'question_sent', [
+                'message' => $response['next_message']
+            ], $isTest);
+        } elseif (isset($response['detail'])) {
+            handleError($from, "Erro ao processar sua resposta. Tente novamente.", $phone_number_id, $campaign['campaign_id'], $isTest);
+        }
+        http_response_code(200);
+        exit;
+    }
+    customLog("Nenhuma mensagem válida no payload");
+    http_response_code(200);
+    exit;
+}
+?>
\ No newline at end of file
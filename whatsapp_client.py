@@ -0,0 +1,145 @@
+"""Outbound WhatsApp Cloud API messages, sent from Python.
+
+Mirrors sendWhatsAppMessage in webhook.php: the access token of a sender
+number comes from iap_integration_configurations (config_data->>phone_id),
+unless WHATSAPP_TOKEN is set. GRAPH_API_URL points the client at another
+Graph endpoint, e.g. a local fake in tests.
+"""
+import os
+import json
+import time
+import random
+import logging
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import tracing
+
+GRAPH_API_URL = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v19.0/")
+WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
+SEND_TIMEOUT = 15
+RETRY_STATUS = (429, 500, 502, 503, 504)
+MAX_RETRIES = 3
+
+_tokens: Dict[str, str] = {}
+_tokens_lock = threading.Lock()
+
+def log_event(message: str, data: Dict = {}):
+    log_entry = {'message': message, 'data': data}
+    logging.info(json.dumps(log_entry, ensure_ascii=False))
+
+def new_session(pool_size: int = 10) -> requests.Session:
+    """A session whose connection pool fits `pool_size` concurrent senders."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_access_token(phone_number_id: str) -> Optional[str]:
+    """Access token of a sender number, looked up once per process."""
+    if WHATSAPP_TOKEN:
+        return WHATSAPP_TOKEN
+    with _tokens_lock:
+        token = _tokens.get(phone_number_id)
+    if token:
+        return token
+    from supabase_client import select_rows
+    rows = select_rows("iap_integration_configurations", {
+        "select": "config_data",
+        "config_data->>phone_id": f"eq.{phone_number_id}",
+    })
+    token = rows[0].get("config_data", {}).get("access_token") if rows else None
+    if not token:
+        log_event("Nenhum access_token encontrado", {"phone_number_id": phone_number_id})
+        return None
+    with _tokens_lock:
+        _tokens[phone_number_id] = token
+    return token
+
+def text_payload(to: str, body: str) -> Dict[str, Any]:
+    return {"messaging_product": "whatsapp", "to": to, "type": "text", "text": {"body": body}}
+
+def template_payload(to: str, name: str, language: str = "pt_BR",
+                     body_params: Optional[List[str]] = None) -> Dict[str, Any]:
+    template: Dict[str, Any] = {"name": name, "language": {"code": language}}
+    if body_params:
+        template["components"] = [{
+            "type": "body",
+            "parameters": [{"type": "text", "text": str(value)} for value in body_params],
+        }]
+    return {"messaging_product": "whatsapp", "to": to, "type": "template", "template": template}
+
+def response_payload(to: str, response: Dict[str, Any]) -> Dict[str, Any]:
+    """Payload for an engine response: interactive options or plain text."""
+    if "interactive" in response:
+        return {"messaging_product": "whatsapp", "to": to, "type": "interactive",
+                "interactive": response["interactive"]}
+    return text_payload(to, response.get("next_message", ""))
+
+def send_message(payload: Dict[str, Any], phone_number_id: str,
+                 session: Optional[requests.Session] = None) -> Tuple[bool, int, str]:
+    """Sends one message, retrying throttling and server errors with backoff.
+
+    Returns (success, status_code, response text); status_code is 0 when no
+    response was received.
+    """
+    with tracing.span("graph.send") as span:
+        ok, status, text = _send(payload, phone_number_id, session)
+        span.set(status=status)
+    return ok, status, text
+
+def _send(payload: Dict[str, Any], phone_number_id: str,
+          session: Optional[requests.Session]) -> Tuple[bool, int, str]:
+    token = get_access_token(phone_number_id)
+    if not token:
+        return False, 0, "access_token ausente"
+    http = session or requests
+    url = f"{GRAPH_API_URL}{phone_number_id}/messages"
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    status, text = 0, ""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            res = http.post(url, headers=headers, json=payload, timeout=SEND_TIMEOUT)
+            status, text = res.status_code, res.text
+            if status in (200, 201):
+                return True, status, text
+            if status not in RETRY_STATUS:
+                break
+        except requests.RequestException as e:
+            status, text = 0, str(e)
+        if attempt < MAX_RETRIES:
+            time.sleep(min(8.0, 0.5 * 2 ** attempt) * (0.5 + random.random()))
+    log_event("Erro ao enviar mensagem", {
+        "phone": payload.get("to"),
+        "phone_number_id": phone_number_id,
+        "status_code": status,
+        "response": text
+    })
+    return False, status, text
+
+class SendRateLimiter:
+    """Token bucket shared by sender threads: at most `rate` sends per second."""
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)